@@ -0,0 +1,63 @@
+"""
+Compare uploading N files one `upload_image_from_file` call at a time with
+`upload_images_from_files` batches, against a local fake OMERO server.
+
+usage: python benchmarks/bench_batch.py [n_files] [login_latency]
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+from unittest import mock
+
+
+def run(n_files=1000, login_latency=0.2, batch=True):
+    from pyme_omero import core, import_utils
+    from pyme_omero.connection import SessionPool
+    from pyme_omero.testing.fake_omero import FakeServer
+
+    server = FakeServer(login_latency=login_latency)
+    pool = SessionPool(server.login)
+    core.set_session_pool(pool)
+
+    with tempfile.TemporaryDirectory() as temp_dir, \
+            mock.patch.object(import_utils, 'wait_for_import',
+                              server.wait_for_import):
+        files, attachments = [], []
+        for i in range(n_files):
+            files.append(os.path.join(temp_dir, '%d.tif' % i))
+            attachments.append([os.path.join(temp_dir, '%d.hdf' % i)])
+            for path in [files[-1]] + attachments[-1]:
+                with open(path, 'wb') as f:
+                    f.write(os.urandom(4096))
+
+        t0 = time.time()
+        if batch:
+            core.upload_images_from_files(files, 'bench-dataset',
+                                          'bench-project', attachments)
+        else:
+            for path, image_attachments in zip(files, attachments):
+                core.upload_image_from_file(path, 'bench-dataset',
+                                            'bench-project', image_attachments)
+        elapsed = time.time() - t0
+
+    pool.close()
+    return {
+        'benchmark': 'batch_upload',
+        'batch': batch,
+        'n_files': n_files,
+        'logins': server.n_logins,
+        'saveArray_calls': server.calls['saveArray'],
+        'getObject_calls': server.calls['getObject'],
+        'seconds': elapsed,
+        'files_per_second': n_files / elapsed,
+    }
+
+
+if __name__ == '__main__':
+    n_files = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+    for batch in [False, True]:
+        print(json.dumps(run(n_files, latency, batch)))
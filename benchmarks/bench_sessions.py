@@ -0,0 +1,63 @@
+"""
+Count OMERO logins per `ImageUpload.save`-style recipe run against a local fake
+gateway, with and without session reuse.
+
+usage: python benchmarks/bench_sessions.py [n_runs] [login_latency]
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+from unittest import mock
+
+
+def recipe_run(core, image_path, attachment_path):
+    # the sequence of core calls made by ImageUpload.save
+    image_id = core.upload_image_from_file(image_path, 'bench-dataset',
+                                           'bench-project', [attachment_path])
+    core.connect_and_upload_file_annotation(image_id, attachment_path,
+                                            namespace='pyme.localizations')
+
+
+def run(n_runs=20, login_latency=0.2, reuse=True):
+    from pyme_omero import core
+    from pyme_omero.connection import SessionPool
+    from pyme_omero.testing.fake_omero import FakeServer
+
+    server = FakeServer(login_latency=login_latency)
+    # max_idle=0 discards every session on return, i.e. one login per checkout
+    pool = SessionPool(server.login, max_idle=300. if reuse else 0.)
+    core.set_session_pool(pool)
+
+    with tempfile.TemporaryDirectory() as temp_dir, \
+            mock.patch.object(core, 'file_import', server.file_import):
+        image_path = os.path.join(temp_dir, 'bench.tif')
+        attachment_path = os.path.join(temp_dir, 'bench.hdf')
+        for path in [image_path, attachment_path]:
+            with open(path, 'wb') as f:
+                f.write(b'\0' * 1024)
+
+        t0 = time.time()
+        for _ in range(n_runs):
+            recipe_run(core, image_path, attachment_path)
+        elapsed = time.time() - t0
+
+    pool.close()
+    return {
+        'benchmark': 'sessions',
+        'reuse': reuse,
+        'n_runs': n_runs,
+        'login_latency_s': login_latency,
+        'logins': server.n_logins,
+        'logins_per_run': server.n_logins / n_runs,
+        'seconds_per_run': elapsed / n_runs,
+    }
+
+
+if __name__ == '__main__':
+    n_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+    for reuse in [False, True]:
+        print(json.dumps(run(n_runs, latency, reuse)))
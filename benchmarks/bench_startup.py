@@ -0,0 +1,51 @@
+"""
+Measure the import cost of pyme-omero's PYME plugin modules and of
+`pyme_omero.core` with ``python -X importtime``, and check it stays within a
+budget without importing omero, Ice or yaml. Exits non-zero if not.
+
+The PYME / wx modules each plugin module needs are imported first and not
+counted, as the host application has already loaded them during plugin
+discovery.
+
+usage: python benchmarks/bench_startup.py [budget_ms]
+"""
+
+import json
+import sys
+
+# plugin module -> host modules already loaded when it is registered
+TARGETS = [
+    ('pyme_omero.core', []),
+    ('pyme_omero.recipe_modules.omero_upload', ['PYME.recipes.base',
+                                                'PYME.recipes.output',
+                                                'PYME.recipes.traits']),
+    ('pyme_omero.dsviewer_modules.omero_io', ['wx',
+                                              'PYME.DSView.modules._base']),
+    ('pyme_omero.visgui_modules.omero_loader', ['wx']),
+]
+
+
+def run(budget_ms=100.):
+    from pyme_omero.testing.importtime import import_cost
+
+    results = []
+    for module, preload in TARGETS:
+        try:
+            result = import_cost(module, preload)
+        except ImportError as e:
+            result = {'module': module, 'skipped': str(e)}
+        else:
+            result['budget_ms'] = budget_ms
+            result['ok'] = (result['import_ms'] <= budget_ms
+                            and not result['heavy_imports'])
+        result['benchmark'] = 'startup'
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 100.
+    results = run(budget)
+    for result in results:
+        print(json.dumps(result))
+    sys.exit(0 if all(r.get('ok', True) for r in results) else 1)
@@ -0,0 +1,298 @@
+"""
+Benchmark the main upload and download paths of `pyme_omero.core` against a
+local fake OMERO server (`pyme_omero.testing.fake_omero`) with configurable
+latency and bandwidth, so they can be measured on a laptop or in CI.
+
+Benchmarks:
+    single_upload      one image with one attachment, `upload_image_from_file`
+    batch_upload       n images with one attachment each,
+                       `upload_images_from_files`
+    large_download     one large OriginalFile over 1 and 4 streams,
+                       `transfer.download_original_file`
+    container_lookup   `get_or_create_dataset_id`, cold then cached
+    attachment_fetch   the localization files attached to an image (among
+                       tags and other files), `localization_files_from_image_url`
+    pixel_upload       one in-memory uint16 z-stack, written as OME-TIFF and
+                       imported with `upload_image_from_file`, then written
+                       plane by plane over 1 and 4 RawPixelsStores with
+                       `upload_image_from_pixels`
+
+Each result is printed as one JSON object per line, including the per-operation
+timing summary from `pyme_omero.metrics`, and optionally appended to a file, so
+runs can be compared over time.
+
+usage: python benchmarks/bench_suite.py [--only NAME ...] [--output PATH]
+                                        [--rpc-latency S] [--bandwidth MB/S]
+                                        [--login-latency S]
+                                        [--query-latency S]
+                                        [--import-latency S] [--size-mb MB]
+                                        [--n-files N]
+"""
+
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+from unittest import mock
+
+MB = 1000000
+
+
+def _setup(network):
+    from pyme_omero import core, metrics
+    from pyme_omero.connection import SessionPool
+    from pyme_omero.testing.fake_omero import FakeServer
+
+    server = FakeServer(**network)
+    pool = SessionPool(server.login)
+    core.set_session_pool(pool)
+    metrics.get_metrics().reset()
+    return server, pool
+
+def _write_random(path, size):
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return path
+
+def _result(name, server, pool, elapsed, **extra):
+    from pyme_omero import metrics
+    pool.close()
+    result = {
+        'benchmark': name,
+        'seconds': elapsed,
+        'logins': server.n_logins,
+        'bytes_uploaded': server.bytes_uploaded,
+        'bytes_downloaded': server.bytes_downloaded,
+        'calls': dict(server.calls),
+        'operations': metrics.get_metrics().summary(),
+    }
+    result.update(extra)
+    return result
+
+
+def bench_single_upload(network, size_mb=16, **kwargs):
+    from pyme_omero import core, import_utils
+
+    server, pool = _setup(network)
+    size = int(size_mb * MB)
+    with tempfile.TemporaryDirectory() as temp_dir, \
+            mock.patch.object(import_utils, 'wait_for_import',
+                              server.wait_for_import):
+        image = _write_random(os.path.join(temp_dir, 'bench.tif'), size)
+        attachment = _write_random(os.path.join(temp_dir, 'bench.hdf'),
+                                   size // 4)
+        t0 = time.perf_counter()
+        core.upload_image_from_file(image, 'bench-dataset', 'bench-project',
+                                    [attachment])
+        elapsed = time.perf_counter() - t0
+    return _result('single_upload', server, pool, elapsed, size_mb=size_mb,
+                   MB_per_s=size * 1.25 / MB / elapsed)
+
+def bench_batch_upload(network, n_files=20, size_mb=16, **kwargs):
+    from pyme_omero import core, import_utils
+
+    server, pool = _setup(network)
+    size = max(1, int(size_mb * MB / n_files))
+    with tempfile.TemporaryDirectory() as temp_dir, \
+            mock.patch.object(import_utils, 'wait_for_import',
+                              server.wait_for_import):
+        files, attachments = [], []
+        for i in range(n_files):
+            files.append(_write_random(os.path.join(temp_dir, '%d.tif' % i),
+                                       size))
+            attachments.append([_write_random(
+                os.path.join(temp_dir, '%d.hdf' % i), size // 4)])
+        t0 = time.perf_counter()
+        core.upload_images_from_files(files, 'bench-dataset', 'bench-project',
+                                      attachments)
+        elapsed = time.perf_counter() - t0
+    return _result('batch_upload', server, pool, elapsed, n_files=n_files,
+                   file_size_bytes=size, files_per_s=n_files / elapsed)
+
+def bench_large_download(network, size_mb=16, n_streams=1, **kwargs):
+    from pyme_omero import transfer
+
+    server, pool = _setup(network)
+    size = int(size_mb * MB)
+    file_id = server.add_original_file(os.urandom(size))
+    with tempfile.TemporaryDirectory() as temp_dir, \
+            pool.connection() as conn:
+        t0 = time.perf_counter()
+        transfer.download_original_file(conn, file_id, size,
+                                        os.path.join(temp_dir, 'bench.hdf'),
+                                        n_streams=n_streams)
+        elapsed = time.perf_counter() - t0
+    return _result('large_download', server, pool, elapsed, size_mb=size_mb,
+                   n_streams=n_streams, MB_per_s=size / MB / elapsed)
+
+def bench_container_lookup(network, n_files=20, **kwargs):
+    from pyme_omero import core
+
+    server, pool = _setup(network)
+    names = ['bench-dataset-%d' % i for i in range(n_files)]
+    timings = {}
+    for state in ('cold', 'cached'):
+        t0 = time.perf_counter()
+        for name in names:
+            core.get_or_create_dataset_id(name, 'bench-project')
+        timings[state] = (time.perf_counter() - t0) / len(names)
+    return _result('container_lookup', server, pool, sum(timings.values()) *
+                   len(names), n_lookups=2 * len(names),
+                   cold_s_per_lookup=timings['cold'],
+                   cached_s_per_lookup=timings['cached'])
+
+def bench_attachment_fetch(network, n_files=20, size_mb=16, **kwargs):
+    import omero.model
+    from omero import rtypes
+    from pyme_omero import core, metrics
+
+    server, pool = _setup(network)
+    n_attachments = max(1, min(n_files, 8))
+    size = max(1, int(size_mb * MB / n_attachments))
+    image_id = server.create_image('bench.tif').pixels[0].image.getId()\
+        .getValue()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with pool.connection() as conn:
+            image = conn.getObject('Image', image_id)
+            for i in range(n_files):
+                tag = omero.model.TagAnnotationI()
+                tag.setTextValue(rtypes.rstring('tag%d' % i))
+                image.linkAnnotation(server.save(tag))
+            for i in range(n_attachments):
+                path = _write_random(os.path.join(temp_dir, '%d.hdf' % i),
+                                     size)
+                image.linkAnnotation(conn.createFileAnnfromLocalFile(path))
+        # only time the fetch
+        server.bytes_uploaded = 0
+        server.calls.clear()
+        metrics.get_metrics().reset()
+
+        out_dir = os.path.join(temp_dir, 'out')
+        os.mkdir(out_dir)
+        t0 = time.perf_counter()
+        core.localization_files_from_image_url(
+            'https://bench/webclient/?show=image-%d' % image_id, out_dir,
+            use_cache=False)
+        elapsed = time.perf_counter() - t0
+    return _result('attachment_fetch', server, pool, elapsed,
+                   n_attachments=n_attachments, file_size_bytes=size,
+                   MB_per_s=n_attachments * size / MB / elapsed)
+
+def bench_pixel_upload(network, size_mb=16, backend='import', max_workers=4,
+                       **kwargs):
+    import numpy as np
+    from pyme_omero import core, import_utils, ome_tiff
+
+    server, pool = _setup(network)
+    size_z = max(1, int(size_mb * MB / (2 * 1024 * 1024)))
+    # (x, y, z, t, c), as ImageStack.data_xyztc
+    data = np.random.randint(0, 2**16, (1024, 1024, size_z, 1, 1), 
+                             dtype='u2')
+    with tempfile.TemporaryDirectory() as temp_dir, \
+            mock.patch.object(import_utils, 'wait_for_import',
+                              server.wait_for_import):
+        t0 = time.perf_counter()
+        if backend == 'import':
+            # include serializing the file, which the pixels path skips
+            path = os.path.join(temp_dir, 'bench.ome.tif')
+            with open(path, 'wb') as f:
+                ome_tiff.write_ome_tiff(data, f)
+            core.upload_image_from_file(path, 'bench-dataset', 
+                                        'bench-project')
+        else:
+            core.upload_image_from_pixels('bench.tif', data, 'bench-dataset',
+                                          'bench-project', 
+                                          max_workers=max_workers)
+        elapsed = time.perf_counter() - t0
+    return _result('pixel_upload', server, pool, elapsed, backend=backend,
+                   max_workers=max_workers if backend == 'pixels' else None,
+                   size_mb=data.nbytes / MB, MB_per_s=data.nbytes / MB / 
+                   elapsed)
+
+
+def _large_download_streams(network, **kwargs):
+    return [bench_large_download(network, n_streams=n, **kwargs)
+            for n in (1, 4)]
+
+def _pixel_upload_backends(network, **kwargs):
+    return [bench_pixel_upload(network, backend='import', **kwargs)] + [
+        bench_pixel_upload(network, backend='pixels', max_workers=n, **kwargs)
+        for n in (1, 4)]
+
+BENCHMARKS = {
+    'single_upload': lambda network, **kw: [bench_single_upload(network, **kw)],
+    'batch_upload': lambda network, **kw: [bench_batch_upload(network, **kw)],
+    'large_download': _large_download_streams,
+    'container_lookup': lambda network, **kw: [
+        bench_container_lookup(network, **kw)],
+    'attachment_fetch': lambda network, **kw: [
+        bench_attachment_fetch(network, **kw)],
+    'pixel_upload': _pixel_upload_backends,
+}
+
+
+def run(names=None, network=None, **kwargs):
+    """ run benchmarks
+
+    Parameters
+    ----------
+    names : list, optional
+        keys of `BENCHMARKS` to run, by default all of them
+    network : dict, optional
+        `FakeServer` latency / bandwidth keyword arguments
+    **kwargs
+        benchmark sizes, size_mb and n_files
+
+    Returns
+    -------
+    list
+        one dict per result
+    """
+    network = network or {}
+    environment = {'python': platform.python_version(),
+                   'platform': platform.platform(), 'time': time.time(),
+                   'network': network}
+    results = []
+    for name in names or sorted(BENCHMARKS):
+        for result in BENCHMARKS[name](network, **kwargs):
+            result['environment'] = environment
+            results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS),
+                        help='benchmarks to run, by default all')
+    parser.add_argument('--output', help='also append the results, one JSON '
+                        'object per line, to this file')
+    parser.add_argument('--rpc-latency', type=float, default=0.001,
+                        help='[s] per RawFileStore call (default 0.001)')
+    parser.add_argument('--bandwidth', type=float, default=100.,
+                        help='[MB/s] per stream, 0 for unlimited (default 100)')
+    parser.add_argument('--login-latency', type=float, default=0.2,
+                        help='[s] per login (default 0.2)')
+    parser.add_argument('--query-latency', type=float, default=0.005,
+                        help='[s] per query (default 0.005)')
+    parser.add_argument('--import-latency', type=float, default=0.5,
+                        help='[s] per server-side import (default 0.5)')
+    parser.add_argument('--size-mb', type=float, default=16.,
+                        help='data per benchmark [MB] (default 16)')
+    parser.add_argument('--n-files', type=int, default=20,
+                        help='files / lookups per benchmark (default 20)')
+    args = parser.parse_args()
+
+    network = {'rpc_latency': args.rpc_latency,
+               'bandwidth': args.bandwidth * MB or None,
+               'login_latency': args.login_latency,
+               'query_latency': args.query_latency,
+               'import_latency': args.import_latency}
+    results = run(args.only, network, size_mb=args.size_mb,
+                  n_files=args.n_files)
+    lines = [json.dumps(result) for result in results]
+    print('\n'.join(lines))
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
@@ -0,0 +1,234 @@
+"""
+File attachment lookups: deduplication by content hash, and server-side
+filtered listing of the files attached to an image.
+
+Before uploading a file as a FileAnnotation, its SHA-1 is looked up, first in
+an in-process index of what this process has already attached and then on the
+server, among the current user's OriginalFiles. If a FileAnnotation with the
+same contents and namespace exists, it is linked to the image rather than
+uploading the file again.
+"""
+
+import hashlib
+import os
+import threading
+import logging
+
+from pyme_omero import metrics
+from pyme_omero.containers import _query_id
+
+logger = logging.getLogger(__name__)
+
+HASH_BLOCK_SIZE = 1048576
+
+FILE_ANNOTATION_BY_HASH = ('select a.id from FileAnnotation a join a.file f '
+                           'where f.hash = :hash and f.size = :size '
+                           'and a.ns = :ns and a.details.owner.id = :uid '
+                           'order by a.id')
+IMAGE_ANNOTATION_LINK = ('select l.id from ImageAnnotationLink l '
+                         'where l.parent.id = :iid and l.child.id = :aid')
+# filled in with extra 'and ...' conditions by `file_annotations_on_image`
+FILE_ANNOTATIONS_ON_IMAGE = ('select a.id, f.id, f.name, f.size, f.hash, '
+                             'f.mtime '
+                             'from ImageAnnotationLink l, FileAnnotation a '
+                             'join a.file f '
+                             'where a.id = l.child.id and l.parent.id = :iid'
+                             '%s order by l.id')
+
+
+def file_sha1(path, block_size=HASH_BLOCK_SIZE):
+    """ hex SHA-1 digest of a local file, as OMERO records it for
+    OriginalFiles uploaded with the SHA1-160 checksum algorithm
+    """
+    sha1 = hashlib.sha1()
+    with metrics.span('hash', file=os.path.basename(path)) as span, \
+            open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+            span.add_bytes(len(block))
+    return sha1.hexdigest()
+
+
+class AttachmentIndex(object):
+    def __init__(self):
+        """ in-process record of file hashes and the FileAnnotations holding
+        them, with counters of what deduplication has saved
+        """
+        self._hashes = {}
+        self._annotations = {}
+        self._lock = threading.Lock()
+        self.n_reused = 0
+        self.bytes_saved = 0
+
+    def sha1(self, path):
+        """ SHA-1 of a local file, only re-hashed if it has been modified """
+        st = os.stat(path)
+        key = (os.path.abspath(path), st.st_size, st.st_mtime)
+        with self._lock:
+            digest = self._hashes.get(key)
+        if digest is None:
+            digest = file_sha1(path)
+            with self._lock:
+                self._hashes[key] = digest
+        return digest
+
+    def get(self, digest, namespace):
+        with self._lock:
+            return self._annotations.get((digest, namespace))
+
+    def put(self, digest, namespace, annotation_id):
+        with self._lock:
+            self._annotations[(digest, namespace)] = annotation_id
+
+    def invalidate(self, digest=None, namespace=None):
+        """ forget one annotation, or all of them """
+        with self._lock:
+            if digest is None:
+                self._annotations.clear()
+            else:
+                self._annotations.pop((digest, namespace), None)
+
+    def record_reuse(self, n_bytes):
+        with self._lock:
+            self.n_reused += 1
+            self.bytes_saved += n_bytes
+
+
+def find_file_annotation(connection, digest, size, namespace=''):
+    """ look up one of the current user's FileAnnotations by the SHA-1 and size
+    of its file
+
+    Parameters
+    ----------
+    connection : omero.gateway.BlitzGateway
+        an open connection to an OMERO server
+    digest : str
+        hex SHA-1 of the file contents
+    size : int
+        file size in bytes
+    namespace : str, optional
+        annotation namespace, by default ''
+
+    Returns
+    -------
+    int
+        ID of the (lowest ID) matching FileAnnotation, or None
+    """
+    return _query_id(connection, FILE_ANNOTATION_BY_HASH, hash=digest,
+                     size=size, ns=namespace, uid=connection.getUserId())
+
+def link_annotation(connection, image_id, annotation_id):
+    """ link an existing annotation to an image, unless it already is
+
+    Returns
+    -------
+    bool
+        True if a new link was made
+    """
+    import omero.model
+
+    if _query_id(connection, IMAGE_ANNOTATION_LINK, iid=image_id,
+                 aid=annotation_id) is not None:
+        return False
+    link = omero.model.ImageAnnotationLinkI()
+    link.parent = omero.model.ImageI(image_id, False)
+    link.child = omero.model.FileAnnotationI(annotation_id, False)
+    connection.getUpdateService().saveAndReturnObject(link,
+                                                      connection.SERVICE_OPTS)
+    return True
+
+def attach_existing(connection, index, image_id, path, namespace=''):
+    """ link an already-uploaded copy of a file to an image, if there is one
+
+    Parameters
+    ----------
+    connection : omero.gateway.BlitzGateway
+        an open connection to an OMERO server
+    index : AttachmentIndex
+        in-process index to check first, and to update
+    image_id : int
+        image to attach the file to
+    path : str
+        local file
+    namespace : str, optional
+        annotation namespace, by default ''
+
+    Returns
+    -------
+    digest : str
+        hex SHA-1 of the file, to `index.put` once it has been uploaded
+    annotation_id : int
+        ID of the FileAnnotation linked, or None if the file needs uploading
+    """
+    from omero import ServerError
+
+    digest = index.sha1(path)
+    size = os.path.getsize(path)
+
+    annotation_id = index.get(digest, namespace)
+    if annotation_id is not None:
+        try:
+            link_annotation(connection, image_id, annotation_id)
+        except ServerError as e:  # e.g. deleted since
+            logger.debug('cached FileAnnotation %d unusable: %s' % (
+                annotation_id, e))
+            index.invalidate(digest, namespace)
+            annotation_id = None
+
+    if annotation_id is None:
+        annotation_id = find_file_annotation(connection, digest, size,
+                                             namespace)
+        if annotation_id is None:
+            return digest, None
+        link_annotation(connection, image_id, annotation_id)
+        index.put(digest, namespace, annotation_id)
+
+    index.record_reuse(size)
+    logger.info('linked existing FileAnnotation %d for %s, saving %.1f MB '
+                '(%.1f MB saved so far)' % (annotation_id,
+                                            os.path.basename(path), size / 1e6,
+                                            index.bytes_saved / 1e6))
+    return digest, annotation_id
+
+def file_annotations_on_image(connection, image_id, extensions=None,
+                              namespace=None):
+    """ list the FileAnnotations linked to an image, filtered server-side, in
+    a single query however many annotations of other kinds the image has
+
+    Parameters
+    ----------
+    connection : omero.gateway.BlitzGateway
+        an open connection to an OMERO server
+    image_id : int
+        image ID
+    extensions : list, optional
+        only include files whose names end with one of these, e.g. ['.h5r']
+    namespace : str, optional
+        only include annotations in this namespace
+
+    Returns
+    -------
+    list
+        one dict per annotation, in the order they were linked, with keys
+        annotation_id, file_id, name, size, hash and mtime
+    """
+    from omero.sys import ParametersI
+    from omero.rtypes import unwrap
+
+    params = ParametersI()
+    params.addLong('iid', image_id)
+    conditions = ''
+    if namespace is not None:
+        conditions += ' and a.ns = :ns'
+        params.addString('ns', namespace)
+    if extensions:
+        names = []
+        for i, ext in enumerate(extensions):
+            params.addString('ext%d' % i, '%' + ext)
+            names.append('f.name like :ext%d' % i)
+        conditions += ' and (%s)' % ' or '.join(names)
+
+    rows = connection.getQueryService().projection(
+        FILE_ANNOTATIONS_ON_IMAGE % conditions, params, connection.SERVICE_OPTS)
+    keys = ('annotation_id', 'file_id', 'name', 'size', 'hash', 'mtime')
+    return [dict(zip(keys, unwrap(row))) for row in rows]
@@ -0,0 +1,242 @@
+"""
+Persistent, on-disk cache of files downloaded from OMERO.
+
+Entries are keyed by server, OMERO object type and ID, and validated against a
+cheap server-side fingerprint (e.g. OriginalFile hash/size/mtime) so a changed
+object is re-downloaded. The least recently used entries are evicted once the
+cache exceeds its size budget, except for the few most recently used, whose
+files callers (e.g. a viewer) may still have open. Several processes can share a cache directory:
+the index is re-read and rewritten under a file lock on every change.
+"""
+
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+import logging
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+# most recently used entries never evicted
+DEFAULT_KEEP_RECENT = 4
+
+
+def default_cache_dir():
+    from PYME.config import user_config_dir
+    return os.path.join(user_config_dir, 'cache', 'pyme-omero')
+
+
+class DownloadCache(object):
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES,
+                 keep_recent=DEFAULT_KEEP_RECENT):
+        """ LRU cache of downloaded files
+
+        Parameters
+        ----------
+        directory : str, optional
+            where to keep cached files, by default `default_cache_dir()`
+        max_bytes : int, optional
+            size budget, by default 10 GB
+        keep_recent : int, optional
+            number of most recently used entries, across all processes sharing
+            the directory, which are never evicted, even if the cache is over
+            budget, by default `DEFAULT_KEEP_RECENT`
+
+        Notes
+        -----
+        A path returned by `get`, `put` or `get_or_fetch` stays valid until
+        `keep_recent` other entries have been used since. Callers holding a
+        file open for longer, across more lookups than that, should copy it.
+        """
+        self.directory = default_cache_dir() if directory is None else directory
+        self.max_bytes = max_bytes
+        self.keep_recent = keep_recent
+        self._index_path = os.path.join(self.directory, 'index.json')
+        self._lock_path = os.path.join(self.directory, 'index.lock')
+        self._lock = threading.RLock()
+        os.makedirs(self.directory, exist_ok=True)
+        self._index = self._load_index()
+
+    @staticmethod
+    def key(kind, object_id, server=''):
+        if not server:
+            return '%s-%d' % (kind, object_id)
+        return '%s-%s-%d' % (re.sub(r'[^\w.-]', '_', server), kind, object_id)
+
+    @property
+    def size(self):
+        with self._locked_index() as index:
+            return sum(entry['size'] for entry in index.values())
+
+    @contextmanager
+    def _locked_index(self):
+        """ hold the index exclusively, across threads and (where fcntl is
+        available) processes sharing the directory, re-reading it from disk
+        so changes made by other processes are kept when it is saved
+        """
+        with self._lock, open(self._lock_path, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._index = self._load_index()
+                yield self._index
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get(self, kind, object_id, fingerprint, server=''):
+        """ look up a cached file
+
+        Parameters
+        ----------
+        kind : str
+            OMERO object type, e.g. 'OriginalFile' or 'Image'
+        object_id : int
+            OMERO object ID
+        fingerprint : str
+            must match the fingerprint the file was cached with
+        server : str, optional
+            server the object is on, e.g. its host, as IDs are only unique
+            within a server
+
+        Returns
+        -------
+        str
+            path to the cached file, or None on a miss
+        """
+        key = self.key(kind, object_id, server)
+        with self._locked_index() as index:
+            entry = index.get(key)
+            if entry is None:
+                return None
+            path = os.path.join(self.directory, key, entry['name'])
+            if entry['fingerprint'] != fingerprint or not os.path.exists(path):
+                self._remove(key)
+                self._save_index()
+                return None
+            entry['last_access'] = time.time()
+            self._save_index()
+            return path
+
+    def put(self, kind, object_id, fingerprint, name, fetch, server=''):
+        """ add a file to the cache
+
+        Parameters
+        ----------
+        kind : str
+            OMERO object type, e.g. 'OriginalFile' or 'Image'
+        object_id : int
+            OMERO object ID
+        fingerprint : str
+            server-side fingerprint of the object
+        name : str
+            file name to store the object under
+        fetch : callable
+            called with a path, writes the object there (e.g. downloads it)
+        server : str, optional
+            server the object is on, see `get`
+
+        Returns
+        -------
+        str
+            path to the cached file
+        """
+        key = self.key(kind, object_id, server)
+        entry_dir = os.path.join(self.directory, key)
+        partial_dir = entry_dir + '.partial-%d-%d' % (os.getpid(),
+                                                      threading.get_ident())
+        os.makedirs(partial_dir, exist_ok=True)
+        try:
+            fetch(os.path.join(partial_dir, name))
+            size = os.path.getsize(os.path.join(partial_dir, name))
+            with self._locked_index() as index:
+                self._remove(key)
+                os.replace(partial_dir, entry_dir)
+                index[key] = dict(name=name, fingerprint=fingerprint,
+                                  size=size, last_access=time.time())
+                self._evict(keep=key)
+                self._save_index()
+        finally:
+            shutil.rmtree(partial_dir, ignore_errors=True)
+        return os.path.join(entry_dir, name)
+
+    def get_or_fetch(self, kind, object_id, fingerprint, name, fetch,
+                     server=''):
+        """ `get`, falling back to `put` on a miss
+
+        Returns
+        -------
+        str
+            path to the cached file
+        """
+        path = self.get(kind, object_id, fingerprint, server)
+        if path is not None:
+            logger.debug('cache hit for %s %d' % (kind, object_id))
+            return path
+        return self.put(kind, object_id, fingerprint, name, fetch, server)
+
+    def invalidate(self, kind=None, object_id=None, server=''):
+        """ remove one entry, or all entries """
+        with self._locked_index() as index:
+            keys = (list(index.keys()) if kind is None
+                    else [self.key(kind, object_id, server)])
+            for key in keys:
+                self._remove(key)
+            self._save_index()
+
+    def _remove(self, key):
+        self._index.pop(key, None)
+        shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+
+    def _evict(self, keep=None):
+        total = sum(entry['size'] for entry in self._index.values())
+        lru = sorted(self._index.items(), key=lambda kv: kv[1]['last_access'])
+        recent = set(key for key, _ in lru[len(lru) - self.keep_recent:])
+        for key, entry in lru:
+            if total <= self.max_bytes:
+                break
+            if key == keep or key in recent:
+                continue
+            logger.debug('evicting %s from download cache' % key)
+            total -= entry['size']
+            self._remove(key)
+
+    def _load_index(self):
+        try:
+            with open(self._index_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_index(self):
+        temp_path = self._index_path + '.tmp-%d' % os.getpid()
+        with open(temp_path, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(temp_path, self._index_path)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_download_cache():
+    """ get the process-wide download cache, creating it on first use
+
+    Returns
+    -------
+    DownloadCache
+        shared download cache
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = DownloadCache()
+        return _cache
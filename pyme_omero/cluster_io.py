@@ -0,0 +1,115 @@
+"""
+Streaming reads of files on a PYME cluster.
+
+`PYME.IO.clusterIO.get_file` returns a whole file as one bytes object, so a
+large file costs its full size in memory (twice over while it is written out).
+These helpers stream it over HTTP from the data server holding it instead,
+one bounded chunk at a time, fetching the next chunk while the current one is
+written, e.g. to a local file or to a `pyme_omero.transfer.RawFileStoreWriter`.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+import logging
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1048576
+
+
+def locate(name, clusterfilter, retries=3):
+    """ find the url of a data server holding a cluster file
+
+    Parameters
+    ----------
+    name : str
+        file name on the cluster
+    clusterfilter : str
+        cluster name filter, see PYME.IO.unifiedIO.split_cluster_url
+    retries : int, optional
+        number of times to look for the file, by default 3
+
+    Returns
+    -------
+    str
+        http url of the file
+    """
+    from PYME.IO import clusterIO
+
+    for attempt in range(retries):
+        locations = clusterIO.locate_file(name, clusterfilter,
+                                          return_first_hit=True)
+        if len(locations) > 0:
+            return locations[0][0]
+        time.sleep(0.1 * (attempt + 1))
+    raise IOError('%s could not be found on the cluster' % name)
+
+def iter_cluster_file(name, clusterfilter, chunk_size=CHUNK_SIZE, timeout=5.):
+    """ yield the contents of a cluster file in chunks of at most
+    `chunk_size` bytes, holding no more than one chunk in memory
+    """
+    import requests
+
+    url = locate(name, clusterfilter)
+    with requests.get(url, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        for chunk in r.iter_content(chunk_size):
+            if chunk:
+                yield chunk
+
+def copy_cluster_file(name, clusterfilter, f, chunk_size=CHUNK_SIZE,
+                      timeout=5.):
+    """ stream a cluster file into an open file-like object
+
+    The next chunk is fetched on a background thread while the current one is
+    written, so fetching overlaps with e.g. uploading to OMERO.
+
+    Parameters
+    ----------
+    name : str
+        file name on the cluster
+    clusterfilter : str
+        cluster name filter
+    f : file
+        open, writable binary file
+    chunk_size : int, optional
+        bytes per chunk, by default 1 MB
+    timeout : float, optional
+        HTTP timeout in seconds, by default 5
+
+    Returns
+    -------
+    int
+        number of bytes copied
+    """
+    chunks = iter_cluster_file(name, clusterfilter, chunk_size, timeout)
+    n_bytes = 0
+    with ThreadPoolExecutor(max_workers=1) as fetch_ahead:
+        pending = fetch_ahead.submit(next, chunks, None)
+        try:
+            while True:
+                chunk = pending.result()
+                if chunk is None:
+                    break
+                pending = fetch_ahead.submit(next, chunks, None)
+                f.write(chunk)
+                n_bytes += len(chunk)
+        finally:
+            # wait for any in-flight fetch before closing the HTTP stream
+            wait([pending])
+            chunks.close()
+    logger.debug('streamed %d bytes of %s from the cluster' % (n_bytes, name))
+    return n_bytes
+
+def fetch_cluster_file(name, clusterfilter, path, chunk_size=CHUNK_SIZE,
+                       timeout=5.):
+    """ stream a cluster file to a local path
+
+    Returns
+    -------
+    str
+        `path`
+    """
+    with open(path, 'wb') as f:
+        copy_cluster_file(name, clusterfilter, f, chunk_size, timeout)
+    return path
@@ -0,0 +1,304 @@
+"""
+Pooled, reusable OMERO sessions.
+
+Logging in to an OMERO server is slow (hundreds of ms), so rather than opening
+a fresh session for every call in `pyme_omero.core`, connections are checked
+out of a `SessionPool` and returned to it once the caller is done. Idle
+sessions are kept alive in the background until they exceed `max_idle`, and
+are health-checked before being handed out again.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from pyme_omero import metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def login(user, password, address, port=4064):
+    """open a new BlitzGateway connection to an OMERO server
+
+    Parameters
+    ----------
+    user : str
+        OMERO user name
+    password : str
+        OMERO password
+    address : str
+        OMERO server address
+    port : int, optional
+        OMERO server port, by default 4064
+
+    Returns
+    -------
+    omero.gateway.BlitzGateway
+        an open, logged-in connection
+    """
+    from omero.gateway import BlitzGateway
+
+    conn = BlitzGateway(user, password, host=address, port=int(port))
+    with metrics.span('login', address=address):
+        if not conn.connect():
+            raise IOError('Could not log in to OMERO server at %s:%s' % (
+                address, port))
+    logger.debug('Logged in to OMERO server at %s:%s' % (address, port))
+    return conn
+
+
+class SessionPool(object):
+    def __init__(self, factory, max_size=4, max_idle=300., keep_alive=60.,
+                 check_after=10.):
+        """ thread-safe pool of OMERO connections
+
+        Parameters
+        ----------
+        factory : callable
+            called with no arguments to open a new connection, e.g. a partial of
+            `login`. Connections must provide `keepAlive()` and `close()`, as
+            `omero.gateway.BlitzGateway` does.
+        max_size : int, optional
+            maximum number of connections open at once, by default 4
+        max_idle : float, optional
+            [s] idle connections older than this are closed rather than reused,
+            by default 300.
+        keep_alive : float, optional
+            [s] interval at which idle connections are pinged to keep their
+            sessions from timing out server-side, by default 60.
+        check_after : float, optional
+            [s] connections idle for longer than this are health-checked before
+            being handed out, by default 10.
+        """
+        self._factory = factory
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.keep_alive = keep_alive
+        self.check_after = check_after
+
+        self._cond = threading.Condition()
+        self._idle = []  # [(connection, time last returned), ...]
+        self._n_open = 0
+        self._closed = False
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._keep_alive_thread = None
+
+        self.n_logins = 0
+
+    @property
+    def n_open(self):
+        return self._n_open
+
+    @property
+    def n_idle(self):
+        return len(self._idle)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """ check out a connection for the duration of a `with` block. Nested
+        calls on the same thread reuse the connection already checked out.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            [s] how long to wait for a connection if the pool is exhausted, by
+            default None (wait indefinitely)
+
+        Yields
+        -------
+        omero.gateway.BlitzGateway
+            an open connection
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+
+        conn = self.checkout(timeout)
+        self._local.conn, self._local.depth = conn, 1
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self.checkin(conn)
+
+    @contextmanager
+    def bind(self, conn):
+        """ make a connection already obtained with `checkout` the one used by
+        nested `connection` calls on this thread, e.g. when a connection is
+        handed from one worker thread to another. Does not check it back in.
+
+        Parameters
+        ----------
+        conn : omero.gateway.BlitzGateway
+            checked-out connection
+        """
+        previous = getattr(self._local, 'conn', None), getattr(self._local,
+                                                               'depth', 0)
+        self._local.conn, self._local.depth = conn, 1
+        try:
+            yield conn
+        finally:
+            self._local.conn, self._local.depth = previous
+
+    def checkout(self, timeout=None):
+        """ get a healthy connection from the pool, opening a new one if
+        required and allowed by `max_size`
+
+        Parameters
+        ----------
+        timeout : float, optional
+            [s] how long to wait for a connection if the pool is exhausted, by
+            default None (wait indefinitely)
+
+        Returns
+        -------
+        omero.gateway.BlitzGateway
+            an open connection, which must be returned with `checkin`
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise RuntimeError('SessionPool has been closed')
+
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                elif self._n_open < self.max_size:
+                    conn, last_used = None, None
+                    self._n_open += 1
+                else:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        raise RuntimeError('Timed out waiting for an OMERO session')
+                    self._cond.wait(remaining)
+                    continue
+
+            if conn is None:
+                return self._open()
+
+            idle = time.time() - last_used
+            if idle >= self.max_idle:
+                logger.debug('discarding OMERO session idle for %.0f s' % idle)
+                self._discard(conn)
+            elif idle > self.check_after and not self._is_healthy(conn):
+                logger.debug('discarding unhealthy OMERO session')
+                self._discard(conn)
+            else:
+                return conn
+
+    def open_dedicated(self):
+        """ open a connection outside the pool, with the pool's factory, for
+        a caller which holds on to it for an open-ended time (e.g. an image
+        open in a viewer) and would otherwise starve everyone else of pooled
+        connections. It does not count towards `max_size`.
+
+        Returns
+        -------
+        omero.gateway.BlitzGateway
+            an open connection, which the caller must `close()`
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('SessionPool has been closed')
+        conn = self._factory()
+        with self._cond:
+            self.n_logins += 1
+        return conn
+
+    def checkin(self, conn):
+        """ return a connection to the pool
+
+        Parameters
+        ----------
+        conn : omero.gateway.BlitzGateway
+            connection previously obtained with `checkout`
+        """
+        with self._cond:
+            if not self._closed:
+                self._idle.append((conn, time.time()))
+                self._cond.notify()
+                self._start_keep_alive()
+                return
+        self._discard(conn)
+
+    def close(self):
+        """ close all idle connections and refuse further checkouts.
+        Connections currently checked out are closed when returned.
+        """
+        with self._cond:
+            self._closed = True
+            self._stop.set()
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def _open(self):
+        try:
+            conn = self._factory()
+        except:
+            with self._cond:
+                self._n_open -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.n_logins += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._cond:
+            self._n_open -= 1
+            self._cond.notify()
+        try:
+            conn.close()
+        except Exception as e:
+            logger.debug('error closing OMERO session: %s' % e)
+
+    def _is_healthy(self, conn):
+        try:
+            return bool(conn.keepAlive())
+        except Exception:
+            return False
+
+    def _start_keep_alive(self):
+        # called with self._cond held
+        if self._keep_alive_thread is None or not self._keep_alive_thread.is_alive():
+            self._keep_alive_thread = threading.Thread(target=self._keep_alive_loop,
+                                                       name='omero-keep-alive',
+                                                       daemon=True)
+            self._keep_alive_thread.start()
+
+    def _keep_alive_loop(self):
+        while not self._stop.wait(self.keep_alive):
+            with self._cond:
+                if self._closed or not self._idle:
+                    # exit once nothing is left to keep alive, checkin restarts
+                    self._keep_alive_thread = None
+                    return
+                # take the idle connections out while we ping them
+                idle, self._idle = self._idle, []
+
+            now = time.time()
+            keep = []
+            for conn, last_used in idle:
+                if now - last_used >= self.max_idle or not self._is_healthy(conn):
+                    self._discard(conn)
+                else:
+                    keep.append((conn, last_used))
+
+            with self._cond:
+                if self._closed:
+                    discard = keep
+                else:
+                    # oldest first so `checkout` keeps popping the freshest
+                    self._idle = keep + self._idle
+                    discard = []
+                    self._cond.notify_all()
+            for conn, _ in discard:
+                self._discard(conn)
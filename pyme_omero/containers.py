@@ -0,0 +1,220 @@
+"""
+Project / Dataset resolution by name.
+
+Lookups are name-filtered HQL queries rather than full `loadContainerHierarchy`
+loads, and their results are cached in-process with a time-to-live. Creation is
+serialized per name so concurrent uploads can't create twin containers.
+"""
+
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+PROJECT_BY_NAME = ('select p.id from Project p '
+                   'where p.name = :name and p.details.owner.id = :uid '
+                   'order by p.id')
+DATASET_BY_NAME = ('select d.id from Dataset d '
+                   'where d.name = :name and d.details.owner.id = :uid '
+                   'order by d.id')
+DATASET_IN_PROJECT_BY_NAME = ('select l.child.id from ProjectDatasetLink l '
+                              'where l.parent.id = :pid '
+                              'and l.child.name = :name '
+                              'order by l.child.id')
+
+
+class ContainerCache(object):
+    def __init__(self, ttl=300.):
+        """ in-process name -> ID cache for OMERO containers
+
+        Parameters
+        ----------
+        ttl : float, optional
+            [s] how long a cached ID is trusted before being looked up again,
+            by default 300.
+        """
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def get(self, key):
+        with self._lock:
+            try:
+                container_id, t = self._entries[key]
+            except KeyError:
+                return None
+            if time.time() - t > self.ttl:
+                del self._entries[key]
+                return None
+            return container_id
+
+    def put(self, key, container_id):
+        with self._lock:
+            self._entries[key] = (container_id, time.time())
+
+    def invalidate(self, key=None):
+        """ drop one cached entry, or all of them
+
+        Parameters
+        ----------
+        key : tuple, optional
+            (kind, name, parent ID) key to drop, by default None (drop all)
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def lock(self, key):
+        """ lock serializing lookup-then-create for a single key """
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+
+def _query_id(connection, hql, **kwargs):
+    from omero.sys import ParametersI
+
+    params = ParametersI()
+    for k, v in kwargs.items():
+        if isinstance(v, int):
+            params.addLong(k, v)
+        else:
+            params.addString(k, v)
+    params.page(0, 1)
+    rows = connection.getQueryService().projection(hql, params,
+                                                   connection.SERVICE_OPTS)
+    if rows:
+        return rows[0][0].getValue()
+    return None
+
+def find_project_id(connection, project_name):
+    """ look up a project owned by the current user by name
+
+    Parameters
+    ----------
+    connection : omero.gateway.BlitzGateway
+        an open connection to an OMERO server
+    project_name : str
+        project name
+
+    Returns
+    -------
+    int
+        ID of the (lowest ID) matching project, or None if there is none
+    """
+    return _query_id(connection, PROJECT_BY_NAME, name=project_name,
+                     uid=connection.getUserId())
+
+def find_dataset_id(connection, dataset_name, project_id=None):
+    """ look up a dataset by name, either within a project or among all of the
+    current user's datasets
+
+    Parameters
+    ----------
+    connection : omero.gateway.BlitzGateway
+        an open connection to an OMERO server
+    dataset_name : str
+        dataset name
+    project_id : int, optional
+        only consider datasets linked to this project, by default None
+
+    Returns
+    -------
+    int
+        ID of the (lowest ID) matching dataset, or None if there is none
+    """
+    if project_id is None:
+        return _query_id(connection, DATASET_BY_NAME, name=dataset_name,
+                         uid=connection.getUserId())
+    return _query_id(connection, DATASET_IN_PROJECT_BY_NAME, name=dataset_name,
+                     pid=project_id)
+
+def _create_container(connection, kind, name):
+    import omero.model
+    from omero import rtypes
+
+    container = getattr(omero.model, kind + 'I')()
+    container.setName(rtypes.rstring(name))
+    container = connection.getUpdateService().saveAndReturnObject(container)
+    logger.debug('Created %s %s: %d' % (kind, name,
+                                        container.getId().getValue()))
+    return container.getId().getValue()
+
+def _link_dataset(connection, project_id, dataset_id):
+    import omero.model
+
+    link = omero.model.ProjectDatasetLinkI()
+    link.parent = omero.model.ProjectI(project_id, False)
+    link.child = omero.model.DatasetI(dataset_id, False)
+    connection.getUpdateService().saveArray([link], connection.SERVICE_OPTS)
+
+def _get_or_create(cache, key, find, create):
+    container_id = cache.get(key)
+    if container_id is not None:
+        return container_id
+
+    with cache.lock(key):
+        # another thread may have resolved / created it while we waited
+        container_id = cache.get(key)
+        if container_id is None:
+            container_id = find()
+            if container_id is None:
+                container_id = create()
+            cache.put(key, container_id)
+    return container_id
+
+def get_or_create_project_id(connection, project_name, cache):
+    """ resolve a project by name, creating it if it does not exist
+
+    Parameters
+    ----------
+    connection : omero.gateway.BlitzGateway
+        an open connection to an OMERO server
+    project_name : str
+        project name
+    cache : ContainerCache
+        name -> ID cache
+
+    Returns
+    -------
+    int
+        project ID
+    """
+    return _get_or_create(cache, ('Project', project_name, None),
+                          lambda: find_project_id(connection, project_name),
+                          lambda: _create_container(connection, 'Project',
+                                                    project_name))
+
+def get_or_create_dataset_id(connection, dataset_name, cache, project_id=None):
+    """ resolve a dataset by name, creating it (and linking it to `project_id`,
+    if given) if it does not exist
+
+    Parameters
+    ----------
+    connection : omero.gateway.BlitzGateway
+        an open connection to an OMERO server
+    dataset_name : str
+        dataset name
+    cache : ContainerCache
+        name -> ID cache
+    project_id : int, optional
+        project the dataset belongs to, by default None
+
+    Returns
+    -------
+    int
+        dataset ID
+    """
+    def create():
+        dataset_id = _create_container(connection, 'Dataset', dataset_name)
+        if project_id is not None:
+            _link_dataset(connection, project_id, dataset_id)
+        return dataset_id
+
+    return _get_or_create(cache, ('Dataset', dataset_name, project_id),
+                          lambda: find_dataset_id(connection, dataset_name,
+                                                  project_id),
+                          create)
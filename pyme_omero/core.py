@@ -1,24 +1,189 @@
 
-import omero.model
-from omero.gateway import BlitzGateway
-from omero.cli import cli_login
-from omero import rtypes
-import yaml
 import os
-from PYME.config import user_config_dir
+import atexit
+import shutil
+import threading
+from functools import partial
+from collections import OrderedDict
 from contextlib import contextmanager
+from pyme_omero.connection import SessionPool, login
+from pyme_omero import (attachments, cache, cluster_io, containers, 
+                        import_policy, metrics, resumable, serialization, 
+                        tables, transfer, upload_queue)
 import logging
 
 logger = logging.getLogger(__name__)
 
-credentials = os.path.join(user_config_dir, 'plugins', 'config', 'pyme-omero')
-with open(credentials) as f:
-    credentials = yaml.safe_load(f)
-
-LOGIN_ARGS = ['-u%s' % credentials['user'], '-w%s' % credentials['password'], 
-              '-s%s' % credentials['address'], '-p%s' % credentials.get('port', 4064)]
+# omero, yaml and PYME are imported where they are used, and the credentials
+# are read on first use, so that importing this module (e.g. during PYME plugin
+# discovery) is cheap and works before the plugin has been configured
 
 BUFF_SIZE = 1048576  # ome.conditions.ApiUsageException: Max read size is: 1048576
+# attachments at least this large are uploaded resumably
+RESUMABLE_UPLOAD_SIZE = 64 * 1024 ** 2
+LOCALIZATION_EXTENSIONS = ['.hdf', '.h5r', '.parquet', '.feather']
+
+_credentials = None
+_credentials_lock = threading.Lock()
+
+def credentials_path():
+    from PYME.config import user_config_dir
+    return os.path.join(user_config_dir, 'plugins', 'config', 'pyme-omero')
+
+def get_credentials():
+    """get the stored OMERO login details, reading them on first use
+
+    Returns
+    -------
+    dict
+        'user', 'password', 'address' and optionally 'port'
+
+    Raises
+    ------
+    IOError
+        if the credentials file does not exist. See readme.md to configure it.
+    """
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None:
+            import yaml
+            path = credentials_path()
+            try:
+                with open(path) as f:
+                    _credentials = yaml.safe_load(f)
+            except IOError as e:
+                raise IOError('OMERO credentials could not be read from %s, '
+                              'see readme.md to configure them (%s)' % (path, 
+                                                                       e))
+        return _credentials
+
+def __getattr__(name):
+    # module attributes which used to be set at import
+    if name == 'credentials':
+        return get_credentials()
+    if name == 'LOGIN_ARGS':
+        credentials = get_credentials()
+        return ['-u%s' % credentials['user'], '-w%s' % credentials['password'], 
+                '-s%s' % credentials['address'], 
+                '-p%s' % credentials.get('port', 4064)]
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+_import_policy = None
+
+def get_import_policy():
+    """get the import policy used when none is passed to `file_import` etc.,
+    read on first use from the optional 'import' entry of the credentials
+    file, e.g.
+
+        import:
+            thumbnails: false
+            checksum: CRC-32
+            transfer: ln
+            repository_root: /mnt/omero/ManagedRepository
+
+    Returns
+    -------
+    pyme_omero.import_policy.ImportPolicy
+        the default policy, uploading with thumbnails, statistics and SHA-1
+        unless configured otherwise
+    """
+    global _import_policy
+    with _credentials_lock:
+        policy = _import_policy
+    if policy is None:
+        try:
+            options = get_credentials().get('import', None) or {}
+        except (IOError, ImportError):
+            # no config, e.g. a session pool set up by hand
+            options = {}
+        policy = import_policy.ImportPolicy(**options)
+        with _credentials_lock:
+            if _import_policy is None:
+                _import_policy = policy
+            policy = _import_policy
+    return policy
+
+def set_import_policy(policy):
+    """replace the default import policy, see `get_import_policy`
+
+    Parameters
+    ----------
+    policy : pyme_omero.import_policy.ImportPolicy
+        new default, or None to re-read it from the credentials file
+    """
+    global _import_policy
+    with _credentials_lock:
+        _import_policy = policy
+
+def upload_journal_dir():
+    """ where journals of resumable uploads are kept """
+    from PYME.config import user_config_dir
+    return os.path.join(user_config_dir, 'cache', 'pyme-omero-uploads')
+
+_session_pool = None
+_session_pool_lock = threading.Lock()
+
+# name -> ID cache for projects / datasets, call `container_cache.invalidate()`
+# if containers are deleted or renamed server-side
+container_cache = containers.ContainerCache()
+# SHA-1 -> FileAnnotation ID index used to avoid re-uploading attachments, 
+# see `pyme_omero.attachments`
+attachment_index = attachments.AttachmentIndex()
+
+def get_session_pool():
+    """get the session pool used by this module, creating it from the stored
+    credentials on first use
+
+    Returns
+    -------
+    pyme_omero.connection.SessionPool
+        pool of connections to the configured OMERO server
+    """
+    global _session_pool
+    with _session_pool_lock:
+        if _session_pool is None:
+            credentials = get_credentials()
+            _session_pool = SessionPool(partial(login, credentials['user'],
+                                                credentials['password'],
+                                                credentials['address'],
+                                                credentials.get('port', 4064)))
+            atexit.register(_session_pool.close)
+        return _session_pool
+
+def set_session_pool(pool):
+    """replace the session pool used by this module, e.g. with one connecting
+    to a different server or to a fake gateway for testing. The previous pool,
+    if any, is closed.
+
+    Parameters
+    ----------
+    pool : pyme_omero.connection.SessionPool
+        new session pool
+    """
+    global _session_pool
+    with _session_pool_lock:
+        old, _session_pool = _session_pool, pool
+    container_cache.invalidate()
+    attachment_index.invalidate()
+    if old is not None and old is not pool:
+        old.close()
+
+def connection(timeout=None):
+    """check out a pooled connection to the OMERO server
+
+    Parameters
+    ----------
+    timeout : float, optional
+        [s] how long to wait for a free connection, by default None (wait
+        indefinitely)
+
+    Returns
+    -------
+    contextmanager
+        yielding an open omero.gateway.BlitzGateway. Nested calls within the
+        same thread share one connection.
+    """
+    return get_session_pool().connection(timeout)
 
 def link_to_desired_name(temp_filename, filename):
     """create a hardlink on the filesystem in order to name a temporary file
@@ -75,126 +240,686 @@ def local_or_named_temp_filename(url):
         if localpath:
             yield localpath
         else:
-            ext = os.path.splitext(name)[-1]
-
             with tempfile.TemporaryDirectory() as temp_dir:
-                with open(os.path.join(temp_dir, os.path.split(name)[-1]), 'wb') as f:
-                    s = clusterIO.get_file(name, clusterfilter)
-                    f.write(s)
-                    f.flush()
-                    yield f.name
+                # stream to disk rather than clusterIO.get_file, which holds
+                # the whole file in memory
+                yield cluster_io.fetch_cluster_file(
+                    name, clusterfilter, 
+                    os.path.join(temp_dir, os.path.split(name)[-1]))
 
     else:
         raise IOError('Path "%s" could not be found' % url)
 
 def create_dataset(connection, dataset_name):
+    import omero.model
+    from omero import rtypes
+
     dataset = omero.model.DatasetI()
     dataset.setName(rtypes.rstring(dataset_name))
     dataset = connection.getUpdateService().saveAndReturnObject(dataset)
     return dataset.getId().getValue()
 
-def get_or_create_project_id(connection, project_name):    
-    # check if the project already exists
-    projects = connection.getContainerService().loadContainerHierarchy('Project', 
-                                                                    None, None)
-    for p in projects:
-        if p.getName().getValue() == project_name:
-            return p.getId().getValue()
-    
-    # create a new project
-    project = omero.model.ProjectI()
-    project.setName(rtypes.rstring(project_name))
-    project = connection.getUpdateService().saveAndReturnObject(project)
-    return project.getId().getValue()
+def get_or_create_project_id(connection, project_name):
+    """ get the ID of the named project, creating it if it doesn't exist
+
+    Parameters
+    ----------
+    connection : omero.gateway.BlitzGateway
+        an open connection to an OMERO server
+    project_name : str
+        name of the project
+
+    Returns
+    -------
+    int
+        project ID
+    """
+    return containers.get_or_create_project_id(connection, project_name,
+                                               container_cache)
 
 def get_or_create_dataset_id(dataset_name, project_name=''):
-    with cli_login(*LOGIN_ARGS) as cli:
-        conn = BlitzGateway(client_obj=cli._client)
-        
+    """ get the ID of the named dataset, creating it (and the project, if
+    given) if it doesn't exist. Results are cached in `container_cache`.
+
+    Parameters
+    ----------
+    dataset_name : str
+        name of the dataset
+    project_name : str, optional
+        name of the project the dataset belongs to, by default ''
+
+    Returns
+    -------
+    int
+        dataset ID
+    """
+    with connection() as conn, metrics.span('container_lookup', 
+                                            dataset=dataset_name, 
+                                            project=project_name):
         # handle linking with project if given
+        project_id = None
         if project_name != '':
-            # check if the dataset already exists within the project
             project_id = get_or_create_project_id(conn, project_name)
-            # projects = conn.getContainerService().loadContainerHierarchy('Project', 
-                                                                       #  None, None)
-            project = conn.getObject("Project", project_id)
-            dataset_wrapper = project.findChildByName(dataset_name)
-            if dataset_wrapper != None:
-                return dataset_wrapper.getId()
-            
-            # make a new dataset
-            dataset_id = create_dataset(conn, dataset_name)
-            
-            # link it to the project
-            links = []
-            link = omero.model.ProjectDatasetLinkI()
-            link.parent = omero.model.ProjectI(project_id, False)
-            link.child = omero.model.DatasetI(dataset_id, False)
-            links.append(link)
-            conn.getUpdateService().saveArray(links, conn.SERVICE_OPTS)
-            return dataset_id
         
-        # no project specified, check if the dataset already exists
-        datasets = conn.getContainerService().loadContainerHierarchy('Dataset', 
-                                                                    None, None)
-        for d in datasets:
-            if d.getName().getValue() == dataset_name:
-                return d.getId().getValue()
-        
-        # otherwise create a new dataset
-        return create_dataset(conn, dataset_name)
+        return containers.get_or_create_dataset_id(conn, dataset_name,
+                                                   container_cache, project_id)
+
+def start_file_import(client, filename, block_size=BUFF_SIZE, policy=None):
+    """ upload a file and start its server-side import without waiting for
+    the import to finish
 
-def file_import(client, filename, wait=-1):
-    """Re-usable method for a basic import."""
+    Parameters
+    ----------
+    client : omero.client
+        client of an open session, e.g. BlitzGateway.c
+    filename : str
+        path to the file to import
+    block_size : int, optional
+        upload block size, capped at `BUFF_SIZE`
+    policy : pyme_omero.import_policy.ImportPolicy, optional
+        thumbnail, statistics, checksum and transfer options, by default
+        `get_import_policy()`
+
+    Returns
+    -------
+    tuple
+        (import process, import handle) to pass to `finish_file_import`. Must
+        be finished on the same session.
+    """
     from pyme_omero import import_utils
+    if policy is None:
+        policy = get_import_policy()
     mrepo = client.getManagedRepository()
     files = [filename]
 
     fileset = import_utils.create_fileset(files)
-    settings = import_utils.create_settings(name=os.path.basename(filename))
+    settings = import_utils.create_settings(name=os.path.basename(filename),
+                                            policy=policy)
 
     proc = mrepo.importFileset(fileset, settings)
     try:
-        return import_utils.assert_import(client, proc, files, wait)
+        handle = import_utils.upload_and_verify(client, proc, files, block_size,
+                                                policy=policy)
+    except:
+        proc.close()
+        raise
+    return proc, handle
+
+def finish_file_import(client, started, wait=-1):
+    """ wait for an import begun with `start_file_import`
+
+    Parameters
+    ----------
+    client : omero.client
+        client of the session the import was started on
+    started : tuple
+        return value of `start_file_import`
+    wait : int, optional
+        seconds to wait for the import, 0 to return immediately, by default -1
+        (wait indefinitely)
+
+    Returns
+    -------
+    omero.cmd.ImportResponse
+        import response, or None if `wait` is 0
+    """
+    from pyme_omero import import_utils
+    proc, handle = started
+    try:
+        return import_utils.wait_for_import(client, handle, wait)
     finally:
         proc.close()
 
+def file_import(client, filename, wait=-1, block_size=BUFF_SIZE, policy=None):
+    """Re-usable method for a basic import, see `start_file_import`."""
+    return finish_file_import(client, 
+                              start_file_import(client, filename, block_size,
+                                                policy),
+                              wait)
+
+def _link_imported_image(conn, r, dataset_id, attachments):
+    if not r:
+        return None
+    
+    # TODO - doing this as iterable fileset for single file is weird
+    p = r.pixels[0]
+    image_id = p.image.id.val
+    logger.debug('Imported Image ID: %d' % image_id)
+    return _link_image(conn, image_id, dataset_id, attachments)
+
+def _link_image(conn, image_id, dataset_id, attachments):
+    import omero.model
+
+    links = []
+    link = omero.model.DatasetImageLinkI()
+    link.parent = omero.model.DatasetI(dataset_id, False)
+    link.child = omero.model.ImageI(image_id, False)
+    links.append(link)
+    conn.getUpdateService().saveArray(links, conn.SERVICE_OPTS)
+
+    if len(attachments) >  0:
+        # have to have loadedness -> True to link an annotation
+        image = conn.getObject("Image", image_id)
+        for attachment in attachments:
+            # TODO - add guess_mimetype / namespace here
+            upload_file_annotation(conn, image, attachment, 
+                                   namespace='pyme.localizations')
+    return image_id
+
 def upload_image_from_file(file, dataset_name, project_name='', 
-                           attachments=(), wait=-1):
+                           attachments=(), wait=-1, policy=None):
+    attachments = list(attachments)
+
+    with connection() as conn:
+        dataset_id = get_or_create_dataset_id(dataset_name, project_name)
+
+        r = file_import(conn.c, file, wait, policy=policy)
+        return _link_imported_image(conn, r, dataset_id, attachments)
+
+def submit_image_upload(file, dataset_name, project_name='', attachments=(),
+                        wait=-1, callback=None, cleanup=None, queue=None,
+                        policy=None):
+    """ queue an `upload_image_from_file` call to run in the background. The
+    server-side import of one queued file overlaps with the transfer of the
+    next.
+
+    Parameters
+    ----------
+    file : str
+        path to the image file
+    dataset_name : str
+        name of the dataset to link the image to
+    project_name : str, optional
+        name of the project the dataset belongs to, by default ''
+    attachments : list, optional
+        paths to files to attach to the image
+    wait : int, optional
+        seconds to wait for the import, see `finish_file_import`
+    callback : callable, optional
+        called with the image ID once the image is linked, on the same session
+    cleanup : callable, optional
+        called with no arguments once the job has succeeded or failed, e.g. to
+        remove the temporary directory holding `file`
+    queue : pyme_omero.upload_queue.UploadQueue, optional
+        queue to submit to, by default the shared `upload_queue.get_queue()`
+    policy : pyme_omero.import_policy.ImportPolicy, optional
+        import options, see `start_file_import`
+
+    Returns
+    -------
+    pyme_omero.upload_queue.UploadJob
+        job whose result is the image ID
+
+    Notes
+    -----
+    Each job holds a pooled connection from the start of its transfer until
+    its image is linked, so queued uploads use at most `queue.max_in_flight`
+    connections. Keep that below the pool's `max_size` (as the defaults are)
+    so that connections remain for other callers, e.g. the GUI thread.
+    """
     attachments = list(attachments)
+    pool = get_session_pool()
+    if queue is None:
+        queue = upload_queue.get_queue()
+
+    def transfer():
+        # the import handle is only valid on the session which started it, so
+        # hold on to the connection across both stages
+        conn = pool.checkout()
+        try:
+            with pool.bind(conn):
+                dataset_id = get_or_create_dataset_id(dataset_name, 
+                                                      project_name)
+                return conn, dataset_id, start_file_import(conn.c, file,
+                                                           policy=policy)
+        except:
+            pool.checkin(conn)
+            raise
+    
+    def finish(started):
+        conn, dataset_id, import_started = started
+        try:
+            with pool.bind(conn):
+                r = finish_file_import(conn.c, import_started, wait)
+                image_id = _link_imported_image(conn, r, dataset_id, 
+                                                attachments)
+                if callback is not None and image_id is not None:
+                    callback(image_id)
+                return image_id
+        finally:
+            pool.checkin(conn)
+
+    def abort(started):
+        # the queue shut down before finish could run
+        conn, dataset_id, (proc, handle) = started
+        try:
+            proc.close()
+        finally:
+            pool.checkin(conn)
+    
+    return queue.submit(transfer, finish, cleanup, 
+                        description=os.path.basename(file), abort=abort)
+
+def start_stream_import(client, name, write, block_size=BUFF_SIZE,
+                        policy=None):
+    """ like `start_file_import`, but for a file which is serialized straight
+    into the import uploader rather than read from disk
+
+    Parameters
+    ----------
+    client : omero.client
+        client of an open session, e.g. BlitzGateway.c
+    name : str
+        file name to import as. The extension determines the format the server
+        reads it with.
+    write : callable
+        called with a writable, seekable file-like object and writes the file
+        contents to it
+    block_size : int, optional
+        upload block size, capped at `BUFF_SIZE`
+    policy : pyme_omero.import_policy.ImportPolicy, optional
+        thumbnail and statistics options, by default `get_import_policy()`.
+        Its checksum and transfer are not used: streamed files are always
+        uploaded, and hashed with SHA-1 as they are written.
+
+    Returns
+    -------
+    tuple
+        (import process, import handle) to pass to `finish_file_import`
+    """
+    from pyme_omero import import_utils
+    if policy is None:
+        policy = get_import_policy()
+    if policy.checksum != import_policy.SHA1_160 or policy.in_place:
+        logger.debug('streaming %s with SHA-1 upload rather than %s' % (
+            name, policy))
+    policy = import_policy.ImportPolicy(thumbnails=policy.thumbnails,
+                                        stats=policy.stats)
+    mrepo = client.getManagedRepository()
+
+    fileset = import_utils.create_fileset([name])
+    settings = import_utils.create_settings(name=name, policy=policy)
+
+    proc = mrepo.importFileset(fileset, settings)
+    try:
+        rfs = proc.getUploader(0)
+        try:
+            with metrics.span('upload', file=name, stream=True) as span:
+                writer = transfer.RawFileStoreWriter(rfs, block_size)
+                write(writer)
+                digest = writer.hexdigest()
+                span.add_bytes(writer.size)
+            logger.debug('streamed %d bytes of %s' % (writer.size, name))
+        finally:
+            rfs.close()
+        with metrics.span('verify_upload', n_files=1):
+            handle = proc.verifyUpload([digest])
+    except:
+        proc.close()
+        raise
+    return proc, handle
+
+def upload_stream_annotation(connection, image, name, write,
+                             mimetype='application/octet-stream', 
+                             namespace='', description=None):
+    """ like `upload_file_annotation`, but for a file which is serialized 
+    straight to the server rather than read from disk
+
+    Parameters
+    ----------
+    connection : omero.gateway.BlitzGateway
+        an open connection to an OMERO server
+    image : int or omero object wrapped
+        either an image_id or a Blitz object wrapper instance of the image
+    name : str
+        file name of the attachment
+    write : callable
+        called with a writable, seekable file-like object and writes the file
+        contents to it
+    mimetype : str, optional
+        by default 'application/octet-stream'
+    namespace : str, optional
+        by default ''
+    description : str, optional
+        by default None
+    
+    Returns
+    -------
+    int
+        FileAnnotation ID
+    """
+    try:
+        image_id = image.getId()
+    except AttributeError:
+        image_id = image
+    
+    og_file = _create_original_file(connection, name, mimetype)
+    _write_original_file(connection, og_file.getId().getValue(), write)
+    return _link_file_annotation(connection, image_id, 
+                                 og_file.getId().getValue(), namespace, 
+                                 description)
+
+def _new_original_file(name, mimetype):
+    import omero.model
+    from omero import rtypes
+
+    og_file = omero.model.OriginalFileI()
+    og_file.setName(rtypes.rstring(name))
+    og_file.setPath(rtypes.rstring(''))
+    og_file.setMimetype(rtypes.rstring(mimetype))
+    og_file.setSize(rtypes.rlong(0))
+    return og_file
+
+def _create_original_file(connection, name, mimetype):
+    return connection.getUpdateService().saveAndReturnObject(
+        _new_original_file(name, mimetype), connection.SERVICE_OPTS)
+
+def _write_original_file(connection, og_file_id, write):
+    raw_file_store = transfer.create_raw_file_store(connection)
+    try:
+        raw_file_store.setFileId(og_file_id)
+        with transfer.RawFileStoreWriter(raw_file_store) as writer:
+            write(writer)
+        # saving the store updates the OriginalFile size and hash
+        return raw_file_store.save()
+    finally:
+        raw_file_store.close()
+
+def _copy_file(path, writer):
+    with open(path, 'rb') as f:
+        shutil.copyfileobj(f, writer, BUFF_SIZE)
+
+def _link_file_annotation(connection, image_id, og_file_id, namespace='', 
+                          description=None):
+    import omero.model
+    from omero import rtypes
+
+    update = connection.getUpdateService()
+    file_ann = omero.model.FileAnnotationI()
+    file_ann.setFile(omero.model.OriginalFileI(og_file_id, False))
+    file_ann.setNs(rtypes.rstring(namespace))
+    if description is not None:
+        file_ann.setDescription(rtypes.rstring(description))
+    file_ann = update.saveAndReturnObject(file_ann, connection.SERVICE_OPTS)
+    
+    link = omero.model.ImageAnnotationLinkI()
+    link.parent = omero.model.ImageI(image_id, False)
+    link.child = omero.model.FileAnnotationI(file_ann.getId().getValue(), 
+                                             False)
+    update.saveAndReturnObject(link, connection.SERVICE_OPTS)
+    logger.debug('Attached FileAnnotation %d to %d' % (
+        file_ann.getId().getValue(), image_id))
+    return file_ann.getId().getValue()
+
+def upload_image_from_stream(name, write, dataset_name, project_name='',
+                             attachments=(), wait=-1, policy=None):
+    """ upload an image which is serialized straight to the server, with no
+    local temporary files
+
+    Parameters
+    ----------
+    name : str
+        file name to import the image as, e.g. 'rendering.png'. The extension
+        determines the format the server reads it with.
+    write : callable
+        called with a writable, seekable file-like object and writes the image
+        file to it, e.g. a partial of `serialization.write_image_tiff`
+    dataset_name : str
+        name of the dataset to link the image to
+    project_name : str, optional
+        name of the project the dataset belongs to, by default ''
+    attachments : list, optional
+        (name, write) pairs of attachments to serialize to the server and
+        attach to the image with the 'pyme.localizations' namespace
+    wait : int, optional
+        seconds to wait for the import, see `finish_file_import`
+    policy : pyme_omero.import_policy.ImportPolicy, optional
+        thumbnail and statistics options, see `start_stream_import`
+
+    Returns
+    -------
+    int
+        image ID, or None if the import was not waited on
+    """
+    with connection() as conn:
+        dataset_id = get_or_create_dataset_id(dataset_name, project_name)
+
+        r = finish_file_import(conn.c, 
+                               start_stream_import(conn.c, name, write,
+                                                   policy=policy), wait)
+        image_id = _link_imported_image(conn, r, dataset_id, [])
+        if image_id is not None:
+            for attachment_name, write_attachment in attachments:
+                upload_stream_annotation(conn, image_id, attachment_name, 
+                                         write_attachment, 
+                                         namespace='pyme.localizations')
+        return image_id
+
+def upload_image_from_pixels(name, data, dataset_name, project_name='',
+                             attachments=(), voxelsize=None, max_workers=4):
+    """ upload an in-memory image by writing its planes straight into a new
+    Image, rather than importing a file, see `pixels.upload_pixels`
+
+    Parameters
+    ----------
+    name : str
+        image name
+    data : array-like
+        5D (x, y, z, t, c) pixel data, e.g. `ImageStack.data_xyztc`
+    dataset_name : str
+        name of the dataset to link the image to
+    project_name : str, optional
+        name of the project the dataset belongs to, by default ''
+    attachments : list, optional
+        paths to files to attach to the image
+    voxelsize : tuple, optional
+        [um] (x, y, z) pixel sizes
+    max_workers : int, optional
+        number of planes written in parallel, by default 4
+
+    Returns
+    -------
+    int
+        image ID
+    """
+    from pyme_omero import pixels
+    attachments = list(attachments)
+
+    with connection() as conn:
+        dataset_id = get_or_create_dataset_id(dataset_name, project_name)
 
-    dataset_id = get_or_create_dataset_id(dataset_name, project_name)
-
-    with cli_login(*LOGIN_ARGS) as cli:
-        conn = BlitzGateway(client_obj=cli._client)
-
-        r = file_import(cli._client, file, wait)
-        if r:
-            links = []
-            # TODO - doing this as iterable fileset for single file is weird
-            p = r.pixels[0]
-            image_id = p.image.id.val
-            logger.debug('Imported Image ID: %d' % image_id)
-            link = omero.model.DatasetImageLinkI()
-            link.parent = omero.model.DatasetI(dataset_id, False)
-            link.child = omero.model.ImageI(image_id, False)
+        image_id = pixels.upload_pixels(conn, name, data, voxelsize,
+                                        max_workers=max_workers)
+        return _link_image(conn, image_id, dataset_id, attachments)
+
+def _create_file_annotations(conn, files, namespace, 
+                             mimetype='application/octet-stream'):
+    # the user's FileAnnotations of identical files are reused, looked up by
+    # hash. The rest are created with one saveAndReturnArray call for their 
+    # OriginalFiles and one for the annotations; only file contents are sent
+    # file by file, resumably for large files.
+    import omero.model
+    from omero import rtypes
+
+    ann_ids, digests = {}, OrderedDict()
+    for file in files:
+        if file in ann_ids or file in digests:
+            continue
+        digest = attachment_index.sha1(file)
+        size = os.path.getsize(file)
+        file_ann_id = attachments.find_file_annotation(conn, digest, size,
+                                                       namespace)
+        if file_ann_id is None:
+            digests[file] = digest
+        else:
+            attachment_index.record_reuse(size)
+            ann_ids[file] = file_ann_id
+    if len(digests) == 0:
+        return ann_ids
+    
+    update = conn.getUpdateService()
+    small = [f for f in digests 
+             if os.path.getsize(f) < RESUMABLE_UPLOAD_SIZE]
+    og_file_ids = {}
+    if len(small) > 0:
+        og_files = update.saveAndReturnArray(
+            [_new_original_file(os.path.basename(f), mimetype) for f in small],
+            conn.SERVICE_OPTS)
+        for file, og_file in zip(small, og_files):
+            og_file_ids[file] = og_file.getId().getValue()
+    
+    for file in digests:
+        with metrics.span('attachment_upload', os.path.getsize(file), 
+                          file=os.path.basename(file)):
+            if file in og_file_ids:
+                _write_original_file(conn, og_file_ids[file], 
+                                     partial(_copy_file, file))
+            else:
+                og_file_ids[file] = _upload_original_file_resumable(
+                    conn, file, mimetype)
+    
+    file_anns = []
+    for file in digests:
+        file_ann = omero.model.FileAnnotationI()
+        file_ann.setFile(omero.model.OriginalFileI(og_file_ids[file], False))
+        file_ann.setNs(rtypes.rstring(namespace))
+        file_anns.append(file_ann)
+    file_anns = update.saveAndReturnArray(file_anns, conn.SERVICE_OPTS)
+    for file, file_ann in zip(digests, file_anns):
+        ann_ids[file] = file_ann.getId().getValue()
+        attachment_index.put(digests[file], namespace, ann_ids[file])
+    return ann_ids
+
+def _link_batch(conn, dataset_id, image_ids, attachments, callback=None):
+    # all dataset links and attachment links in one saveArray call
+    import omero.model
+
+    file_ann_ids = _create_file_annotations(
+        conn, [attachment for image_id, image_attachments 
+               in zip(image_ids, attachments) if image_id is not None
+               for attachment in image_attachments], 'pyme.localizations')
+    
+    links = []
+    for image_id in image_ids:
+        if image_id is None:
+            continue
+        link = omero.model.DatasetImageLinkI()
+        link.parent = omero.model.DatasetI(dataset_id, False)
+        link.child = omero.model.ImageI(image_id, False)
+        links.append(link)
+    
+    for image_id, image_attachments in zip(image_ids, attachments):
+        if image_id is None:
+            continue
+        for attachment in image_attachments:
+            link = omero.model.ImageAnnotationLinkI()
+            link.parent = omero.model.ImageI(image_id, False)
+            link.child = omero.model.FileAnnotationI(file_ann_ids[attachment],
+                                                     False)
             links.append(link)
-            conn.getUpdateService().saveArray(links, conn.SERVICE_OPTS)
-
-            if len(attachments) >  0:
-                # have to have loadedness -> True to link an annotation
-                image = conn.getObject("Image", image_id)
-                for attachment in attachments:
-                    # TODO - add guess_mimetype / namespace here
-                    upload_file_annotation(conn, image, attachment, 
-                                           namespace='pyme.localizations')
-    return image_id
+    
+    if len(links) > 0:
+        conn.getUpdateService().saveArray(links, conn.SERVICE_OPTS)
+    
+    if callback is not None:
+        for index, image_id in enumerate(image_ids):
+            if image_id is not None:
+                callback(index, image_id)
+
+def upload_images_from_files(files, dataset_name, project_name='', 
+                             attachments=None, wait=-1, policy=None,
+                             callback=None):
+    """ upload a batch of images over a single session, creating the
+    attachments' OriginalFiles and FileAnnotations with one `saveAndReturnArray`
+    call each, and all dataset and attachment links with one `saveArray` call.
+    The transfer of each file overlaps with the server-side import of the
+    previous one.
+
+    Parameters
+    ----------
+    files : list
+        paths to the image files
+    dataset_name : str
+        name of the dataset to link the images to
+    project_name : str, optional
+        name of the project the dataset belongs to, by default ''
+    attachments : list, optional
+        one list of attachment paths per file, attached to the corresponding
+        image with the 'pyme.localizations' namespace
+    wait : int, optional
+        seconds to wait for each import, see `finish_file_import`
+    policy : pyme_omero.import_policy.ImportPolicy, optional
+        import options, see `start_file_import`
+    callback : callable, optional
+        called as callback(index in `files`, image ID) for each image once it
+        is linked, on the same session
+
+    Returns
+    -------
+    list
+        image IDs, in the order of `files` (None for imports not waited on)
+
+    Notes
+    -----
+    If an upload or import fails, files already uploaded are still imported,
+    and every image imported is linked, attached to and passed to `callback`
+    before the error is raised.
+    """
+    files = list(files)
+    if attachments is None:
+        attachments = [[] for f in files]
+    attachments = [list(a) for a in attachments]
+    assert len(attachments) == len(files)
+
+    with connection() as conn:
+        dataset_id = get_or_create_dataset_id(dataset_name, project_name)
+
+        # import, letting the server process file i - 1 while we send file i
+        image_ids = [None] * len(files)
+        outstanding = []  # (index, started) not yet passed to finish
+        def finish_next():
+            index, started = outstanding.pop(0)
+            r = finish_file_import(conn.c, started, wait)
+            image_ids[index] = r.pixels[0].image.id.val if r else None
+        
+        try:
+            for index, file in enumerate(files):
+                outstanding.append((index, start_file_import(conn.c, file, 
+                                                             policy=policy)))
+                if len(outstanding) > 1:
+                    finish_next()
+            while len(outstanding) > 0:
+                finish_next()
+        except:
+            # files still outstanding are uploaded and verified already, so
+            # finish their imports (closing their processes) and link them too
+            while len(outstanding) > 0:
+                file = files[outstanding[0][0]]
+                try:
+                    finish_next()
+                except Exception:
+                    logger.exception('import of %s failed' % file)
+            logger.error('batch upload failed after importing %s, linking '
+                         'them' % [i for i in image_ids if i is not None])
+            try:
+                _link_batch(conn, dataset_id, image_ids, attachments, callback)
+            except Exception:
+                logger.exception('linking images %s failed' % image_ids)
+            raise
+        
+        logger.debug('Imported Image IDs: %s' % image_ids)
+        _link_batch(conn, dataset_id, image_ids, attachments, callback)
+    
+    return image_ids
 
 def upload_file_annotation(connection, image, file, 
                            mimetype='application/octet-stream', 
-                           namespace='', description=None):
+                           namespace='', description=None, deduplicate=True):
     """ upload a file as an attachment to an already-uploaded image
 
+    Files of at least `RESUMABLE_UPLOAD_SIZE` bytes are uploaded resumably,
+    see `upload_large_file_annotation`.
+
     Parameters
     ----------
     connection : omero.gateway.BlitzGateway
@@ -209,6 +934,16 @@ def upload_file_annotation(connection, image, file,
         by default ''
     description : str, optional
         by default None
+    deduplicate : bool, optional
+        if a FileAnnotation with identical contents and namespace already 
+        exists, just link it rather than uploading the file again, by default
+        True. See `pyme_omero.attachments`; bytes saved are counted in 
+        `attachment_index.bytes_saved`.
+    
+    Returns
+    -------
+    int
+        FileAnnotation ID
     """
     try:
         image_id = image.getId()
@@ -216,80 +951,523 @@ def upload_file_annotation(connection, image, file,
         image_id = image
         image = connection.getObject("Image", image)
     
-    file_ann = connection.createFileAnnfromLocalFile(file, mimetype=mimetype,
-                                                     ns=namespace, desc=None)
-    logger.debug('Attaching FileAnnotation %d to %d' % (file_ann.getId(), 
-                                                        image_id))
-    image.linkAnnotation(file_ann)
+    digest = None
+    if deduplicate:
+        digest, file_ann_id = attachments.attach_existing(connection, 
+                                                          attachment_index,
+                                                          image_id, file, 
+                                                          namespace)
+        if file_ann_id is not None:
+            return file_ann_id
+    
+    size = os.path.getsize(file)
+    with metrics.span('attachment_upload', size, 
+                      file=os.path.basename(file)):
+        if size >= RESUMABLE_UPLOAD_SIZE:
+            file_ann_id = upload_large_file_annotation(connection, image_id, 
+                                                       file, mimetype, 
+                                                       namespace, description)
+        else:
+            file_ann = connection.createFileAnnfromLocalFile(file, 
+                                                             mimetype=mimetype,
+                                                             ns=namespace, 
+                                                             desc=None)
+            logger.debug('Attaching FileAnnotation %d to %d' % (
+                file_ann.getId(), image_id))
+            image.linkAnnotation(file_ann)
+            file_ann_id = file_ann.getId()
+    
+    if digest is not None:
+        attachment_index.put(digest, namespace, file_ann_id)
+    return file_ann_id
+
+def upload_large_file_annotation(connection, image_id, file,
+                                 mimetype='application/octet-stream', 
+                                 namespace='', description=None, 
+                                 journal_dir=None, retries=5):
+    """ upload a file as an attachment, resuming after dropped connections
+
+    Accepted blocks are journaled in `journal_dir` against the OriginalFile
+    being written, so if this process dies part-way through a later call for 
+    the same (unmodified) file picks up where it left off instead of starting
+    over.
+
+    Parameters
+    ----------
+    connection : omero.gateway.BlitzGateway
+        an open connection to an OMERO server
+    image_id : int
+        ID of the image to attach the file to
+    file : str
+        path to the file on disk
+    mimetype : str, optional
+        by default 'application/octet-stream'
+    namespace : str, optional
+        by default ''
+    description : str, optional
+        by default None
+    journal_dir : str, optional
+        where to keep upload journals, by default `upload_journal_dir()`
+    retries : int, optional
+        consecutive failures to tolerate, see 
+        `pyme_omero.resumable.upload_file_resumable`
+    
+    Returns
+    -------
+    int
+        FileAnnotation ID
+    """
+    og_file_id = _upload_original_file_resumable(connection, file, mimetype,
+                                                 journal_dir, retries)
+    return _link_file_annotation(connection, image_id, og_file_id, namespace,
+                                 description)
+
+def _upload_original_file_resumable(connection, file, mimetype, 
+                                    journal_dir=None, retries=5):
+    if journal_dir is None:
+        journal_dir = upload_journal_dir()
+    journal = resumable.UploadJournal(file, BUFF_SIZE, journal_dir)
+    if (journal.target is None 
+            or connection.getObject('OriginalFile', journal.target) is None):
+        og_file = _create_original_file(connection, os.path.basename(file), 
+                                        mimetype)
+        journal.set_target(og_file.getId().getValue())
+    
+    def open_store():
+        raw_file_store = transfer.create_raw_file_store(connection)
+        raw_file_store.setFileId(journal.target)
+        return raw_file_store
+    
+    # saving the store which did the writing updates the OriginalFile size 
+    # and hash
+    resumable.upload_file_resumable(open_store, file, journal, retries,
+                                    on_complete=lambda store: store.save())
+    og_file_id = journal.target
+    journal.discard()
+    return og_file_id
 
 def connect_and_upload_file_annotation(image_id, file, 
                                        mimetype='application/octet-stream',
                                        namespace='', description=None):
-    with cli_login(*LOGIN_ARGS) as cli:
-        conn = BlitzGateway(client_obj=cli._client)
+    with connection() as conn:
         upload_file_annotation(conn, image_id, file, mimetype, namespace,
                                description)
 
-def localization_files_from_image_url(image_url, out_dir):
+def upload_url_annotation(connection, image, url, 
+                          mimetype='application/octet-stream', namespace='', 
+                          description=None):
+    """ upload a local file or pyme-cluster file as an attachment
+
+    Cluster files with no local path are streamed from the cluster straight
+    into the attachment, without being staged in memory or on disk; the next 
+    chunk is fetched from the cluster while the current one is sent to OMERO.
+
+    Parameters
+    ----------
+    connection : omero.gateway.BlitzGateway
+        an open connection to an OMERO server
+    image : int or omero object wrapped
+        either an image_id or a Blitz object wrapper instance of the image
+    url : str
+        local path or pyme-cluster url
+    mimetype : str, optional
+        by default 'application/octet-stream'
+    namespace : str, optional
+        by default ''
+    description : str, optional
+        by default None
     """
+    from PYME.IO.FileUtils import nameUtils
+    from PYME.IO import unifiedIO
+
+    filename = nameUtils.getFullExistingFilename(url)
+    if os.path.exists(filename) or not unifiedIO.is_cluster_uri(url):
+        with local_or_named_temp_filename(url) as f:
+            return upload_file_annotation(connection, image, f, mimetype, 
+                                          namespace, description)
+    
+    from PYME.IO import clusterIO
+    name, clusterfilter = unifiedIO.split_cluster_url(filename)
+    localpath = clusterIO.get_local_path(name, clusterfilter)
+    if localpath:
+        return upload_file_annotation(connection, image, localpath, mimetype,
+                                      namespace, description)
+    
+    write = partial(cluster_io.copy_cluster_file, name, clusterfilter)
+    return upload_stream_annotation(connection, image, 
+                                    os.path.split(name)[-1], write, mimetype, 
+                                    namespace, description)
+
+def connect_and_upload_url_annotation(image_id, url, 
+                                      mimetype='application/octet-stream',
+                                      namespace='', description=None):
+    with connection() as conn:
+        upload_url_annotation(conn, image_id, url, mimetype, namespace,
+                              description)
+
+def upload_table_annotation(connection, image_id, tabular, name, 
+                            metadata=None, namespace=None, batch_rows=None):
+    """ store a PYME tabular object as an OMERO.table attached to an image, so
+    that its columns and rows can be queried server-side, see 
+    `pyme_omero.tables`
+
+    Parameters
+    ----------
+    connection : omero.gateway.BlitzGateway
+        an open connection to an OMERO server
+    image_id : int
+        image to attach the table to
+    tabular : PYME.IO.tabular.TabularBase
+        localizations
+    name : str
+        table name
+    metadata : PYME.IO.MetaDataHandler.MDHandlerBase, optional
+        metadata to store with the table
+    namespace : str, optional
+        annotation namespace, by default `tables.TABLE_NAMESPACE`
+    batch_rows : int, optional
+        rows sent per call, by default sized by the number of columns, see
+        `tables.write_table`
+
+    Returns
+    -------
+    int
+        FileAnnotation ID
+    """
+    if namespace is None:
+        namespace = tables.TABLE_NAMESPACE
+    with metrics.span('table_upload', table=name):
+        file_id = tables.write_table(connection, tabular, name, metadata, 
+                                     batch_rows)
+    return _link_file_annotation(connection, image_id, file_id, namespace)
+
+def connect_and_upload_table_annotation(image_id, tabular, name, 
+                                        metadata=None, namespace=None):
+    with connection() as conn:
+        return upload_table_annotation(conn, image_id, tabular, name, metadata,
+                                       namespace)
+
+def image_id_from_url(image_url):
+    """ parse the image ID from an OMERO web `Link to this image` url
 
     Parameters
     ----------
     image_url : str
-        url from OMERO web client, gotten typically by clicking the link symbol
-        with an image selected, i.e. `Link to this image`.
-    out_dir : str
-        path / name of tempfile.TemporaryDirectory
+        url from OMERO web client, e.g. 
+        https://server/webclient/?show=image-1234
 
     Returns
     -------
-    localization_files : list
-        paths to localization files saved to disk
+    int
+        image ID
     """
     from urllib.parse import urlparse, parse_qs
-    from omero.util.populate_roi import DownloadingOriginalFileProvider
 
     url = urlparse(image_url)
     # for `Link to this image`
-    image_id = int(parse_qs(url.query)['show'][0].split('-')[-1])
+    return int(parse_qs(url.query)['show'][0].split('-')[-1])
+
+def _fingerprint(*fields):
+    # cheap server-side metadata identifying a version of an object
+    return ':'.join('' if f is None else str(getattr(f, 'val', f)) 
+                    for f in fields)
+
+def _fetch_columnar(fetch, ext, path):
+    columnar_path = os.path.splitext(path)[0] + ext
+    fetch(path=columnar_path)
+    try:
+        return serialization.columnar_to_hdf(columnar_path, path)
+    finally:
+        os.remove(columnar_path)
+
+def _server_name(conn):
+    """ host:port of the server a connection is to, as object IDs are only
+    unique within a server """
+    client = conn.c
+    return '%s:%s' % (client.getProperty('omero.host'),
+                      client.getProperty('omero.port') or 4064)
+
+def _fetch_localization_file(conn, og_file, out_dir, n_streams, use_cache,
+                             progress):
+    progress.check()
+    filename = og_file['name']
+    stub, ext = os.path.splitext(filename)
     
-    localization_files = []
+    fetch = partial(transfer.download_original_file, conn, og_file['file_id'],
+                    og_file['size'], n_streams=n_streams, progress=progress)
+    if ext in serialization.COLUMNAR_EXTENSIONS:
+        # decode to the hdf layout PYME loads, caching the result
+        filename = stub + '.hdf'
+        fetch = partial(_fetch_columnar, fetch, ext)
+    if not use_cache:
+        return fetch(path=os.path.join(out_dir, filename))
+    
+    fingerprint = _fingerprint(og_file['hash'], og_file['size'], 
+                               og_file['mtime'])
+    download_cache = cache.get_download_cache()
+    server = _server_name(conn)
+    path = download_cache.get('OriginalFile', og_file['file_id'], fingerprint,
+                              server)
+    if path is not None:
+        progress.add(og_file['size'])
+        return path
+    return download_cache.put('OriginalFile', og_file['file_id'], fingerprint,
+                              filename, lambda path: fetch(path=path), server)
+
+def download_localization_files(image_url, out_dir, n_streams=1, 
+                                use_cache=True, max_workers=4, progress=None,
+                                cancel=None):
+    """ start downloading the localization files attached to an image, in 
+    parallel, each over its own RawFileStore
+
+    Parameters
+    ----------
+    image_url : str
+        url from OMERO web client, gotten typically by clicking the link symbol
+        with an image selected, i.e. `Link to this image`.
+    out_dir : str
+        path / name of tempfile.TemporaryDirectory. Unused for files served
+        from the download cache.
+    n_streams : int, optional
+        number of parallel range reads to download each file with, by default
+        1. Files are streamed to disk in `BUFF_SIZE` chunks either way.
+    use_cache : bool, optional
+        serve files from / add files to the persistent download cache (see
+        `pyme_omero.cache`), by default True. Cached files should be treated
+        as read-only.
+    max_workers : int, optional
+        number of files to download at once, by default 4
+    progress : callable, optional
+        called as progress(bytes_done, bytes_total), totalled over all files,
+        from the download threads
+    cancel : threading.Event, optional
+        set to abandon the downloads; those in flight stop within a chunk and
+        their futures raise `transfer.TransferCancelled`
 
-    with cli_login(*LOGIN_ARGS) as cli:
-        conn = BlitzGateway(client_obj=cli._client)
+    Returns
+    -------
+    futures : list
+        one concurrent.futures.Future per file, in the order the files were 
+        attached, each resolving to the path of the downloaded file. The first
+        file is started first, so it can be opened while the rest download. 
+        Parquet and Feather attachments (see 
+        `serialization.TABULAR_ENCODINGS`) are converted to .hdf files.
+    """
+    from concurrent.futures import ThreadPoolExecutor
 
-        # Would be nice to specify pyme.localizations namespace, but probably
-        # reliable to check file extentsion since one can manually attach
+    image_id = image_id_from_url(image_url)
+    pool = get_session_pool()
+    conn = pool.checkout()
+    try:
+        # Would be nice to specify pyme.localizations namespace, but more
+        # reliable to check file extension since one can manually attach
         # localizations with no namespace specified
+        og_files = attachments.file_annotations_on_image(
+            conn, image_id, extensions=LOCALIZATION_EXTENSIONS)
+    except:
+        pool.checkin(conn)
+        raise
+    
+    if len(og_files) == 0:
+        pool.checkin(conn)
+        return []
+    
+    total = transfer.TransferProgress(sum(f['size'] for f in og_files), 
+                                      progress, cancel)
+    # the connection is shared by the downloads, each on its own 
+    # RawFileStore, and returned to the pool once they have all finished
+    remaining = [len(og_files)]
+    remaining_lock = threading.Lock()
+    def release(future):
+        with remaining_lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+        pool.checkin(conn)
+    
+    executor = ThreadPoolExecutor(max_workers=max(1, max_workers), 
+                                  thread_name_prefix='omero-download')
+    futures = [executor.submit(_fetch_localization_file, conn, og_file, 
+                               out_dir, n_streams, use_cache, total)
+               for og_file in og_files]
+    executor.shutdown(wait=False)
+    for future in futures:
+        future.add_done_callback(release)
+    return futures
 
-        # localization_links = list(conn.getAnnotationLinks('Image', 
-        #                                              parent_ids=[image_id],
-        #                                              ns="pyme.localizations"))
-        
-        localization_links = list(conn.getAnnotationLinks('Image', 
-                                                            parent_ids=[image_id]))
-        
-        raw_file_store = conn.createRawFileStore()
+def localization_files_from_image_url(image_url, out_dir, n_streams=1, 
+                                      use_cache=True, max_workers=4, 
+                                      progress=None):
+    """ download the localization files attached to an image, see
+    `download_localization_files`
 
+    Returns
+    -------
+    localization_files : list
+        paths to localization files saved to disk, in the order they were
+        attached
+    """
+    futures = download_localization_files(image_url, out_dir, n_streams, 
+                                          use_cache, max_workers, progress)
+    return [future.result() for future in futures]
 
-        for link in localization_links:
-            try:  # select for Blitzwrapped omero types with getFile attr
-                og_file = link.getChild().getFile()._obj
-            except AttributeError:  # not all BlitzWrapped omero types have getFile
-                continue
+def _shared_connection_sources(list_files, open_one):
+    """ open a tabular source per file, all sharing one dedicated connection
+    which is closed once every source has been
 
-            filename = og_file.getName().getValue()
-            if os.path.splitext(filename)[-1] not in ['.hdf', '.h5r']:
+    Parameters
+    ----------
+    list_files : callable
+        called with the connection, returns the OriginalFile dicts to open
+    open_one : callable
+        called with (connection, OriginalFile dict, on_close) and returns a
+        (name, source) pair, the source calling on_close once closed, or None
+        to skip the file
+
+    Returns
+    -------
+    list
+        (name, source) pairs
+    """
+    # dedicated rather than pooled, as PYME pipelines hold sources open for
+    # as long as they are viewed
+    conn = get_session_pool().open_dedicated()
+    sources = []
+    open_sources = [0]
+    open_lock = threading.Lock()
+    def release():
+        with open_lock:
+            open_sources[0] -= 1
+            if open_sources[0] > 0:
+                return
+        conn.close()
+    
+    try:
+        for og_file in list_files(conn):
+            opened = open_one(conn, og_file, release)
+            if opened is None:
                 continue
-            path = os.path.join(out_dir, filename)
-            localization_files.append(path)
-            raw_file_store.setFileId(og_file.id.val)
-            with open(path, 'wb') as f:
-                f.write(raw_file_store.read(0, og_file.size.val))
-        
-        return localization_files
+            with open_lock:
+                open_sources[0] += 1
+            sources.append(opened)
+    except:
+        for name, source in sources:
+            source.close()
+        if len(sources) == 0:
+            conn.close()
+        raise
+    
+    if len(sources) == 0:
+        conn.close()
+    return sources
+
+def open_remote_localization_files(image_url, tablename='FitResults', 
+                                   **kwargs):
+    """ open the HDF5 localization files attached to an image where they are,
+    on the server, reading only the parts of them which are used rather than
+    downloading them first
+
+    Parameters
+    ----------
+    image_url : str
+        url from OMERO web client, gotten typically by clicking the link symbol
+        with an image selected, i.e. `Link to this image`.
+    tablename : str, optional
+        table to open in each file, by default 'FitResults'. Files without it
+        are skipped.
+    **kwargs
+        passed to `transfer.RawFileStoreReader`, e.g. cache_blocks, read_ahead
 
-def download_image(image_url, out_dir):
+    Returns
+    -------
+    list
+        (name, `pyme_omero.remote_tabular.RemoteHDFSource`) per file, in the
+        order the files were attached. The sources share a connection of
+        their own, which stays open until every source has been closed, so
+        callers must `close()` them.
+    """
+    from pyme_omero.remote_tabular import RemoteHDFSource
+
+    image_id = image_id_from_url(image_url)
+
+    def list_files(conn):
+        return attachments.file_annotations_on_image(
+            conn, image_id, extensions=['.h5r', '.hdf'])
+
+    def open_one(conn, og_file, on_close):
+        f = transfer.open_original_file(conn, og_file['file_id'], 
+                                        og_file['size'], **kwargs)
+        try:
+            source = RemoteHDFSource(f, tablename, on_close)
+        except (KeyError, IOError, OSError) as e:
+            f.close()
+            logger.warning('skipping %s: %s' % (og_file['name'], e))
+            return None
+        return os.path.splitext(og_file['name'])[0], source
+
+    return _shared_connection_sources(list_files, open_one)
+
+def open_localization_tables(image_url, columns=None, start=0, stop=None,
+                             where=None, variables=None, namespace=None):
+    """ open the OMERO.tables attached to an image (see
+    `upload_table_annotation`) as PYME tabular sources, fetching only the
+    chosen columns and rows
+
+    Parameters
+    ----------
+    image_url : str
+        url from OMERO web client, gotten typically by clicking the link symbol
+        with an image selected, i.e. `Link to this image`.
+    columns : list, optional
+        columns to read, by default all of them
+    start, stop : int, optional
+        range of rows to read, by default all of them
+    where : str, optional
+        server-side row selection, e.g. '(t >= 1000) & (t < 2000)', see
+        `tables.TableReader`
+    variables : dict, optional
+        values of variables in `where`
+    namespace : str, optional
+        annotation namespace of the tables, by default 
+        `tables.TABLE_NAMESPACE`
+
+    Returns
+    -------
+    list
+        (name, `pyme_omero.remote_tabular.OMEROTableSource`) per table, in
+        the order they were attached. The sources share a connection of
+        their own, which stays open until every source has been closed, so
+        callers must `close()` them.
+    """
+    from pyme_omero.remote_tabular import OMEROTableSource
+
+    if namespace is None:
+        namespace = tables.TABLE_NAMESPACE
+    image_id = image_id_from_url(image_url)
+
+    def list_files(conn):
+        return attachments.file_annotations_on_image(conn, image_id, 
+                                                     namespace=namespace)
+
+    def open_one(conn, og_file, on_close):
+        reader = tables.TableReader(conn, og_file['file_id'], start, stop, 
+                                    where, variables)
+        try:
+            return og_file['name'], OMEROTableSource(reader, columns, on_close)
+        except:
+            reader.close()
+            raise
+
+    return _shared_connection_sources(list_files, open_one)
+
+def _export_ome_tiff(image, path):
+    total_size, buff_generator = image.exportOmeTiff(BUFF_SIZE)
+    with open(path, 'wb') as f:
+        for buff in buff_generator:        
+            f.write(buff)
+    return path
+
+def download_image(image_url, out_dir, use_cache=True):
     """
 
     Parameters
@@ -298,34 +1476,37 @@ def download_image(image_url, out_dir):
         url from OMERO web client, gotten typically by clicking the link symbol
         with an image selected, i.e. `Link to this image`.
     out_dir : str
-        path / name of tempfile.TemporaryDirectory
+        path / name of tempfile.TemporaryDirectory. Unused if the image is
+        served from the download cache.
+    use_cache : bool, optional
+        serve the image from / add it to the persistent download cache (see
+        `pyme_omero.cache`), by default True. Cached files should be treated
+        as read-only.
 
     Returns
     -------
     path : str
         path to file saved to disk
     """
-    from urllib.parse import urlparse, parse_qs
-    from omero.util.populate_roi import DownloadingOriginalFileProvider
-
-    url = urlparse(image_url)
-    # for `Link to this image`
-    image_id = int(parse_qs(url.query)['show'][0].split('-')[-1])
-
-    with cli_login(*LOGIN_ARGS) as cli:
-        conn = BlitzGateway(client_obj=cli._client)
+    image_id = image_id_from_url(image_url)
 
+    with connection() as conn:
         image = conn.getObject("Image", image_id)
         
-        total_size, buff_generator = image.exportOmeTiff(BUFF_SIZE)
+        filename = os.path.splitext(image.getName())[0] + '.tif'
+        if not use_cache:
+            return _export_ome_tiff(image, os.path.join(out_dir, filename))
         
-        path = os.path.join(out_dir, 
-                            os.path.splitext(image.getName())[0] + '.tif')
-        with open(path, 'wb') as f:
-            for buff in buff_generator:        
-                f.write(buff)
-        
-        return path
+        # pixel data is immutable once imported, so any update to the image 
+        # (e.g. a rename) is a conservative signal to re-export
+        details = image._obj.getDetails()
+        update_event = details.getUpdateEvent()
+        fingerprint = _fingerprint(image.getName(), 
+                                   None if update_event is None 
+                                   else update_event.getId())
+        return cache.get_download_cache().get_or_fetch(
+            'Image', image_id, fingerprint, filename, 
+            partial(_export_ome_tiff, image), _server_name(conn))
 
 # conn = BlitzGateway(credentials['user'], credentials['password'], 
 #                     host=credentials['address'], port=credentials.get('port', 
@@ -16,14 +16,12 @@ class OMEROIO(Plugin):
         logging.debug('Adding menu items for OMERO loading')
 
         self.dsviewer.AddMenuItem('OMERO', 'Open', self.OnOpenOMERO)
+        self.dsviewer.AddMenuItem('OMERO', 'Open (download OME-TIFF)', 
+                                  self.OnOpenOMERODownload)
         self.dsviewer.AddMenuItem('OMERO', 'Save to OMERO', self.OnSaveToOMERO)
 
-    def OnOpenOMERO(self, wx_event=None):
-        # from pyme_omero.core import localization_files_from_image_url
-        from PYME.IO.image import ImageStack
-        from PYME.DSView import ViewIm3D
+    def _get_image_url(self):
         import wx
-        from pyme_omero.core import download_image
 
         dlg = wx.TextEntryDialog(self.dsviewer, 'OMERO URL', 
                                  'URL to OMERO image', '')
@@ -31,15 +29,14 @@ class OMEROIO(Plugin):
         if dlg.ShowModal() == wx.ID_OK:
             image_url = dlg.GetValue()
         else:
-            dlg.Destroy()
-            return
+            image_url = None
         
         dlg.Destroy()
-
-        path = download_image(image_url, self._tempdir.name)
-        logger.debug('temporary file path: %s' % path)
-
-        im = ImageStack(filename=path)
+        return image_url
+    
+    def _view(self, im):
+        from PYME.DSView import ViewIm3D
+        import wx
 
         dv = ViewIm3D(im, glCanvas=self.dsviewer.glCanvas, 
                       parent=wx.GetTopLevelParent(self.dsviewer))
@@ -47,6 +44,39 @@ class OMEROIO(Plugin):
         #set scaling to (0,1)
         for i in range(im.data.shape[3]):
             dv.do.Gains[i] = 1.0
+
+    def OnOpenOMERO(self, wx_event=None):
+        """ open an OMERO image lazily, fetching planes only as they are 
+        viewed
+        """
+        from PYME.IO.image import ImageStack
+        from PYME.IO.DataSources.BaseDataSource import XYZTCWrapper
+        from pyme_omero.omero_data_source import OMERODataSource
+
+        image_url = self._get_image_url()
+        if image_url is None:
+            return
+
+        ds = OMERODataSource.from_url(image_url)
+        data = XYZTCWrapper(ds, input_order='XYZTC', size_z=ds.size_z, 
+                            size_t=ds.size_t, size_c=ds.size_c)
+        im = ImageStack(data=data, mdh=ds.mdh, titleStub=ds.name)
+        self._view(im)
+
+    def OnOpenOMERODownload(self, wx_event=None):
+        """ download an OMERO image as an OME-TIFF and open it """
+        from PYME.IO.image import ImageStack
+        from pyme_omero.core import download_image
+
+        image_url = self._get_image_url()
+        if image_url is None:
+            return
+
+        path = download_image(image_url, self._tempdir.name)
+        logger.debug('temporary file path: %s' % path)
+
+        im = ImageStack(filename=path)
+        self._view(im)
     
     def OnSaveToOMERO(self, wx_event=None):
         from pyme_omero.recipe_modules import omero_upload
@@ -58,7 +88,8 @@ class OMEROIO(Plugin):
         rec = ModuleCollection()
         rec.namespace['input'] = self.image
 
-        uploader = omero_upload.ImageUpload(rec, input_image='input')
+        uploader = omero_upload.ImageUpload(rec, input_image='input',
+                                            background_upload=True)
         if uploader.configure_traits(kind='modal',
                                      view=uploader.no_localization_view):
             uploader.save(rec.namespace, context)
@@ -0,0 +1,252 @@
+"""
+How much work an import asks of the server, and how the file bytes get there.
+
+By default an import uploads every byte of the file, hashes it with SHA-1 on
+both ends, and has the server compute per-plane statistics and thumbnails. An
+`ImportPolicy` can turn thumbnails and statistics off, pick a cheaper checksum
+algorithm, and, where the client shares storage with the server's
+ManagedRepository (e.g. cluster nodes with the repository mounted), put the
+file in the repository by hardlink, symlink or local copy instead of sending it
+over the network, as `omero import --transfer=ln|ln_s|cp` does.
+
+Checksums are formatted as the server's checksum providers format them (Guava
+`HashCode.toString`, i.e. little-endian bytes in hex for the 32 bit
+checksums), since `verifyUpload` compares them as strings.
+"""
+
+import errno
+import hashlib
+import os
+import shutil
+import struct
+import zlib
+from functools import partial
+import logging
+
+logger = logging.getLogger(__name__)
+
+# values of omero.model.enums.ChecksumAlgorithm*
+SHA1_160 = 'SHA1-160'
+MD5_128 = 'MD5-128'
+ADLER_32 = 'Adler-32'
+CRC_32 = 'CRC-32'
+MURMUR3_32 = 'Murmur3-32'
+MURMUR3_128 = 'Murmur3-128'
+FILE_SIZE_64 = 'File-Size-64'
+
+# 'upload' sends the bytes through the import's RawFileStore, the others need
+# the ManagedRepository to be visible on the local filesystem
+TRANSFERS = ('upload', 'ln', 'ln_s', 'cp')
+READ_SIZE = 1048576
+
+
+class _Checksum32(object):
+    """ hashlib-style wrapper of a running zlib checksum """
+    def __init__(self, func):
+        self._func = func
+        self._value = func(b'')
+
+    def update(self, data):
+        self._value = self._func(data, self._value)
+
+    def hexdigest(self):
+        return struct.pack('<I', self._value & 0xffffffff).hex()
+
+
+class _Murmur3(object):
+    """ hashlib-style wrapper of an mmh3 hasher """
+    def __init__(self, bits):
+        try:
+            import mmh3
+        except ImportError:
+            raise ImportError('the Murmur3 checksums need the mmh3 package '
+                              '(pip install mmh3)')
+        self._hasher = mmh3.mmh3_32() if bits == 32 else mmh3.mmh3_x64_128()
+
+    def update(self, data):
+        self._hasher.update(data)
+
+    def hexdigest(self):
+        return self._hasher.digest().hex()
+
+
+class _FileSize64(object):
+    """ the file size, which costs nothing to compute but detects only
+    truncation """
+    def __init__(self):
+        self.size = 0
+
+    def update(self, data):
+        self.size += len(data)
+
+    def hexdigest(self):
+        return '%x' % self.size
+
+
+# algorithm -> factory of objects with update(bytes) and hexdigest()
+CHECKSUMS = {
+    SHA1_160: hashlib.sha1,
+    MD5_128: hashlib.md5,
+    ADLER_32: partial(_Checksum32, zlib.adler32),
+    CRC_32: partial(_Checksum32, zlib.crc32),
+    MURMUR3_32: partial(_Murmur3, 32),  # needs mmh3
+    MURMUR3_128: partial(_Murmur3, 128),  # needs mmh3
+    FILE_SIZE_64: _FileSize64,
+}
+
+
+class ImportPolicy(object):
+    def __init__(self, thumbnails=True, stats=True, checksum=SHA1_160,
+                 transfer='upload', repository_root=None):
+        """ options for file imports, see `core.file_import`
+
+        Parameters
+        ----------
+        thumbnails : bool, optional
+            have the server generate thumbnails during the import, by default
+            True. Without them they are generated on first view.
+        stats : bool, optional
+            have the server compute per-channel min / max during the import,
+            by default True
+        checksum : str, optional
+            one of `CHECKSUMS`, by default 'SHA1-160'. 'CRC-32' and 'Adler-32'
+            are several times faster to compute on both ends; 'File-Size-64'
+            skips hashing altogether. The Murmur3 checksums need the optional
+            `mmh3` package.
+        transfer : str, optional
+            one of `TRANSFERS`, by default 'upload'. 'ln' (hardlink), 'ln_s'
+            (symlink) and 'cp' place the file in the ManagedRepository from
+            the local filesystem. A hardlinked file must not be modified
+            afterwards (files on another filesystem to the repository are
+            copied instead), and a symlinked one must not be moved or deleted.
+        repository_root : str, optional
+            local path of the ManagedRepository, if mounted somewhere other
+            than where the server sees it. Only used by in-place transfers.
+        """
+        if checksum not in CHECKSUMS:
+            raise ValueError('unknown checksum algorithm %r, use one of %s' % (
+                checksum, sorted(CHECKSUMS)))
+        # fail here rather than at upload time if the checksum needs a
+        # package which isn't installed
+        CHECKSUMS[checksum]()
+        if transfer not in TRANSFERS:
+            raise ValueError('unknown transfer %r, use one of %s' % (
+                transfer, TRANSFERS))
+        self.thumbnails = thumbnails
+        self.stats = stats
+        self.checksum = checksum
+        self.transfer = transfer
+        self.repository_root = repository_root
+
+    def __repr__(self):
+        return ('ImportPolicy(thumbnails=%r, stats=%r, checksum=%r, '
+                'transfer=%r, repository_root=%r)' % (
+                    self.thumbnails, self.stats, self.checksum, self.transfer,
+                    self.repository_root))
+
+    @property
+    def in_place(self):
+        return self.transfer != 'upload'
+
+    def hasher(self):
+        """ new hash object, with update(bytes) and hexdigest(), computing
+        the checksum the server will verify
+        """
+        return CHECKSUMS[self.checksum]()
+
+    def file_checksum(self, path):
+        """ checksum of a local file """
+        if self.checksum == FILE_SIZE_64:
+            return '%x' % os.path.getsize(path)
+        hasher = self.hasher()
+        with open(path, 'rb') as f:
+            for block in iter(partial(f.read, READ_SIZE), b''):
+                hasher.update(block)
+        return hasher.hexdigest()
+
+    def apply(self, settings):
+        """ set thumbnail, statistics and checksum options on
+        omero.grid.ImportSettings
+        """
+        from omero.model import ChecksumAlgorithmI
+        from omero.rtypes import rbool, rstring
+        settings.doThumbnails = rbool(self.thumbnails)
+        settings.noStatsInfo = rbool(not self.stats)
+        settings.checksumAlgorithm = ChecksumAlgorithmI()
+        settings.checksumAlgorithm.value = rstring(self.checksum)
+        return settings
+
+    def repository_dir(self, client):
+        """ local path of the ManagedRepository
+
+        Parameters
+        ----------
+        client : omero.client
+            client of an open session
+
+        Returns
+        -------
+        str
+            `repository_root`, or where the server keeps the repository
+        """
+        if self.repository_root is not None:
+            return self.repository_root
+        root = client.getManagedRepository().root()
+        return os.path.join(root.getPath().getValue(), root.getName().getValue())
+
+    def transfer_file(self, store, path, repository_dir):
+        """ place a file in the ManagedRepository from the local filesystem,
+        rather than uploading it
+
+        Parameters
+        ----------
+        store : omero.api.RawFileStorePrx
+            uploader of the fileset entry, e.g. ImportProcess.getUploader(i),
+            closed here once the server has created the file
+        path : str
+            local file
+        repository_dir : str
+            local path of the ManagedRepository, see `repository_dir`
+
+        Returns
+        -------
+        str
+            checksum of the file, to pass to `verifyUpload`
+        """
+        try:
+            og_file = store.save()
+            location = os.path.join(repository_dir,
+                                    og_file.getPath().getValue(),
+                                    og_file.getName().getValue())
+            if os.path.lexists(location):
+                raise IOError('%s already exists in the repository' % location)
+            # have the server create the file, to check we are looking at the
+            # same directory it is
+            store.write(b'', 0, 0)
+        finally:
+            # as AbstractExecFileTransfer.checkLocation does, so the server
+            # has let go of the file before it is replaced
+            store.close()
+        if not os.path.exists(location):
+            raise IOError('%s was not created, is the ManagedRepository '
+                          'mounted at %s?' % (location, repository_dir))
+        if os.path.getsize(location) != 0:
+            raise IOError('%s was expected to be empty, but has %d bytes' % (
+                location, os.path.getsize(location)))
+        os.remove(location)
+
+        if self.transfer == 'ln':
+            try:
+                os.link(path, location)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                logger.warning('%s is on a different filesystem to the '
+                               'repository, copying it' % path)
+                shutil.copyfile(path, location)
+        elif self.transfer == 'ln_s':
+            os.symlink(os.path.abspath(path), location)
+        else:
+            shutil.copyfile(path, location)
+        logger.debug('%s %s -> %s' % (self.transfer, path, location))
+        return self.file_checksum(path)
@@ -42,10 +42,12 @@ https://github.com/openmicroscopy/openmicroscopy/blob/develop/components/tools/O
 """
 
 import argparse
+import hashlib
 import locale
 import os
 import platform
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import omero.clients
 from omero.cli import cli_login
@@ -57,6 +59,11 @@ from omero_version import omero_version
 from omero.callbacks import CmdCallbackI
 from omero.gateway import BlitzGateway
 
+from pyme_omero import metrics, resumable
+
+# ome.conditions.ApiUsageException: Max read size is: 1048576
+MAX_BLOCK_SIZE = 1048576
+
 
 def get_files_for_fileset(fs_path):
     if os.path.isfile(fs_path):
@@ -96,8 +103,10 @@ def create_fileset(files):
     return fileset
 
 
-def create_settings(name=None):
-    """Create ImportSettings and set some values."""
+def create_settings(name=None, policy=None):
+    """Create ImportSettings and set some values. Thumbnail, statistics and
+    checksum options are taken from `policy`, a
+    `pyme_omero.import_policy.ImportPolicy`, if given."""
     settings = omero.grid.ImportSettings()
     settings.doThumbnails = rbool(True)
     settings.noStatsInfo = rbool(False)
@@ -109,50 +118,102 @@ def create_settings(name=None):
     settings.checksumAlgorithm = ChecksumAlgorithmI()
     s = rstring(ChecksumAlgorithmSHA1160)
     settings.checksumAlgorithm.value = s
+    if policy is not None:
+        policy.apply(settings)
     return settings
 
 
-def upload_files(proc, files, client):
-    """Upload files to OMERO from local filesystem."""
-    ret_val = []
-    for i, fobj in enumerate(files):
-        rfs = proc.getUploader(i)
+def transfer_fileset_entry(proc, i, path, policy, repository_dir):
+    """Place the i-th file of a fileset in the ManagedRepository in place,
+    by hardlink, symlink or local copy as set by `policy`, rather than
+    uploading it."""
+    print ('Transferring (%s): %s' % (policy.transfer, path))
+    with metrics.span('transfer_in_place', file=os.path.basename(path),
+                      transfer=policy.transfer):
+        # transfer_file closes the uploader itself, before touching the file
+        return policy.transfer_file(proc.getUploader(i), path, repository_dir)
+
+
+def upload_fileset_entry(proc, i, path, block_size=MAX_BLOCK_SIZE, retries=2,
+                         progress=None, backoff=1., hasher=hashlib.sha1):
+    """Upload the i-th file of a fileset. If the transfer fails, a fresh
+    uploader is opened after an exponential backoff and the upload resumes
+    after the last block the server verifiably holds, see
+    `pyme_omero.resumable`. Returns the checksum computed by `hasher`."""
+    print ('Uploading: %s' % path)
+    journal = resumable.UploadJournal(path, min(int(block_size), MAX_BLOCK_SIZE))
+    with metrics.span('upload', os.path.getsize(path),
+                      file=os.path.basename(path)):
+        return resumable.upload_file_resumable(lambda: proc.getUploader(i), 
+                                               path, journal, retries, backoff,
+                                               progress=progress, hasher=hasher)
+
+
+def upload_files(proc, files, client=None, block_size=MAX_BLOCK_SIZE,
+                 max_workers=4, retries=2, progress=None, backoff=1.,
+                 policy=None):
+    """Upload files to OMERO from local filesystem.
+
+    Files are read once, hashed as they are sent. `block_size` is capped at
+    the server maximum, `MAX_BLOCK_SIZE`. Up to `max_workers` files of the
+    fileset are uploaded concurrently. A failed transfer is resumed up to
+    `retries` consecutive times, waiting `backoff` seconds, doubling, between
+    attempts. Hashes are returned in the order of `files`, as `verifyUpload`
+    expects. `policy`, a `pyme_omero.import_policy.ImportPolicy`, sets the
+    checksum algorithm and whether files are instead placed in the repository
+    in place, for which `client` is needed to locate it.
+    """
+    n_workers = max(1, min(max_workers, len(files)))
+    if policy is not None and policy.in_place:
+        repository_dir = policy.repository_dir(client)
+        transfer = lambda i, fobj: transfer_fileset_entry(proc, i, fobj, 
+                                                          policy, 
+                                                          repository_dir)
+    else:
+        hasher = hashlib.sha1 if policy is None else policy.hasher
+        transfer = lambda i, fobj: upload_fileset_entry(proc, i, fobj, 
+                                                        block_size, retries,
+                                                        progress, backoff,
+                                                        hasher)
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(transfer, i, fobj)
+                   for i, fobj in enumerate(files)]
         try:
-            with open(fobj, 'rb') as f:
-                print ('Uploading: %s' % fobj)
-                offset = 0
-                block = []
-                rfs.write(block, offset, len(block))  # Touch
-                while True:
-                    block = f.read(1000 * 1000)
-                    if not block:
-                        break
-                    rfs.write(block, offset, len(block))
-                    offset += len(block)
-                ret_val.append(client.sha1(fobj))
-        finally:
-            rfs.close()
-    return ret_val
-
-
-def assert_import(client, proc, files, wait):
-    """Wait and check that we imported an image."""
-    hashes = upload_files(proc, files, client)
+            return [future.result() for future in futures]
+        except:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def upload_and_verify(client, proc, files, block_size=MAX_BLOCK_SIZE,
+                      max_workers=4, policy=None):
+    """Upload the files of a fileset and start the server-side import.
+
+    Returns the handle of the import, which `wait_for_import` polls."""
+    hashes = upload_files(proc, files, client, block_size, max_workers,
+                          policy=policy)
     print ('Hashes:\n  %s' % '\n  '.join(hashes))
-    handle = proc.verifyUpload(hashes)
+    with metrics.span('verify_upload', n_files=len(files)):
+        return proc.verifyUpload(hashes)
+
+
+def wait_for_import(client, handle, wait):
+    """Wait and check that the server-side import produced an image."""
     cb = CmdCallbackI(client, handle)
 
     # https://github.com/openmicroscopy/openmicroscopy/blob/v5.4.9/components/blitz/src/ome/formats/importer/ImportLibrary.java#L631
     if wait == 0:
         cb.close(False)
         return None
-    if wait < 0:
-        while not cb.block(2000):
-            sys.stdout.write('.')
-            sys.stdout.flush()
-        sys.stdout.write('\n')
-    else:
-        cb.loop(wait, 1000)
+    with metrics.span('import_wait'):
+        if wait < 0:
+            while not cb.block(2000):
+                sys.stdout.write('.')
+                sys.stdout.flush()
+            sys.stdout.write('\n')
+        else:
+            cb.loop(wait, 1000)
     rsp = cb.getResponse()
     if isinstance(rsp, omero.cmd.ERR):
         raise Exception(rsp)
@@ -160,7 +221,15 @@ def assert_import(client, proc, files, wait):
     return rsp
 
 
-def full_import(client, fs_path, wait=-1):
+def assert_import(client, proc, files, wait, block_size=MAX_BLOCK_SIZE,
+                  max_workers=4):
+    """Wait and check that we imported an image."""
+    handle = upload_and_verify(client, proc, files, block_size, max_workers)
+    return wait_for_import(client, handle, wait)
+
+
+def full_import(client, fs_path, wait=-1, block_size=MAX_BLOCK_SIZE,
+                max_workers=4):
     """Re-usable method for a basic import."""
     mrepo = client.getManagedRepository()
     files = get_files_for_fileset(fs_path)
@@ -171,7 +240,8 @@ def full_import(client, fs_path, wait=-1):
 
     proc = mrepo.importFileset(fileset, settings)
     try:
-        return assert_import(client, proc, files, wait)
+        return assert_import(client, proc, files, wait, block_size,
+                             max_workers)
     finally:
         proc.close()
 
@@ -186,6 +256,8 @@ def main(argv):
     parser.add_argument('--wait', type=int, default=-1, help=(
         'Wait for this number of seconds for each import to complete. '
         '0: return immediately, -1: wait indefinitely (default)'))
+    parser.add_argument('--workers', type=int, default=4, help=(
+        'Number of files of a fileset to upload concurrently (default 4)'))
     parser.add_argument('path', nargs='+', help='Files or directories')
     args = parser.parse_args(argv)
 
@@ -197,7 +269,8 @@ def main(argv):
 
         for fs_path in args.path:
             print ('Importing: %s' % fs_path)
-            rsp = full_import(cli._client, fs_path, args.wait)
+            rsp = full_import(cli._client, fs_path, args.wait,
+                              max_workers=args.workers)
 
             if rsp:
                 links = []
@@ -0,0 +1,322 @@
+"""
+Timing and byte counts for OMERO operations.
+
+Each stage of an upload or download (login, container lookup, byte transfer,
+hashing, `verifyUpload`, waiting on the server-side import, ...) is recorded as
+a span, with its duration and the number of bytes it moved. Spans are kept in
+a bounded in-memory log and summarised into a histogram of durations per
+operation, which can be exported as JSON, logged, or written in the Prometheus
+text exposition format (e.g. for node_exporter's textfile collector).
+
+    with metrics.span('upload', n_bytes=size, file=name):
+        ...
+
+All of `pyme_omero` records to the shared registry returned by `get_metrics`.
+"""
+
+import bisect
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import logging
+
+logger = logging.getLogger(__name__)
+
+# [s] upper bounds of the duration histogram buckets; +Inf is implicit
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.,
+                   30., 60., 120., 300.)
+
+
+class Span(object):
+    def __init__(self, name, span_id, parent_id=None, n_bytes=0, labels=None):
+        """ one timed operation
+
+        Parameters
+        ----------
+        name : str
+            operation name, e.g. 'upload', which spans are histogrammed by
+        span_id : int
+            ID unique within the registry recording the span
+        parent_id : int, optional
+            ID of the span enclosing this one on the same thread
+        n_bytes : int, optional
+            bytes moved, can be added to with `add_bytes` as they are
+        labels : dict, optional
+            free-form details, e.g. a file name, included in JSON exports
+        """
+        self.name = name
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.n_bytes = n_bytes
+        self.labels = labels or {}
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+        self._t0 = time.perf_counter()
+
+    def add_bytes(self, n_bytes):
+        self.n_bytes += n_bytes
+
+    def finish(self, error=None):
+        self.duration = time.perf_counter() - self._t0
+        self.error = error
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'id': self.span_id,
+            'parent': self.parent_id,
+            'start': self.start,
+            'duration_s': self.duration,
+            'bytes': self.n_bytes,
+            'error': self.error,
+            'labels': self.labels,
+        }
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """ histogram of span durations for one operation, with totals of
+        time, bytes and errors. Bucket counts are stored per bucket and only
+        made cumulative on export.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last is +Inf
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+        self.n_bytes = 0
+        self.n_errors = 0
+
+    def observe(self, duration, n_bytes=0, error=False):
+        self.counts[bisect.bisect_left(self.buckets, duration)] += 1
+        self.count += 1
+        self.sum += duration
+        self.max = max(self.max, duration)
+        self.n_bytes += n_bytes
+        self.n_errors += bool(error)
+
+    def quantile(self, q):
+        """ estimate a quantile of the durations, by linear interpolation
+        within the bucket it falls in
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n > 0:
+                lower = self.buckets[i - 1] if i > 0 else 0.
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total_s': self.sum,
+            'mean_s': self.sum / self.count if self.count else None,
+            'p50_s': self.quantile(0.5),
+            'p95_s': self.quantile(0.95),
+            'max_s': self.max,
+            'bytes': self.n_bytes,
+            'MB_per_s': (self.n_bytes / 1e6 / self.sum
+                         if self.n_bytes and self.sum > 0 else None),
+            'errors': self.n_errors,
+        }
+
+
+class Metrics(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS, max_spans=10000):
+        """ thread-safe registry of spans and per-operation histograms
+
+        Parameters
+        ----------
+        buckets : tuple, optional
+            [s] histogram bucket upper bounds, by default `DEFAULT_BUCKETS`
+        max_spans : int, optional
+            number of most recent spans kept for export, by default 10000.
+            Histograms cover all spans regardless.
+        """
+        self.buckets = tuple(buckets)
+        self._spans = deque(maxlen=max_spans)
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._next_id = 0
+
+    @contextmanager
+    def span(self, name, n_bytes=0, **labels):
+        """ time the body of a `with` block as one operation
+
+        Parameters
+        ----------
+        name : str
+            operation name
+        n_bytes : int, optional
+            bytes moved, if known up front. Otherwise call `add_bytes` on the
+            span yielded.
+        **labels
+            details to record with the span, e.g. file='a.tif'
+
+        Yields
+        ------
+        Span
+            the span, which is recorded when the block exits, including if it
+            raises
+        """
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        with self._lock:
+            self._next_id += 1
+            span_id = self._next_id
+        span = Span(name, span_id, stack[-1] if stack else None, n_bytes,
+                    labels)
+        stack.append(span_id)
+        try:
+            yield span
+        except BaseException as e:
+            span.finish(error=type(e).__name__)
+            raise
+        else:
+            span.finish()
+        finally:
+            stack.pop()
+            self.record(span)
+
+    def record(self, span):
+        """ add a finished span """
+        with self._lock:
+            self._spans.append(span)
+            histogram = self._histograms.get(span.name)
+            if histogram is None:
+                histogram = self._histograms[span.name] = Histogram(
+                    self.buckets)
+            histogram.observe(span.duration, span.n_bytes, span.error)
+        logger.debug('%s took %.3f s (%d bytes)' % (span.name, span.duration,
+                                                     span.n_bytes))
+
+    def spans(self, name=None):
+        """ the most recent spans, oldest first, optionally of one operation """
+        with self._lock:
+            return [s for s in self._spans if name is None or s.name == name]
+
+    def summary(self):
+        """ dict of operation name -> histogram summary """
+        with self._lock:
+            return {name: h.summary()
+                    for name, h in sorted(self._histograms.items())}
+
+    def reset(self):
+        with self._lock:
+            self._spans.clear()
+            self._histograms.clear()
+
+    def to_json(self, include_spans=True):
+        """ JSON of the per-operation summaries and, optionally, the spans """
+        out = {'time': time.time(), 'operations': self.summary()}
+        if include_spans:
+            out['spans'] = [s.to_dict() for s in self.spans()]
+        return json.dumps(out)
+
+    def write_json(self, path, include_spans=True):
+        _write_atomic(path, self.to_json(include_spans))
+
+    def log_summary(self, level=logging.INFO):
+        for name, s in self.summary().items():
+            msg = '%s: %d calls, %.3f s total, mean %.3f s, p95 %.3f s' % (
+                name, s['count'], s['total_s'], s['mean_s'], s['p95_s'])
+            if s['bytes']:
+                msg += ', %.1f MB' % (s['bytes'] / 1e6)
+                if s['MB_per_s'] is not None:
+                    msg += ' (%.1f MB/s)' % s['MB_per_s']
+            if s['errors']:
+                msg += ', %d errors' % s['errors']
+            logger.log(level, msg)
+
+    def to_prometheus(self, prefix='pyme_omero'):
+        """ the histograms in the Prometheus text exposition format """
+        duration = prefix + '_operation_duration_seconds'
+        n_bytes = prefix + '_operation_bytes_total'
+        errors = prefix + '_operation_errors_total'
+        lines = ['# HELP %s Duration of OMERO operations.' % duration,
+                 '# TYPE %s histogram' % duration]
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            for name, h in histograms:
+                label = 'operation="%s"' % _escape_label(name)
+                cumulative = 0
+                for bound, count in zip(h.buckets + (float('inf'),), h.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (
+                        duration, label, le, cumulative))
+                lines.append('%s_sum{%s} %r' % (duration, label, h.sum))
+                lines.append('%s_count{%s} %d' % (duration, label, h.count))
+            lines += ['# HELP %s Bytes moved by OMERO operations.' % n_bytes,
+                      '# TYPE %s counter' % n_bytes]
+            lines += ['%s{operation="%s"} %d' % (n_bytes, _escape_label(name),
+                                                 h.n_bytes)
+                      for name, h in histograms]
+            lines += ['# HELP %s OMERO operations which raised.' % errors,
+                      '# TYPE %s counter' % errors]
+            lines += ['%s{operation="%s"} %d' % (errors, _escape_label(name),
+                                                 h.n_errors)
+                      for name, h in histograms]
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path, prefix='pyme_omero'):
+        """ write a .prom file, atomically so a textfile collector never reads
+        it half-written
+        """
+        _write_atomic(path, self.to_prometheus(prefix))
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _write_atomic(path, text):
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+_metrics = Metrics()
+
+def get_metrics():
+    """ the registry `pyme_omero` records its operations to """
+    return _metrics
+
+def span(name, n_bytes=0, **labels):
+    """ time an operation on the shared registry, see `Metrics.span` """
+    return _metrics.span(name, n_bytes, **labels)
+
+def export_at_exit(json_path=None, prometheus_path=None, log=True):
+    """ export the shared registry when the interpreter exits, e.g. at the end
+    of a batch upload script
+
+    Parameters
+    ----------
+    json_path : str, optional
+        file to write `Metrics.to_json` to
+    prometheus_path : str, optional
+        .prom file to write `Metrics.to_prometheus` to
+    log : bool, optional
+        log a per-operation summary at INFO level, by default True
+    """
+    import atexit
+
+    def export():
+        if log:
+            _metrics.log_summary()
+        if json_path is not None:
+            _metrics.write_json(json_path)
+        if prometheus_path is not None:
+            _metrics.write_prometheus(prometheus_path)
+    atexit.register(export)
@@ -0,0 +1,245 @@
+"""
+Plane-by-plane OME-BigTIFF writer, for images larger than memory, e.g. lazily
+loaded PYME ImageStacks backed by cluster or HDF5 series.
+
+Each plane is pulled from the data source, optionally compressed tile by tile
+on a worker pool, and written out before the next plane is read, so peak
+memory is about two planes (one as read, one re-ordered for writing, or its
+compressed tiles) whatever the stack size.
+
+The file is written strictly sequentially: each plane's IFD is written in
+front of its pixel data, once the plane is compressed and the sizes of its
+tiles are known, and points forward past that data to the next IFD. The writer
+therefore never seeks back, so it can feed a
+`pyme_omero.transfer.RawFileStoreWriter` as it goes and the upload's SHA-1 is
+computed as data is sent rather than by reading the file back.
+"""
+
+import struct
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from xml.sax.saxutils import quoteattr
+import logging
+
+logger = logging.getLogger(__name__)
+
+# compression name -> (TIFF Compression tag value, encoder)
+COMPRESSION = {
+    None: (1, None),
+    'zlib': (8, zlib.compress),  # 'Adobe deflate'
+}
+DEFAULT_TILE = 256
+
+# BigTIFF field types
+ASCII, SHORT, LONG, LONG8 = 2, 3, 4, 16
+_FORMATS = {SHORT: 'H', LONG: 'I', LONG8: 'Q'}
+# numpy dtype kind -> TIFF SampleFormat
+_SAMPLE_FORMATS = {'u': 1, 'i': 2, 'f': 3}
+
+OME_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06" \
+xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" \
+xsi:schemaLocation="http://www.openmicroscopy.org/Schemas/OME/2016-06 \
+http://www.openmicroscopy.org/Schemas/OME/2016-06/ome.xsd" \
+UUID="urn:uuid:%(uuid)s">\
+<Image ID="Image:0" Name=%(name)s>\
+<Pixels ID="Pixels:0" DimensionOrder="XYZCT" Type="%(type)s" \
+SizeX="%(x)d" SizeY="%(y)d" SizeZ="%(z)d" SizeC="%(c)d" SizeT="%(t)d"\
+%(physical)s BigEndian="false">\
+%(channels)s<TiffData IFD="0" PlaneCount="%(n_planes)d"/>\
+</Pixels></Image></OME>'''
+
+
+def _field(tag, field_type, values):
+    """ (tag, type, count, value bytes) of one IFD entry """
+    if field_type == ASCII:
+        payload = values.encode('utf-8') + b'\0'
+        return tag, field_type, len(payload), payload
+    return (tag, field_type, len(values),
+            struct.pack('<%d%s' % (len(values), _FORMATS[field_type]),
+                        *values))
+
+def _padded(n_bytes):
+    return n_bytes + n_bytes % 2
+
+def _ifd_size(fields):
+    """ bytes taken by an IFD and its out-of-line values """
+    return 16 + 20 * len(fields) + sum(_padded(len(f[3])) for f in fields
+                                       if len(f[3]) > 8)
+
+def _ifd(fields, offset, next_offset):
+    """ encode an IFD to be written at `offset`, followed by the values of
+    its entries which do not fit inline
+    """
+    fields = sorted(fields)
+    extra_offset = offset + 16 + 20 * len(fields)
+    entries, extra = [struct.pack('<Q', len(fields))], []
+    for tag, field_type, count, payload in fields:
+        if len(payload) <= 8:
+            value = payload.ljust(8, b'\0')
+        else:
+            value = struct.pack('<Q', extra_offset)
+            payload += b'\0' * (len(payload) % 2)
+            extra.append(payload)
+            extra_offset += len(payload)
+        entries.append(struct.pack('<HHQ', tag, field_type, count) + value)
+    entries.append(struct.pack('<Q', next_offset))
+    return b''.join(entries + extra)
+
+def ome_xml(shape, dtype, name='', voxelsize=None):
+    """ OME-XML describing a 5D (x, y, z, t, c) image stored as one IFD per
+    plane, z fastest, then c, then t
+
+    Parameters
+    ----------
+    shape : tuple
+        (size_x, size_y, size_z, size_t, size_c)
+    dtype : numpy.dtype
+        pixel type
+    name : str, optional
+        image name
+    voxelsize : tuple, optional
+        [um] (x, y, z) pixel sizes, any of which may be None
+
+    Returns
+    -------
+    str
+        OME-XML
+    """
+    from pyme_omero.pixels import PIXEL_TYPES
+
+    size_x, size_y, size_z, size_t, size_c = shape
+    physical = ''
+    for dim, size in zip('XYZ', voxelsize or ()):
+        if size is not None:
+            physical += ' PhysicalSize%s="%r"' % (dim, float(size))
+    channels = ''.join('<Channel ID="Channel:0:%d" SamplesPerPixel="1"/>' % c
+                       for c in range(size_c))
+    return OME_XML % {'uuid': uuid.uuid4(), 'name': quoteattr(name),
+                      'type': PIXEL_TYPES[dtype.name], 'x': size_x,
+                      'y': size_y, 'z': size_z, 'c': size_c, 't': size_t,
+                      'physical': physical, 'channels': channels,
+                      'n_planes': size_z * size_c * size_t}
+
+def _encode_tile_at(plane, tile, encode, yx):
+    import numpy as np
+    y, x = yx
+    data = plane[y:y + tile, x:x + tile]
+    if data.shape != (tile, tile):
+        # edge tiles are stored full size
+        padded = np.zeros((tile, tile), plane.dtype)
+        padded[:data.shape[0], :data.shape[1]] = data
+        data = padded
+    return encode(np.ascontiguousarray(data).tobytes())
+
+def write_ome_tiff(data, f, name='', voxelsize=None, compression=None,
+                   tile=DEFAULT_TILE, maxworkers=1):
+    """ write a 5D image as an OME-BigTIFF, one plane at a time
+
+    Parameters
+    ----------
+    data : array-like
+        5D (x, y, z, t, c) pixel data, e.g. `ImageStack.data_xyztc`, which
+        is only ever indexed one plane at a time
+    f : file
+        open, writable binary file. Written sequentially, never seeked.
+    name : str, optional
+        image name stored in the OME-XML
+    voxelsize : tuple, optional
+        [um] (x, y, z) pixel sizes, any of which may be None
+    compression : str, optional
+        None (uncompressed, one strip per plane) or 'zlib' (deflate
+        compressed tiles)
+    tile : int, optional
+        tile width and height when compressing, a multiple of 16, by default
+        `DEFAULT_TILE`
+    maxworkers : int, optional
+        number of threads compressing the tiles of each plane, by default 1
+
+    Returns
+    -------
+    int
+        bytes written
+    """
+    import numpy as np
+
+    try:
+        compression_tag, encode = COMPRESSION[compression]
+    except KeyError:
+        raise ValueError('unsupported compression %r, use one of %s' % (
+            compression, [c for c in COMPRESSION if c]))
+    if tile % 16:
+        raise ValueError('tile size must be a multiple of 16')
+
+    size_x, size_y, size_z, size_t, size_c = data.shape
+    dtype = np.dtype(data.dtype)
+    if dtype.kind == 'b':
+        dtype = np.dtype('u1')
+    dtype = dtype.newbyteorder('<')
+    planes = [(z, c, t) for t in range(size_t) for c in range(size_c)
+              for z in range(size_z)]
+
+    common = [_field(256, LONG, [size_x]), _field(257, LONG, [size_y]),
+              _field(258, SHORT, [8 * dtype.itemsize]),
+              _field(259, SHORT, [compression_tag]),
+              _field(262, SHORT, [1]),  # min-is-black
+              _field(277, SHORT, [1]), _field(284, SHORT, [1]),
+              _field(339, SHORT, [_SAMPLE_FORMATS[dtype.kind]])]
+    if encode is None:
+        common.append(_field(278, LONG, [size_y]))
+        offsets_tag, counts_tag = 273, 279
+        grid = []
+    else:
+        common += [_field(322, LONG, [tile]), _field(323, LONG, [tile])]
+        offsets_tag, counts_tag = 324, 325
+        grid = [(y, x) for y in range(0, size_y, tile)
+                for x in range(0, size_x, tile)]
+    description = [_field(270, ASCII, ome_xml(data.shape, dtype, name,
+                                              voxelsize))]
+
+    f.write(struct.pack('<2sHHHQ', b'II', 43, 8, 0, 16))
+    pos = 16
+    pool = ThreadPoolExecutor(max_workers=maxworkers,
+                              thread_name_prefix='ome-tiff-encode') \
+        if encode is not None and maxworkers > 1 else None
+    try:
+        for i, (z, c, t) in enumerate(planes):
+            plane = np.asarray(data[:, :, z, t, c]).reshape(size_x,
+                                                            size_y).T
+            plane = plane.astype(dtype, copy=False)
+            if encode is None:
+                chunks = [memoryview(np.ascontiguousarray(plane)).cast('B')]
+            else:
+                encode_tile = partial(_encode_tile_at, plane, tile, encode)
+                chunks = list(map(encode_tile, grid) if pool is None
+                              else pool.map(encode_tile, grid))
+                del encode_tile
+            del plane
+
+            def fields(offsets):
+                return (common + (description if i == 0 else []) +
+                        [_field(offsets_tag, LONG8, offsets),
+                         _field(counts_tag, LONG8,
+                                [len(chunk) for chunk in chunks])])
+
+            data_offset = pos + _ifd_size(fields([0] * len(chunks)))
+            offsets = [data_offset]
+            for chunk in chunks[:-1]:
+                offsets.append(offsets[-1] + len(chunk))
+            data_end = data_offset + sum(len(chunk) for chunk in chunks)
+            next_offset = 0 if i == len(planes) - 1 else _padded(data_end)
+
+            f.write(_ifd(fields(offsets), pos, next_offset))
+            for chunk in chunks:
+                f.write(chunk)
+            chunks = chunk = None  # before the next plane is read
+            if data_end % 2:
+                f.write(b'\0')  # IFDs start on word boundaries
+            pos = _padded(data_end)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    logger.debug('wrote %d planes, %d bytes' % (len(planes), pos))
+    return pos
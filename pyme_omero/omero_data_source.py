@@ -0,0 +1,245 @@
+"""
+PYME data source reading planes from an OMERO image on demand, rather than
+exporting and downloading the whole image as an OME-TIFF first.
+
+Planes are fetched through a RawPixelsStore (as tiles for images too large to
+fetch a plane at once), kept in an LRU cache, and neighbouring z / t planes are
+prefetched in the background.
+"""
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PYME.IO.DataSources.BaseDataSource import BaseDataSource
+import logging
+
+logger = logging.getLogger(__name__)
+
+PIXEL_TYPES = {
+    'bit': np.uint8,  # unpacked from 8 pixels per byte, see `_decode`
+    'int8': np.int8,
+    'uint8': np.uint8,
+    'int16': np.int16,
+    'uint16': np.uint16,
+    'int32': np.int32,
+    'uint32': np.uint32,
+    'float': np.float32,
+    'double': np.float64,
+}
+
+
+class OMERODataSource(BaseDataSource):
+    moduleName = 'OMERODataSource'
+
+    def __init__(self, image_id, cache_planes=64, prefetch=1, pool=None):
+        """
+
+        Parameters
+        ----------
+        image_id : int
+            OMERO image ID
+        cache_planes : int, optional
+            number of planes to keep in memory, by default 64
+        prefetch : int, optional
+            how many planes either side of the last requested one (in z and t)
+            to fetch in the background, by default 1. 0 disables prefetching.
+        pool : pyme_omero.connection.SessionPool, optional
+            pool whose factory opens the data source's own connection, by
+            default that of `pyme_omero.core`. The connection is dedicated
+            rather than checked out, as a data source stays open for as long
+            as it is viewed, and is closed by `release`.
+
+        Notes
+        -----
+        Slices are ordered XYZTC, i.e. slice index = z + size_z * (t + size_t * c),
+        so wrap in PYME.IO.DataSources.BaseDataSource.XYZTCWrapper with
+        input_order='XYZTC' to get a 5D data source.
+        """
+        if pool is None:
+            from pyme_omero import core
+            pool = core.get_session_pool()
+
+        self.image_id = image_id
+        self.cache_planes = cache_planes
+        self.prefetch = prefetch
+
+        self._conn = pool.open_dedicated()
+        try:
+            image = self._conn.getObject('Image', image_id)
+            if image is None:
+                raise IOError('Image %d not found' % image_id)
+            self.name = image.getName()
+            self.size_x, self.size_y = image.getSizeX(), image.getSizeY()
+            self.size_z, self.size_t = image.getSizeZ(), image.getSizeT()
+            self.size_c = image.getSizeC()
+            pixels_type = image.getPixelsType()
+            self.dtype = np.dtype(PIXEL_TYPES[pixels_type])
+            self._bits = pixels_type == 'bit'
+            self.voxelsize = (image.getPixelSizeX(), image.getPixelSizeY(),
+                              image.getPixelSizeZ())
+
+            self._store = self._conn.c.sf.createRawPixelsStore()
+            self._store.setPixelsId(image.getPixelsId(), True)
+            self._tiled = self._store.requiresPixelsPyramid()
+            if self._tiled:
+                self._tile_size = self._store.getTileSize()
+        except:
+            self._conn.close()
+            raise
+
+        self._lock = threading.Lock()  # serialize calls on the stateful store
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._pending = {}
+        self._prefetcher = ThreadPoolExecutor(max_workers=1,
+                                              thread_name_prefix='omero-prefetch')
+        self.n_fetched = 0
+
+    @classmethod
+    def from_url(cls, image_url, **kwargs):
+        """ open an image from its OMERO web `Link to this image` url """
+        from pyme_omero.core import image_id_from_url
+        return cls(image_id_from_url(image_url), **kwargs)
+
+    @property
+    def mdh(self):
+        from PYME.IO import MetaDataHandler
+        mdh = MetaDataHandler.NestedClassMDHandler()
+        for dim, size in zip('xyz', self.voxelsize):
+            if size is not None:
+                mdh['voxelsize.%s' % dim] = size  # [um]
+        mdh['voxelsize.units'] = 'um'
+        mdh['OMERO.ImageID'] = self.image_id
+        mdh['OMERO.ImageName'] = self.name
+        return mdh
+
+    def getSliceShape(self):
+        return (self.size_x, self.size_y)
+
+    def getNumSlices(self):
+        return self.size_z * self.size_t * self.size_c
+
+    def getEvents(self):
+        return []
+
+    def _zct(self, ind):
+        z = ind % self.size_z
+        t = (ind // self.size_z) % self.size_t
+        c = ind // (self.size_z * self.size_t)
+        return z, c, t
+
+    def getSlice(self, ind):
+        z, c, t = self._zct(ind)
+        plane = self.get_plane(z, c, t)
+        self._prefetch_neighbours(z, c, t)
+        return plane
+
+    def get_plane(self, z, c, t):
+        """ get a single plane, from the cache if possible
+
+        Returns
+        -------
+        numpy.ndarray
+            (size_x, size_y) plane, indexed x, y as PYME expects
+        """
+        key = (z, c, t)
+        with self._cache_lock:
+            try:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            except KeyError:
+                pending = self._pending.get(key)
+
+        if pending is not None:  # already being prefetched
+            return pending.result()
+
+        return self._fetch_and_cache(key)
+
+    def get_tile(self, z, c, t, x, y, w, h):
+        """ fetch a (w, h) region of a plane without caching it
+
+        Returns
+        -------
+        numpy.ndarray
+            (w, h) tile, indexed x, y
+        """
+        with self._lock:
+            buf = self._store.getTile(z, c, t, x, y, w, h)
+        return self._decode(buf, w, h)
+
+    def _decode(self, buf, w, h):
+        # RawPixelsStore returns big-endian bytes, (h, w) row-major
+        if self._bits:
+            # packed 8 pixels to a byte, most significant bit first
+            data = np.unpackbits(np.frombuffer(buf, dtype=np.uint8),
+                                 count=w * h)
+        else:
+            data = np.frombuffer(buf, dtype=self.dtype.newbyteorder('>'))
+        return data.astype(self.dtype).reshape(h, w).T
+
+    def _fetch(self, z, c, t):
+        if not self._tiled:
+            with self._lock:
+                buf = self._store.getPlane(z, c, t)
+            self.n_fetched += 1
+            return self._decode(buf, self.size_x, self.size_y)
+
+        plane = np.empty((self.size_x, self.size_y), dtype=self.dtype)
+        tile_w, tile_h = self._tile_size
+        for y in range(0, self.size_y, tile_h):
+            for x in range(0, self.size_x, tile_w):
+                w = min(tile_w, self.size_x - x)
+                h = min(tile_h, self.size_y - y)
+                plane[x:x + w, y:y + h] = self.get_tile(z, c, t, x, y, w, h)
+        self.n_fetched += 1
+        return plane
+
+    def _fetch_and_cache(self, key):
+        plane = self._fetch(*key)
+        with self._cache_lock:
+            self._cache[key] = plane
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_planes:
+                self._cache.popitem(last=False)
+        return plane
+
+    def _prefetch_neighbours(self, z, c, t):
+        steps = [d for d in range(-self.prefetch, self.prefetch + 1) if d != 0]
+        for dz, dt in [(d, 0) for d in steps] + [(0, d) for d in steps]:
+            key = (z + dz, c, t + dt)
+            if not (0 <= key[0] < self.size_z and 0 <= key[2] < self.size_t):
+                continue
+            with self._cache_lock:
+                if key in self._cache or key in self._pending:
+                    continue
+                try:
+                    future = self._prefetcher.submit(self._fetch_and_cache, key)
+                except RuntimeError:  # released
+                    return
+                self._pending[key] = future
+            future.add_done_callback(lambda f, key=key: self._done_prefetch(key))
+
+    def _done_prefetch(self, key):
+        with self._cache_lock:
+            self._pending.pop(key, None)
+
+    def release(self):
+        """ close the RawPixelsStore and the data source's connection """
+        if self._conn is None:
+            return
+        self._prefetcher.shutdown(wait=True)
+        try:
+            self._store.close()
+        finally:
+            self._conn.close()
+            self._conn = None
+
+    def reloadData(self):
+        pass
+
+    def __del__(self):
+        try:
+            self.release()
+        except Exception:
+            pass
@@ -0,0 +1,204 @@
+"""
+Direct pixel upload: create an Image and its Pixels server-side and write the
+planes of an in-memory array through RawPixelsStores, bypassing the
+ManagedRepository import.
+
+The import path (`core.file_import`) serializes the image to a file which the
+server then has to detect the format of, read, and generate statistics and
+thumbnails for, which takes seconds per image. Here the server only stores the
+planes, which are written in parallel, one RawPixelsStore per worker. Channel
+min / max are computed client-side as planes are written; thumbnails are
+generated by the server on first view.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+logger = logging.getLogger(__name__)
+
+# numpy dtype name -> OMERO PixelsType value
+PIXEL_TYPES = {
+    'int8': 'int8',
+    'uint8': 'uint8',
+    'int16': 'int16',
+    'uint16': 'uint16',
+    'int32': 'int32',
+    'uint32': 'uint32',
+    'float32': 'float',
+    'float64': 'double',
+    'bool': 'uint8',
+}
+# planes larger than this are written as horizontal bands with setTile, to
+# stay well within the default 64 MB Ice message size limit
+MAX_MESSAGE_BYTES = 16 * 1024 ** 2
+
+PIXELS_TYPE_BY_VALUE = 'from PixelsType as p where p.value = :value'
+PIXELS_OF_IMAGE = 'select p from Pixels p where p.image.id = :iid'
+
+
+def _find(connection, hql, **kwargs):
+    from omero.sys import ParametersI
+    params = ParametersI()
+    for key, value in kwargs.items():
+        if isinstance(value, str):
+            params.addString(key, value)
+        else:
+            params.addLong(key, value)
+    return connection.getQueryService().findByQuery(hql, params,
+                                                    connection.SERVICE_OPTS)
+
+def create_image(connection, name, shape, dtype, voxelsize=None,
+                 description=''):
+    """ create an empty Image server-side
+
+    Parameters
+    ----------
+    connection : omero.gateway.BlitzGateway
+        an open connection to an OMERO server
+    name : str
+        image name
+    shape : tuple
+        (size_x, size_y, size_z, size_t, size_c)
+    dtype : numpy.dtype
+        pixel type, one of `PIXEL_TYPES`
+    voxelsize : tuple, optional
+        [um] (x, y, z) pixel sizes, any of which may be None
+    description : str, optional
+        image description
+
+    Returns
+    -------
+    image_id : int
+        ID of the Image
+    pixels_id : int
+        ID of its Pixels
+    """
+    import numpy as np
+    import omero.model
+    from omero.model.enums import UnitsLength
+
+    size_x, size_y, size_z, size_t, size_c = shape
+    try:
+        pixels_type_value = PIXEL_TYPES[np.dtype(dtype).name]
+    except KeyError:
+        raise TypeError('OMERO has no pixel type for %s' % dtype)
+    pixels_type = _find(connection, PIXELS_TYPE_BY_VALUE,
+                        value=pixels_type_value)
+    image_id = connection.getPixelsService().createImage(
+        size_x, size_y, size_z, size_t, list(range(size_c)), pixels_type,
+        name, description, connection.SERVICE_OPTS).getValue()
+
+    pixels = _find(connection, PIXELS_OF_IMAGE, iid=image_id)
+    if voxelsize is not None and any(v is not None for v in voxelsize):
+        for setter, size in zip([pixels.setPhysicalSizeX,
+                                 pixels.setPhysicalSizeY,
+                                 pixels.setPhysicalSizeZ], voxelsize):
+            if size is not None:
+                setter(omero.model.LengthI(float(size),
+                                           UnitsLength.MICROMETER))
+        pixels = connection.getUpdateService().saveAndReturnObject(
+            pixels, connection.SERVICE_OPTS)
+    return image_id, pixels.getId().getValue()
+
+def _plane_bytes(data, z, c, t):
+    import numpy as np
+    # XY-indexed plane -> the big-endian, row-major (y, x) bytes OMERO stores
+    plane = np.asarray(data[:, :, z, t, c]).reshape(data.shape[:2]).T
+    return plane, plane.astype(plane.dtype.newbyteorder('>')).tobytes()
+
+def _write_planes(connection, pixels_id, data, planes, extrema, lock):
+    store = connection.c.sf.createRawPixelsStore()
+    try:
+        store.setPixelsId(pixels_id, True, connection.SERVICE_OPTS)
+        size_x, size_y = data.shape[:2]
+        for z, c, t in planes:
+            plane, buf = _plane_bytes(data, z, c, t)
+            if len(buf) <= MAX_MESSAGE_BYTES:
+                store.setPlane(buf, z, c, t, connection.SERVICE_OPTS)
+            else:
+                row_bytes = len(buf) // size_y
+                rows = max(1, MAX_MESSAGE_BYTES // row_bytes)
+                for y in range(0, size_y, rows):
+                    h = min(rows, size_y - y)
+                    store.setTile(buf[y * row_bytes:(y + h) * row_bytes], z,
+                                  c, t, 0, y, size_x, h,
+                                  connection.SERVICE_OPTS)
+            lo, hi = float(plane.min()), float(plane.max())
+            with lock:
+                old_lo, old_hi = extrema.get(c, (lo, hi))
+                extrema[c] = (min(lo, old_lo), max(hi, old_hi))
+        store.save(connection.SERVICE_OPTS)
+    finally:
+        store.close()
+    return len(planes)
+
+def upload_pixels(connection, name, data, voxelsize=None, description='',
+                  max_workers=4):
+    """ create an Image from an in-memory array, without a file import
+
+    Parameters
+    ----------
+    connection : omero.gateway.BlitzGateway
+        an open connection to an OMERO server
+    name : str
+        image name
+    data : array-like
+        5D (x, y, z, t, c) pixel data, e.g. `ImageStack.data_xyztc`. Planes
+        are read one at a time, so this can be lazily loaded.
+    voxelsize : tuple, optional
+        [um] (x, y, z) pixel sizes
+    description : str, optional
+        image description
+    max_workers : int, optional
+        number of planes to write at once, each on its own RawPixelsStore,
+        by default 4
+
+    Returns
+    -------
+    int
+        image ID
+
+    Notes
+    -----
+    If writing the planes fails the new image is deleted before the error is
+    re-raised.
+    """
+    from pyme_omero import metrics
+
+    shape = tuple(data.shape)
+    size_x, size_y, size_z, size_t, size_c = shape
+    planes = [(z, c, t) for t in range(size_t) for c in range(size_c)
+              for z in range(size_z)]
+    n_workers = max(1, min(max_workers, len(planes)))
+
+    with metrics.span('pixels_upload', n_bytes=data.dtype.itemsize *
+                      size_x * size_y * len(planes), image=name):
+        image_id, pixels_id = create_image(connection, name, shape,
+                                           data.dtype, voxelsize, description)
+        try:
+            extrema = {}
+            lock = threading.Lock()
+            with ThreadPoolExecutor(max_workers=n_workers,
+                                    thread_name_prefix='omero-pixels') as pool:
+                futures = [pool.submit(_write_planes, connection, pixels_id,
+                                       data, planes[i::n_workers], extrema,
+                                       lock)
+                           for i in range(n_workers)]
+                n_written = sum(future.result() for future in futures)
+
+            pixels_service = connection.getPixelsService()
+            for c, (lo, hi) in sorted(extrema.items()):
+                pixels_service.setChannelGlobalMinMax(pixels_id, c, lo, hi,
+                                                      connection.SERVICE_OPTS)
+        except Exception:
+            # don't leave an empty, orphaned image behind
+            logger.error('writing image %d failed, deleting it' % image_id)
+            try:
+                connection.deleteObjects('Image', [image_id], wait=True)
+            except Exception:
+                logger.exception('could not delete image %d' % image_id)
+            raise
+    logger.debug('wrote %d planes of image %d over %d stores' % (
+        n_written, image_id, n_workers))
+    return image_id
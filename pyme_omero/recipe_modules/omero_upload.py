@@ -1,8 +1,11 @@
 
 from PYME.recipes.base import register_module, OutputModule
 from PYME.recipes.output import RGBImageOutput
-from PYME.recipes.traits import DictStrStr, CStr, Input, Output, Enum, Float, Int, Bool
+from PYME.recipes.traits import DictStrStr, CStr, Input, Output, Enum, Float, Int, Bool, List
 import os
+import logging
+
+logger = logging.getLogger(__name__)
 
 class Sample(object):
     pass
@@ -31,6 +34,43 @@ class ImageUpload(OutputModule):
         name of OMERO project to link the dataset to. If the project does not
         already exist it will be created. Can use sample metadata entries
         using {format} syntax
+    background_upload : bool
+        submit the upload to the background upload queue and return
+        immediately rather than blocking until the server-side import is done.
+        See `pyme_omero.upload_queue`.
+    stream_upload : bool
+        serialize the image and attachments straight to the OMERO server
+        rather than writing them to temporary files first. A principle input
+        on the cluster is streamed from the cluster into its attachment.
+        Localization attachments are serialized in memory first, taking
+        about twice their encoded size, see 
+        `pyme_omero.serialization.tabular_to_hdf_bytes`.
+    attachment_encoding : str
+        how to serialize localization attachments. 'hdf' is what `to_hdf`
+        writes, 'hdf-blosc' and 'hdf-zstd' are compressed HDF5 which PyTables
+        decompresses transparently, and 'parquet' and 'feather' are zstd
+        compressed columnar formats which `core.localization_files_from_image_url`
+        converts back to HDF5 on download.
+    downcast_attachments : bool
+        store columns in narrower types where that is lossless, e.g. float64
+        columns holding float32 values. See 
+        `pyme_omero.serialization.downcast_lossless`.
+    localization_storage : str
+        'file' attaches localizations as files, encoded as set by
+        `attachment_encoding`. 'omero-table' stores them as OMERO.tables
+        instead, which can be queried for chosen columns and rows without
+        downloading them, see `pyme_omero.core.open_localization_tables`.
+    upload_backend : str
+        'import' uploads an image file which the server imports. 'pixels'
+        creates the image server-side and writes its planes directly, in
+        parallel, skipping the file and the server-side import, see
+        `pyme_omero.pixels`. `stream_upload` does not apply to 'pixels'.
+    image_compression : str
+        images are written plane by plane as OME-BigTIFF, so stacks larger
+        than memory can be uploaded, see `pyme_omero.ome_tiff`. 'zlib'
+        compresses them tile by tile.
+    compression_workers : int
+        number of threads compressing tiles
     
     Notes
     -----
@@ -56,30 +96,42 @@ class ImageUpload(OutputModule):
     omero_project = CStr('')
     omero_dataset = CStr('{Sample.SlideRef}')
 
+    background_upload = Bool(False)
+    stream_upload = Bool(False)
+    attachment_encoding = Enum(['hdf', 'hdf-blosc', 'hdf-zstd', 'parquet', 
+                                'feather'])
+    downcast_attachments = Bool(False)
+    localization_storage = Enum(['file', 'omero-table'])
+    upload_backend = Enum(['import', 'pixels'])
+    image_compression = Enum(['none', 'zlib'])
+    compression_workers = Int(4)
+
     def _save(self, image, path):
         # force tif extension
         path = os.path.splitext(path)[0] + '.tif'
-        image.Save(path)
-
-    def save(self, namespace, context={}):
-        """
-        Parameters
-        ----------
-        namespace : dict
-            The recipe namespace
-        context : dict
-            Information about the source file to allow pattern substitution to 
-            generate the output name. At least 'file_stub' (which is the 
-            filename without any extension) should be resolved.
+        with open(path, 'wb') as f:
+            self._write(image, f)
+    
+    def _stream_name(self, name):
+        return os.path.splitext(name)[0] + '.tif'
 
-        """
-        from pyme_omero import core
-        from tempfile import TemporaryDirectory
-        
-        out_filename = self.filePattern.format(**context)
+    def _write(self, image, f):
+        from pyme_omero import serialization
+        compression = None if self.image_compression == 'none' \
+            else self.image_compression
+        serialization.write_image_tiff(image, f, compression, 
+                                       self.compression_workers)
 
-        im = namespace[self.input_image]
+    def _pixels(self, image):
+        """ 5D (x, y, z, t, c) pixel data and [um] voxel size to upload """
+        try:
+            voxelsize = tuple(v / 1e3 for v in image.voxelsize_nm[:3])
+        except (AttributeError, KeyError):
+            voxelsize = None
+        return image.data_xyztc, voxelsize
 
+    def _targets(self, im):
+        """ resolve the OMERO dataset and project names for an image """
         if hasattr(im, 'mdh'):
             sample = Sample()  # hack around our md keys having periods in them
             for k in [k for k in im.mdh.keys() if k.startswith('Sample.')]:
@@ -90,36 +142,234 @@ class ImageUpload(OutputModule):
         
         dataset = self.omero_dataset.format(**sample_md)
         project = self.omero_project.format(**sample_md)
+        return dataset, project
 
-        with TemporaryDirectory() as temp_dir:
-            out_filename = os.path.join(temp_dir, out_filename)
-            self._save(im, out_filename)
-
-            loc_filenames = []
+    def _write_files(self, namespace, context, temp_dir):
+        """ save the image and localization attachments into temp_dir """
+        out_filename = self.filePattern.format(**context)
+        out_filename = os.path.join(temp_dir, out_filename)
+        self._save(namespace[self.input_image], out_filename)
+        return out_filename, self._write_attachment_files(namespace, temp_dir)
+    
+    def _write_attachment_files(self, namespace, temp_dir):
+        """ save the localization attachments into temp_dir """
+        from pyme_omero import serialization
+        loc_filenames = []
+        for loc_key, loc_stub in self._file_attachments():
+            loc_filename = os.path.join(temp_dir, 
+                                        self._attachment_name(loc_stub))
+            loc_filenames.append(loc_filename)
+            try:
+                mdh = namespace[loc_key].mdh
+            except AttributeError:
+                mdh = None
+            serialization.save_tabular(namespace[loc_key], loc_filename, 
+                                       loc_key, mdh, self.attachment_encoding,
+                                       self.downcast_attachments)
+        return loc_filenames
+    
+    def _file_attachments(self):
+        """ (namespace key, name) of localizations to attach as files """
+        if self.localization_storage != 'file':
+            return []
+        return list(self.input_localization_attachments.items())
+    
+    def _table_attacher(self, namespace):
+        """ function of image ID storing localizations as OMERO.tables
+        attached to the image, if that is how they are to be stored
+        """
+        from pyme_omero import core
+        
+        to_store = []
+        if self.localization_storage == 'omero-table':
             for loc_key, loc_stub in self.input_localization_attachments.items():
-                loc_filename = os.path.join(temp_dir, loc_stub)
-                if os.path.splitext(loc_filename)[-1] == '':
-                    # default to hdf unless h5r is manually specified
-                    loc_filename = loc_filename + '.hdf'
-                loc_filenames.append(loc_filename)
                 try:
                     mdh = namespace[loc_key].mdh
                 except AttributeError:
                     mdh = None
-                namespace[loc_key].to_hdf(loc_filename, loc_key, metadata=mdh)
-            
+                to_store.append((namespace[loc_key], 
+                                 os.path.splitext(loc_stub)[0], mdh))
+        
+        def attach_tables(image_id):
+            if image_id is None:
+                return
+            for tabular, name, mdh in to_store:
+                core.connect_and_upload_table_annotation(image_id, tabular, 
+                                                         name, mdh)
+        
+        return attach_tables
+    
+    def _attacher(self, namespace, context):
+        """ function of image ID attaching everything other than the files
+        uploaded along with the image
+        """
+        attach_tables = self._table_attacher(namespace)
+        attach_principle = self._principle_attacher(context)
+
+        def attach(image_id):
+            attach_tables(image_id)
+            attach_principle(image_id)
+        
+        return attach
+    
+    def _attachment_name(self, loc_stub):
+        from pyme_omero import serialization
+        ext = serialization.tabular_extension(self.attachment_encoding)
+        stub, given_ext = os.path.splitext(loc_stub)
+        if ext != '.hdf':  # columnar formats need their own extension
+            return stub + ext
+        # default to hdf unless h5r is manually specified
+        return loc_stub if given_ext else loc_stub + ext
+    
+    def _principle(self, context):
+        """ path to the h5r file which is the principle input, if any """
+        try:
+            return os.path.join(context['input_dir'], 
+                                context['file_stub']) + '.h5r'
+        except KeyError:
+            return None
+
+    def _stream_outputs(self, namespace, context):
+        """ (name, write) pairs serializing the image and localization 
+        attachments straight to the server
+        """
+        from pyme_omero import serialization
+        from functools import partial
+
+        out_name = self._stream_name(self.filePattern.format(**context))
+        image = (out_name, partial(self._write, namespace[self.input_image]))
+
+        attachments = []
+        for loc_key, loc_stub in self._file_attachments():
+            try:
+                mdh = namespace[loc_key].mdh
+            except AttributeError:
+                mdh = None
+            attachments.append((self._attachment_name(loc_stub), 
+                                partial(serialization.write_tabular, 
+                                        namespace[loc_key], tablename=loc_key,
+                                        metadata=mdh, 
+                                        encoding=self.attachment_encoding,
+                                        downcast=self.downcast_attachments)))
+        return image, attachments
+
+    def save(self, namespace, context={}):
+        """
+        Parameters
+        ----------
+        namespace : dict
+            The recipe namespace
+        context : dict
+            Information about the source file to allow pattern substitution to 
+            generate the output name. At least 'file_stub' (which is the 
+            filename without any extension) should be resolved.
+
+        """
+        from pyme_omero import core
+        from tempfile import TemporaryDirectory
+        
+        dataset, project = self._targets(namespace[self.input_image])
+
+        if self.upload_backend == 'pixels':
+            self._save_pixels(namespace, context, dataset, project)
+            return
+
+        if self.stream_upload:
+            self._save_streamed(namespace, context, dataset, project)
+            return
+
+        temp_dir = TemporaryDirectory()
+        try:
+            out_filename, loc_filenames = self._write_files(namespace, context,
+                                                            temp_dir.name)
+        except:
+            temp_dir.cleanup()
+            raise
+        
+        attach = self._attacher(namespace, context)
+        
+        if self.background_upload:
+            core.submit_image_upload(out_filename, dataset, project, 
+                                     loc_filenames, callback=attach,
+                                     cleanup=temp_dir.cleanup)
+            return
+        
+        try:
             image_id = core.upload_image_from_file(out_filename, dataset, 
                                                    project, loc_filenames)
+        finally:
+            temp_dir.cleanup()
+        
+        attach(image_id)
+    
+    def _principle_attacher(self, context):
+        from pyme_omero import core
+        principle = self._principle(context)
+
+        def attach_principle(image_id):
+            # if an h5r file is the principle input, upload it
+            if principle is None or image_id is None:
+                return
+            try:
+                if self.stream_upload:
+                    core.connect_and_upload_url_annotation(image_id, principle,
+                                                           namespace='pyme.localizations')
+                    return
+                with core.local_or_named_temp_filename(principle) as f:
+                    core.connect_and_upload_file_annotation(image_id, f,
+                                                            namespace='pyme.localizations')
+            except IOError:
+                pass
+        
+        return attach_principle
+
+    def _save_streamed(self, namespace, context, dataset, project):
+        from pyme_omero import core, upload_queue
         
-        # if an h5r file is the principle input, upload it
+        (name, write), attachments = self._stream_outputs(namespace, context)
+        attach = self._attacher(namespace, context)
+        
+        def upload():
+            image_id = core.upload_image_from_stream(name, write, dataset, 
+                                                     project, attachments)
+            attach(image_id)
+            return image_id
+        
+        if self.background_upload:
+            upload_queue.get_queue().submit(upload, description=name)
+        else:
+            upload()
+    
+    def _save_pixels(self, namespace, context, dataset, project):
+        from pyme_omero import core, upload_queue
+        from tempfile import TemporaryDirectory
+
+        name = self._stream_name(self.filePattern.format(**context))
+        data, voxelsize = self._pixels(namespace[self.input_image])
+        temp_dir = TemporaryDirectory()
         try:
-            principle = os.path.join(context['input_dir'], 
-                                     context['file_stub']) + '.h5r'
-            with core.local_or_named_temp_filename(principle) as f:
-                core.connect_and_upload_file_annotation(image_id, f,
-                                                        namespace='pyme.localizations')
-        except (KeyError, IOError):
-            pass
+            loc_filenames = self._write_attachment_files(namespace, 
+                                                         temp_dir.name)
+        except:
+            temp_dir.cleanup()
+            raise
+        attach = self._attacher(namespace, context)
+
+        def upload():
+            try:
+                image_id = core.upload_image_from_pixels(name, data, dataset,
+                                                         project, 
+                                                         loc_filenames,
+                                                         voxelsize)
+            finally:
+                temp_dir.cleanup()
+            attach(image_id)
+            return image_id
+        
+        if self.background_upload:
+            upload_queue.get_queue().submit(upload, description=name)
+        else:
+            upload()
     
     @property
     def inputs(self):
@@ -183,6 +433,21 @@ class RGBImageUpload(ImageUpload):
     omero_project : str
         name of OMERO project to link the dataset to. If the project does not
         already exist it will be created.
+    background_upload : bool
+        submit the upload to the background upload queue and return
+        immediately rather than blocking until the server-side import is done.
+    stream_upload : bool
+        serialize the image and attachments straight to the OMERO server
+        rather than writing them to temporary files first.
+    attachment_encoding : str
+        how to serialize localization attachments, see `ImageUpload`
+    downcast_attachments : bool
+        store columns in narrower types where that is lossless
+    localization_storage : str
+        attach localizations as files or as OMERO.tables, see `ImageUpload`
+    upload_backend : str
+        import a png file, or write the rendered RGB planes directly as a
+        3 channel uint8 image, see `ImageUpload`
     zoom : float
         how large to zoom the image
     scaling : str 
@@ -211,7 +476,7 @@ class RGBImageUpload(ImageUpload):
     zoom = Int(1)
     colorblind_friendly = Bool(True)
 
-    def _save(self, image, path):
+    def _render(self, image):
         from PIL import Image
         from PYME.IO.rgb_image import image_to_rgb, image_to_cmy
         
@@ -222,5 +487,153 @@ class RGBImageUpload(ImageUpload):
             im = image_to_rgb(image, zoom=self.zoom, scaling=self.scaling, 
                               scaling_factor=self.scaling_factor)
         
-        rgb = Image.fromarray(im, mode='RGB')
-        rgb.save(path)
+        return Image.fromarray(im, mode='RGB')
+
+    def _save(self, image, path):
+        self._render(image).save(path)
+    
+    def _stream_name(self, name):
+        return os.path.splitext(name)[0] + '.png'
+    
+    def _write(self, image, f):
+        self._render(image).save(f, format='PNG')
+    
+    def _pixels(self, image):
+        import numpy as np
+        rgb = np.asarray(self._render(image))  # (y, x, channel)
+        return rgb.transpose(1, 0, 2)[:, :, None, None, :], None
+
+
+@register_module('BatchImageUpload')
+class BatchImageUpload(ImageUpload):
+    """
+    Upload PYME ImageStacks to an OMERO server in batches, optionally
+    attaching localization files. Outputs are gathered across `save` calls
+    (e.g. one per file of a series) and imported as a group over one OMERO
+    session, with all dataset links and attachments created in a single call.
+
+    Parameters
+    ----------
+    input_image : str
+        name of image in the recipe namespace to upload
+    input_localization_attachments : dict
+        maps tabular types (keys) to attachment filenames (values). Tabular's
+        will be saved as '.hdf' files and attached to the image
+    filePattern : str
+        pattern to determine name of image on OMERO server. 'file_stub' will be
+        set automatically.
+    omero_dataset : str
+        name of OMERO dataset to add the image to. If the dataset does not
+        already exist it will be created. Can use sample metadata entries
+        using {format} syntax
+    omero_project : str
+        name of OMERO project to link the dataset to. If the project does not
+        already exist it will be created. Can use sample metadata entries
+        using {format} syntax
+    batch_size : int
+        number of outputs to gather before uploading them. Call `flush` once
+        the recipe has run over every file to upload the last, partial batch;
+        outputs still pending are not uploaded otherwise.
+    
+    Notes
+    -----
+    OMERO server address and user login information must be stored in the user
+    PYME config directory under plugins/config/pyme-omero, see `ImageUpload`.
+
+    `background_upload`, `stream_upload` and `upload_backend` do not apply;
+    batches are uploaded from temporary files, synchronously, when they are
+    flushed.
+    """
+    batch_size = Int(100)
+
+    _pending = List()
+
+    def save(self, namespace, context={}):
+        """
+        Parameters
+        ----------
+        namespace : dict
+            The recipe namespace
+        context : dict
+            Information about the source file to allow pattern substitution to 
+            generate the output name. At least 'file_stub' (which is the 
+            filename without any extension) should be resolved.
+
+        """
+        from tempfile import TemporaryDirectory
+        
+        dataset, project = self._targets(namespace[self.input_image])
+
+        temp_dir = TemporaryDirectory()
+        try:
+            out_filename, loc_filenames = self._write_files(namespace, context,
+                                                            temp_dir.name)
+        except:
+            temp_dir.cleanup()
+            raise
+        
+        self._pending.append((dataset, project, out_filename, loc_filenames, 
+                              self._principle(context), 
+                              self._table_attacher(namespace), temp_dir))
+        
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+    
+    def flush(self):
+        """ upload all pending outputs. Images are linked, and have their
+        attachments and tables added, as soon as their group is imported, and
+        those imported before a failure are still linked before the error is
+        raised.
+
+        Returns
+        -------
+        list
+            image IDs of the uploaded images
+        """
+        from pyme_omero import core
+        from contextlib import ExitStack
+        from collections import OrderedDict
+
+        pending, self._pending = self._pending, []
+        if len(pending) == 0:
+            return []
+        
+        groups = OrderedDict()
+        for dataset, project, out_filename, loc_filenames, principle, \
+                attach_tables, _ in pending:
+            groups.setdefault((dataset, project), []).append((out_filename, 
+                                                              loc_filenames, 
+                                                              principle,
+                                                              attach_tables))
+        
+        image_ids = []
+        try:
+            with ExitStack() as stack:
+                for (dataset, project), entries in groups.items():
+                    files, attachments = [], []
+                    for out_filename, loc_filenames, principle, _ in entries:
+                        files.append(out_filename)
+                        attachments.append(list(loc_filenames))
+                        if principle is None:
+                            continue
+                        try:
+                            attachments[-1].append(stack.enter_context(
+                                core.local_or_named_temp_filename(principle)))
+                        except IOError:
+                            pass
+                    def attach_tables(index, image_id, entries=entries):
+                        entries[index][-1](image_id)
+                        image_ids.append(image_id)
+                    
+                    core.upload_images_from_files(files, dataset, project, 
+                                                  attachments, 
+                                                  callback=attach_tables)
+        except:
+            logger.error('batch upload failed, images %s were uploaded' % (
+                image_ids))
+            raise
+        finally:
+            for entry in pending:
+                entry[-1].cleanup()
+        
+        return image_ids
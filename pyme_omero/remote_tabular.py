@@ -0,0 +1,229 @@
+"""
+PYME tabular data sources reading localizations in place on an OMERO server,
+rather than downloading whole files first.
+
+`RemoteHDFSource` reads an HDF5 localization file (.h5r / .hdf) attachment.
+
+The file is opened with h5py over a `transfer.RawFileStoreReader`, so only the
+blocks holding the metadata and the columns / row ranges actually read are
+fetched. PyTables, which PYME otherwise uses for these files, can only open
+files by name, hence h5py.
+
+Tables written by PyTables store rows contiguously, so reading one column
+still fetches the chunks of the table it spans; the savings are in what is not
+read at all, e.g. the other tables in the file, or rows outside a range.
+Nested fields, e.g. those of PYME's `FitResults` table, are flattened to
+`fitResults_x0` style keys, with the same short aliases (x, y, A, sig,
+error_x, ...) as `tabular.FitResultsSource`.
+
+`OMEROTableSource` reads an OMERO.table (see `pyme_omero.tables`), fetching
+only the selected columns and rows.
+"""
+
+import json
+from collections import OrderedDict
+from PYME.IO import tabular
+import logging
+
+logger = logging.getLogger(__name__)
+
+# attributes PyTables adds to every node
+PYTABLES_ATTRS = ('CLASS', 'VERSION', 'TITLE', 'FILTERS', 'PYTABLES_FORMAT_VERSION')
+
+# short names for flattened FitResults columns, as tabular.FitResultsSource
+FIT_RESULTS_ALIASES = {
+    'A': 'fitResults_A',
+    'x': 'fitResults_x0',
+    'y': 'fitResults_y0',
+    'z': 'fitResults_z0',
+    'sig': 'fitResults_sigma',
+    'error_A': 'fitError_A',
+    'error_x': 'fitError_x0',
+    'error_y': 'fitError_y0',
+    'error_z': 'fitError_z0',
+    'error_sig': 'fitError_sigma',
+}
+
+
+def _read_metadata(group, mdh, prefix=''):
+    import h5py
+    for name, value in group.attrs.items():
+        if name in PYTABLES_ATTRS:
+            continue
+        if isinstance(value, bytes):
+            if value.startswith(b'\x80'):
+                # pickled by PyTables, not unpickled from a remote file
+                logger.debug('skipping pickled metadata entry %s%s' % (prefix,
+                                                                        name))
+                continue
+            value = value.decode('utf-8', 'replace')
+        mdh[prefix + name] = value
+    for name, child in group.items():
+        if isinstance(child, h5py.Group):
+            _read_metadata(child, mdh, prefix + name + '.')
+
+
+def _flatten(dtype, prefix=''):
+    """ flattened column name -> path of field names, for a (possibly
+    nested) compound dtype, e.g. 'fitResults_x0' -> ('fitResults', 'x0') """
+    fields = OrderedDict()
+    for name in dtype.names:
+        if dtype[name].names is None:
+            fields[prefix + name] = (name,)
+        else:
+            for key, path in _flatten(dtype[name], prefix + name + '_').items():
+                fields[key] = (name,) + path
+    return fields
+
+
+class RemoteHDFSource(tabular.TabularBase):
+    _name = 'OMERO HDF File'
+
+    def __init__(self, file_obj, tablename='FitResults', on_close=None):
+        """
+
+        Parameters
+        ----------
+        file_obj : file
+            readable, seekable binary file holding the HDF5 file, e.g. a
+            `transfer.RawFileStoreReader`. Closed along with this source.
+        tablename : str, optional
+            table to read, by default 'FitResults'
+        on_close : callable, optional
+            called with no arguments once the source is closed, e.g. to return
+            a connection to its pool
+        """
+        import h5py
+
+        h5f = h5py.File(file_obj, 'r')
+        if tablename not in h5f:
+            tables = list(h5f.keys())
+            h5f.close()
+            raise KeyError('no table %s, tables are %s' % (tablename, tables))
+        self._file_obj = file_obj
+        self._on_close = on_close
+        self._h5f = h5f
+        self._table = h5f[tablename]
+        self.tablename = tablename
+        self._fields = _flatten(self._table.dtype)
+        self._aliases = dict((alias, key) for alias, key
+                             in FIT_RESULTS_ALIASES.items()
+                             if key in self._fields and alias not in self._fields)
+        self._keys = list(self._fields.keys()) + sorted(self._aliases)
+        self._columns = {}  # top-level field -> all its rows
+
+    @property
+    def mdh(self):
+        from PYME.IO import MetaDataHandler
+        mdh = MetaDataHandler.NestedClassMDHandler()
+        if 'MetaData' in self._h5f:
+            _read_metadata(self._h5f['MetaData'], mdh)
+        return mdh
+
+    def keys(self):
+        return self._keys
+
+    def __len__(self):
+        return len(self._table)
+
+    def __getitem__(self, keys):
+        key, sl = self._getKeySlice(keys)
+        try:
+            path = self._fields[self._aliases.get(key, key)]
+        except KeyError:
+            raise KeyError('Key (%s) not found' % key)
+
+        field = path[0]
+        column = self._columns.get(field)
+        if column is not None:
+            data = column[sl]
+        elif isinstance(sl, slice) and sl != slice(None):
+            # row range, fetched without caching the whole column
+            data = self._table.fields(field)[sl]
+        else:
+            column = self._columns[field] = self._table.fields(field)[:]
+            data = column[sl]
+        for name in path[1:]:
+            data = data[name]
+        return data
+
+    def close(self):
+        if self._h5f is None:
+            return
+        try:
+            self._h5f.close()
+            self._file_obj.close()
+        finally:
+            self._h5f = None
+            self._columns = {}
+            if self._on_close is not None:
+                self._on_close()
+
+
+class OMEROTableSource(tabular.TabularBase):
+    _name = 'OMERO.table'
+
+    def __init__(self, reader, columns=None, on_close=None):
+        """
+
+        Parameters
+        ----------
+        reader : pyme_omero.tables.TableReader
+            open table, with the rows to read already selected. Closed along
+            with this source.
+        columns : list, optional
+            columns to make available, by default all of them. Each is fetched
+            the first time it is used.
+        on_close : callable, optional
+            called with no arguments once the source is closed, e.g. to return
+            a connection to its pool
+        """
+        self._reader = reader
+        self._on_close = on_close
+        self._keys = list(reader.keys()) if columns is None else list(columns)
+        missing = set(self._keys) - set(reader.keys())
+        if missing:
+            raise KeyError('no columns %s in table' % sorted(missing))
+        self._columns = {}
+        self._metadata = reader.metadata()
+
+    @property
+    def mdh(self):
+        from PYME.IO import MetaDataHandler
+        mdh = MetaDataHandler.NestedClassMDHandler()
+        if 'pyme.metadata' in self._metadata:
+            for key, value in json.loads(
+                    self._metadata['pyme.metadata']).items():
+                mdh[key] = value
+        return mdh
+
+    def keys(self):
+        return self._keys
+
+    def __len__(self):
+        return self._reader.n_rows
+
+    def fetch(self, keys=None):
+        """ fetch several columns at once, in one pass over the rows """
+        keys = [k for k in (keys or self._keys) if k not in self._columns]
+        if keys:
+            self._columns.update(self._reader.read(keys))
+
+    def __getitem__(self, keys):
+        key, sl = self._getKeySlice(keys)
+        if key not in self._keys:
+            raise KeyError('Key (%s) not found' % key)
+        if key not in self._columns:
+            self.fetch([key])
+        return self._columns[key][sl]
+
+    def close(self):
+        if self._reader is None:
+            return
+        try:
+            self._reader.close()
+        finally:
+            self._reader = None
+            self._columns = {}
+            if self._on_close is not None:
+                self._on_close()
@@ -0,0 +1,344 @@
+"""
+Resumable, chunk-verified uploads of large files through a RawFileStore.
+
+An `UploadJournal` records the CRC-32 of each block once the server has
+accepted it. That is enough to catch a torn or missing block, and cheap enough
+not to undo the savings of a cheap whole-file checksum
+(`pyme_omero.import_policy`). If a write fails, the failed store is closed,
+the upload backs off exponentially, opens a fresh store and carries on from
+the last block which still reads back from the server with its journaled
+checksum, rather than starting the file over. Journals can be kept on disk, so
+an upload into an OriginalFile which outlives the process (e.g. an attachment)
+can be resumed by a later one.
+"""
+
+import hashlib
+import json
+import os
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_SIZE = 1048576  # also the server maximum for a single read
+MAX_VERIFY_BLOCKS = 4  # blocks to step back through before starting over
+BLOCK_CHECKSUM = 'CRC-32'
+
+
+def block_digest(data, value=0):
+    """ hex CRC-32 of a block, as journaled, optionally continuing the
+    checksum `value` of preceding data """
+    return '%08x' % (zlib.crc32(data, value) & 0xffffffff)
+
+
+class UploadJournal(object):
+    def __init__(self, path, block_size=DEFAULT_BLOCK_SIZE, directory=None):
+        """ record of the blocks of a local file the server has accepted
+
+        Parameters
+        ----------
+        path : str
+            local file being uploaded
+        block_size : int, optional
+            bytes per block, by default 1 MB
+        directory : str, optional
+            where to keep the journal. By default it is only kept in memory, so
+            an upload can only be resumed within this process.
+
+        Notes
+        -----
+        On disk, the journal is a JSON header line identifying the local file
+        (path, size, mtime), block size, block checksum and upload target,
+        followed by one hex CRC-32 per accepted block. Blocks are appended as
+        they are accepted, so journaling a large file costs one short write
+        per block.
+        """
+        st = os.stat(path)
+        self.path = os.path.abspath(path)
+        self.file_size = st.st_size
+        self.block_size = int(block_size)
+        self._mtime = st.st_mtime
+        self.target = None
+        self.chunks = []
+        self.journal_path = None
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            key = '%s:%d:%r' % (self.path, self.file_size, self._mtime)
+            self.journal_path = os.path.join(
+                directory, hashlib.sha1(key.encode()).hexdigest() + '.journal')
+            self._load()
+
+    @property
+    def offset(self):
+        """ number of bytes, from the start of the file, the server has
+        accepted """
+        return min(len(self.chunks) * self.block_size, self.file_size)
+
+    def chunk_range(self, index):
+        start = index * self.block_size
+        return start, min(start + self.block_size, self.file_size)
+
+    def set_target(self, target):
+        """ record what the file is being uploaded to (e.g. an OriginalFile
+        ID), forgetting any blocks sent to a previous target """
+        self.target = target
+        self.chunks = []
+        self._rewrite()
+
+    def record(self, digest):
+        """ journal the next block as accepted by the server """
+        self.chunks.append(digest)
+        if self.journal_path is not None:
+            with open(self.journal_path, 'a') as f:
+                f.write(digest + '\n')
+
+    def truncate(self, n_chunks):
+        """ forget all but the first `n_chunks` blocks """
+        if n_chunks < len(self.chunks):
+            del self.chunks[n_chunks:]
+            self._rewrite()
+
+    def discard(self):
+        """ forget everything, removing the journal from disk """
+        self.target = None
+        self.chunks = []
+        if self.journal_path is not None:
+            try:
+                os.remove(self.journal_path)
+            except OSError:
+                pass
+
+    def _header(self):
+        return dict(path=self.path, size=self.file_size, mtime=self._mtime,
+                    block_size=self.block_size, checksum=BLOCK_CHECKSUM,
+                    target=self.target)
+
+    def _rewrite(self):
+        if self.journal_path is None:
+            return
+        temp_path = self.journal_path + '.tmp-%d' % os.getpid()
+        with open(temp_path, 'w') as f:
+            f.write(json.dumps(self._header()) + '\n')
+            f.writelines(digest + '\n' for digest in self.chunks)
+        os.replace(temp_path, self.journal_path)
+
+    def _load(self):
+        try:
+            with open(self.journal_path) as f:
+                header = json.loads(f.readline())
+                lines = f.read().split('\n')
+        except (IOError, ValueError):
+            return
+
+        target = header.pop('target', None)
+        expected = self._header()
+        expected.pop('target')
+        if header != expected:
+            logger.debug('ignoring stale upload journal %s' % 
+                         self.journal_path)
+            return
+
+        self.target = target
+        # the last line may have been cut short by a crash mid-append, and
+        # anything after it is untrustworthy
+        for digest in lines[:-1]:
+            if len(digest) != 8:
+                break
+            self.chunks.append(digest)
+        if lines[-1] or len(self.chunks) < len(lines) - 1:
+            self._rewrite()  # drop the torn tail from disk too
+
+
+def read_blocks(f, block_size, n_bytes):
+    """ yield successive blocks of the next `n_bytes` of an open file,
+    reading the next block on a background thread while the caller handles
+    the current one. A block comes back short if the file ends early.
+    """
+    starts = iter(range(0, n_bytes, block_size))
+    with ThreadPoolExecutor(max_workers=1,
+                            thread_name_prefix='upload-read-ahead') as pool:
+        def read_next():
+            start = next(starts, None)
+            if start is None:
+                return None
+            return pool.submit(f.read, min(block_size, n_bytes - start))
+
+        pending = read_next()
+        while pending is not None:
+            block = pending.result()
+            pending = read_next() if block else None
+            yield block
+
+def _close(store, path):
+    try:
+        store.close()
+    except Exception as e:
+        logger.debug('closing the store of %s failed: %s' % (path, e))
+
+def _read_back(store, start, stop):
+    value = 0
+    for offset in range(start, stop, DEFAULT_BLOCK_SIZE):
+        value = zlib.crc32(store.read(offset, min(DEFAULT_BLOCK_SIZE,
+                                                  stop - offset)), value)
+    return block_digest(b'', value)
+
+def resume_offset(store, journal):
+    """ find where to resume an upload, checking the server against the
+    journal and rolling the journal back past any blocks it does not hold
+
+    Parameters
+    ----------
+    store : omero.api.RawFileStorePrx
+        store with its file ID already set
+    journal : UploadJournal
+        blocks believed to have been accepted
+
+    Returns
+    -------
+    int
+        offset to resume writing from
+    """
+    n = len(journal.chunks)
+    if n == 0:
+        return 0
+
+    server_size = store.size()
+    while n > 0 and journal.chunk_range(n - 1)[1] > server_size:
+        n -= 1
+
+    # blocks before the last intact one were accepted before it, so only the
+    # tail needs checking
+    for _ in range(MAX_VERIFY_BLOCKS):
+        if n == 0:
+            break
+        if (_read_back(store, *journal.chunk_range(n - 1)) 
+                == journal.chunks[n - 1]):
+            break
+        logger.warning('block %d of %s does not match the journal' % (
+            n - 1, journal.path))
+        n -= 1
+    else:
+        n = 0
+
+    journal.truncate(n)
+    return journal.offset
+
+def upload_file_resumable(open_store, path, journal=None, retries=5,
+                          backoff=1., max_backoff=60., progress=None,
+                          on_complete=None, hasher=hashlib.sha1):
+    """ upload a file through a RawFileStore, resuming after failures
+
+    Parameters
+    ----------
+    open_store : callable
+        called with no arguments, returns a RawFileStore with its file already
+        set, e.g. ``lambda: proc.getUploader(i)``. Called again for a fresh
+        store after each failure, once the failed store is closed, and
+        retried like a failed write if it fails itself.
+    path : str
+        local file to upload
+    journal : UploadJournal, optional
+        journal to resume from and record to, by default a new in-memory one
+    retries : int, optional
+        number of consecutive failures, without any blocks being accepted in
+        between, to tolerate before giving up, by default 5
+    backoff : float, optional
+        seconds to wait after the first failure, doubling with each further
+        consecutive failure, by default 1
+    max_backoff : float, optional
+        longest wait between attempts, by default 60 s
+    progress : callable, optional
+        called as progress(path, bytes_sent, total_bytes) after each block
+    on_complete : callable, optional
+        called with the store once the last block is written, before the store
+        is closed, e.g. to `save()` it
+    hasher : callable, optional
+        called with no arguments for a new object with update(bytes) and
+        hexdigest() computing the file's checksum, by default hashlib.sha1.
+        See `pyme_omero.import_policy.CHECKSUMS`.
+
+    Returns
+    -------
+    str
+        hex digest of the whole file
+    """
+    if journal is None:
+        journal = UploadJournal(path)
+    block_size = journal.block_size
+    total = journal.file_size
+
+    digest = hasher()
+    hashed = 0  # length of the prefix fed to digest
+    failures = 0
+    t0 = time.time()
+    sent = 0
+    with open(path, 'rb') as f:
+        while True:
+            store = blocks = None
+            accepted = len(journal.chunks)
+            try:
+                # reopening can fail too while the server is unreachable
+                store = open_store()
+                offset = resume_offset(store, journal)
+                if offset < hashed:
+                    digest, hashed = hasher(), 0
+                if hashed < offset:  # hash the resumed prefix locally
+                    f.seek(hashed)
+                    while hashed < offset:
+                        block = f.read(min(block_size, offset - hashed))
+                        digest.update(block)
+                        hashed += len(block)
+                if offset > 0:
+                    logger.info('resuming upload of %s at byte %d' % (path,
+                                                                      offset))
+                else:
+                    store.write(b'', 0, 0)  # touch
+
+                f.seek(offset)
+                blocks = read_blocks(f, block_size, total - offset)
+                for block in blocks:
+                    if not block:
+                        break
+                    store.write(block, offset, len(block))
+                    digest.update(block)
+                    hashed += len(block)
+                    journal.record(block_digest(block))
+                    offset += len(block)
+                    sent += len(block)
+                    if progress is not None:
+                        progress(path, offset, total)
+                if offset < total:
+                    raise IOError('%s shrank during upload' % path)
+
+                if on_complete is not None:
+                    on_complete(store)
+                break
+            except Exception as e:
+                # release the failed store before waiting for another
+                if blocks is not None:
+                    blocks.close()
+                    blocks = None
+                if store is not None:
+                    _close(store, path)
+                    store = None
+                if len(journal.chunks) > accepted:
+                    failures = 0
+                failures += 1
+                if failures > retries:
+                    raise
+                delay = min(backoff * 2 ** (failures - 1), max_backoff)
+                logger.warning('upload of %s failed at byte %d (%s), retrying '
+                               'in %.1f s' % (path, journal.offset, e, delay))
+                time.sleep(delay)
+            finally:
+                if blocks is not None:
+                    blocks.close()  # waits for any read in flight
+                if store is not None:
+                    _close(store, path)
+
+    elapsed = max(time.time() - t0, 1e-9)
+    logger.info('uploaded %s: %.1f MB sent in %.2f s (%.1f MB/s)' % (
+        os.path.basename(path), sent / 1e6, elapsed, sent / 1e6 / elapsed))
+    return digest.hexdigest()
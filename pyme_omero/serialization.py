@@ -0,0 +1,270 @@
+"""
+Serialize PYME images and tabular data to open file-like objects, e.g. a
+`pyme_omero.transfer.RawFileStoreWriter`, so they can be uploaded without
+being written to a local temporary file first.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def write_image_tiff(image, f, compression=None, maxworkers=1):
+    """ write an ImageStack as an OME-BigTIFF, one plane at a time, see
+    `pyme_omero.ome_tiff`
+
+    Parameters
+    ----------
+    image : PYME.IO.image.ImageStack
+        image to write. Lazily loaded stacks are never fully in memory.
+    f : file
+        open, writable binary file
+    compression : str, optional
+        None, or 'zlib' to write deflate compressed tiles
+    maxworkers : int, optional
+        number of threads compressing tiles, by default 1
+    """
+    from pyme_omero import ome_tiff
+
+    try:
+        voxelsize = tuple(v / 1e3 for v in image.voxelsize_nm[:3])
+    except (AttributeError, KeyError):
+        voxelsize = None
+    ome_tiff.write_ome_tiff(image.data_xyztc, f, voxelsize=voxelsize,
+                            compression=compression, maxworkers=maxworkers)
+
+# attachment encoding -> (file extension, PyTables compression library)
+TABULAR_ENCODINGS = {
+    'hdf': ('.hdf', None),
+    'hdf-blosc': ('.hdf', 'blosc:lz4'),
+    'hdf-zstd': ('.hdf', 'blosc:zstd'),
+    'parquet': ('.parquet', None),
+    'feather': ('.feather', None),
+}
+COLUMNAR_EXTENSIONS = ('.parquet', '.feather')
+
+
+def tabular_extension(encoding):
+    """ file extension for tables serialized with `encoding` """
+    return TABULAR_ENCODINGS[encoding][0]
+
+def downcast_lossless(records):
+    """ narrow float64 columns which round-trip exactly through float32, and
+    integer columns whose values fit a smaller integer type
+
+    Parameters
+    ----------
+    records : numpy.ndarray
+        record array
+
+    Returns
+    -------
+    numpy.ndarray
+        record array, with the same values, using no more bytes per row
+    """
+    import numpy as np
+
+    dtypes = []
+    for name in records.dtype.names:
+        col = records[name]
+        dtype = col.dtype
+        if dtype == np.float64 and col.ndim == 1:
+            if np.array_equal(col.astype(np.float32).astype(np.float64), col,
+                              equal_nan=True):
+                dtype = np.dtype(np.float32)
+        elif dtype.kind in 'iu' and col.ndim == 1 and col.size > 0:
+            lo, hi = col.min(), col.max()
+            candidates = ['u1', 'u2', 'u4'] if lo >= 0 else ['i1', 'i2', 'i4']
+            for candidate in candidates:
+                info = np.iinfo(candidate)
+                if info.min <= lo and hi <= info.max:
+                    if np.dtype(candidate).itemsize < dtype.itemsize:
+                        dtype = np.dtype(candidate)
+                    break
+        dtypes.append((name, dtype, col.shape[1:]))
+    return records.astype(dtypes)
+
+def tabular_to_hdf_bytes(tabular, tablename, metadata=None, complib=None,
+                         complevel=5, downcast=False):
+    """ serialize a tabular data source to an in-memory HDF5 file in the
+    layout `to_hdf` writes, without touching disk
+
+    Parameters
+    ----------
+    tabular : PYME.IO.tabular.TabularBase
+        table to serialize
+    tablename : str
+        name of the table within the file
+    metadata : PYME.IO.MetaDataHandler.MDHandlerBase, optional
+        metadata to store alongside the table
+    complib : str, optional
+        PyTables compression library, e.g. 'blosc:zstd'. By default the table
+        is not compressed. PyTables readers decompress transparently.
+    complevel : int, optional
+        compression level, by default 5
+    downcast : bool, optional
+        narrow column types where lossless, see `downcast_lossless`
+
+    Returns
+    -------
+    bytes
+        HDF5 file image
+
+    Notes
+    -----
+    PyTables can only write a file image it holds in memory, which is then
+    copied out, so peak memory is about twice the serialized size, on top of
+    the record array. Save very large tables to a local file instead, see
+    `save_tabular`.
+    """
+    import tables
+    from PYME.IO import MetaDataHandler
+
+    records = tabular.to_recarray()
+    if downcast:
+        records = downcast_lossless(records)
+    filters = None
+    if complib is not None:
+        filters = tables.Filters(complevel=complevel, complib=complib,
+                                 shuffle=True)
+
+    with tables.open_file('%s.hdf' % tablename, 'w', driver='H5FD_CORE',
+                          driver_core_backing_store=0) as h5f:
+        h5f.create_table(h5f.root, tablename, records, filters=filters)
+        if metadata is not None:
+            MetaDataHandler.HDFMDHandler(h5f, metadata)
+        h5f.flush()
+        return h5f.get_file_image()
+
+def tabular_to_arrow_bytes(tabular, tablename, metadata=None,
+                           encoding='parquet', downcast=False):
+    """ serialize a tabular data source as Parquet or Feather (zstd
+    compressed), keeping the table name and metadata in the schema metadata
+    so `columnar_to_hdf` can restore them
+
+    Returns
+    -------
+    bytes
+        Parquet or Feather file contents
+    """
+    import io
+    import pyarrow as pa
+
+    records = tabular.to_recarray()
+    if downcast:
+        records = downcast_lossless(records)
+    table = pa.table({name: records[name] for name in records.dtype.names})
+    schema_md = {'pyme.tablename': tablename}
+    if metadata is not None:
+        schema_md['pyme.metadata'] = metadata.to_JSON()
+    table = table.replace_schema_metadata(schema_md)
+
+    buf = io.BytesIO()
+    if encoding == 'parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(table, buf, compression='zstd')
+    elif encoding == 'feather':
+        from pyarrow import feather
+        feather.write_feather(table, buf, compression='zstd')
+    else:
+        raise ValueError('%s is not a columnar encoding' % encoding)
+    return buf.getvalue()
+
+def tabular_to_bytes(tabular, tablename, metadata=None, encoding='hdf',
+                     downcast=False):
+    """ serialize a tabular data source with one of `TABULAR_ENCODINGS`
+
+    Returns
+    -------
+    bytes
+        file contents, to be named with `tabular_extension(encoding)`
+    """
+    ext, complib = TABULAR_ENCODINGS[encoding]
+    if ext in COLUMNAR_EXTENSIONS:
+        return tabular_to_arrow_bytes(tabular, tablename, metadata, encoding,
+                                      downcast)
+    return tabular_to_hdf_bytes(tabular, tablename, metadata, complib,
+                                downcast=downcast)
+
+def write_tabular(tabular, f, tablename, metadata=None, encoding='hdf',
+                  downcast=False):
+    """ write a tabular data source to a file-like object with one of
+    `TABULAR_ENCODINGS`
+
+    Parameters
+    ----------
+    tabular : PYME.IO.tabular.TabularBase
+        table to write
+    f : file
+        open, writable binary file
+    tablename : str
+        name of the table within the file
+    metadata : PYME.IO.MetaDataHandler.MDHandlerBase, optional
+        metadata to store alongside the table
+    encoding : str, optional
+        key of `TABULAR_ENCODINGS`, by default 'hdf'
+    downcast : bool, optional
+        narrow column types where lossless, see `downcast_lossless`
+
+    Notes
+    -----
+    The file is serialized in memory before being written, see
+    `tabular_to_hdf_bytes`.
+    """
+    f.write(tabular_to_bytes(tabular, tablename, metadata, encoding, downcast))
+
+def save_tabular(tabular, path, tablename, metadata=None, encoding='hdf',
+                 downcast=False):
+    """ `write_tabular` to a local file """
+    if encoding == 'hdf' and not downcast:
+        # what we've always written
+        tabular.to_hdf(path, tablename, metadata=metadata)
+        return
+    with open(path, 'wb') as f:
+        write_tabular(tabular, f, tablename, metadata, encoding, downcast)
+
+def columnar_to_hdf(path, out_path):
+    """ convert a Parquet or Feather file written by `tabular_to_arrow_bytes`
+    to the HDF5 layout PYME loads
+
+    Parameters
+    ----------
+    path : str
+        .parquet or .feather file
+    out_path : str
+        where to write the HDF5 file
+
+    Returns
+    -------
+    str
+        `out_path`
+    """
+    import json
+    import numpy as np
+    import tables
+    from PYME.IO import MetaDataHandler
+
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        table = pq.read_table(path)
+    else:
+        from pyarrow import feather
+        table = feather.read_table(path)
+
+    schema_md = table.schema.metadata or {}
+    tablename = schema_md.get(b'pyme.tablename', b'FitResults').decode()
+    columns = [(name, table.column(name).to_numpy()) for name in
+               table.column_names]
+    records = np.empty(table.num_rows, dtype=[(name, col.dtype) for name, col
+                                              in columns])
+    for name, col in columns:
+        records[name] = col
+
+    with tables.open_file(out_path, 'w') as h5f:
+        h5f.create_table(h5f.root, tablename, records)
+        if b'pyme.metadata' in schema_md:
+            mdh = MetaDataHandler.NestedClassMDHandler()
+            for k, v in json.loads(schema_md[b'pyme.metadata']).items():
+                mdh.setEntry(k, v)
+            MetaDataHandler.HDFMDHandler(h5f, mdh)
+    return out_path
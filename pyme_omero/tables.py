@@ -0,0 +1,209 @@
+"""
+Localization tables stored as OMERO.tables, rather than as opaque HDF5 file
+attachments, so they can be queried server-side: consumers fetch only the
+columns and rows (e.g. one time window, or one channel) they need.
+
+Tables are written in batches of rows, one column chunk per column per batch,
+so memory use and message sizes stay bounded however long the table. The table
+name, the original column dtypes (OMERO.tables only has 64 bit numeric
+columns) and PYME metadata are stored as table metadata, under
+'pyme.tablename', 'pyme.dtypes' and 'pyme.metadata' (JSON).
+"""
+
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+TABLE_NAMESPACE = 'pyme.localizations.table'
+# bytes per addData / read call, as 8 byte values across all columns of a
+# batch. OMERO's default Ice message size limit is 64 MB, this leaves room for
+# the message's own overhead
+BATCH_BYTES = 32 * 1024 ** 2
+
+
+def _column_type(dtype):
+    import omero.grid
+    if dtype.kind == 'b':
+        return omero.grid.BoolColumn
+    if dtype.kind in 'iu':
+        return omero.grid.LongColumn
+    if dtype.kind == 'f':
+        return omero.grid.DoubleColumn
+    raise TypeError('no OMERO.tables column type for %s' % dtype)
+
+def _batch_rows(n_columns):
+    """ rows per call such that a batch of `n_columns` columns fits in
+    `BATCH_BYTES` """
+    return max(1, BATCH_BYTES // (8 * max(1, n_columns)))
+
+def _shared_resources(connection):
+    resources = connection.c.sf.sharedResources()
+    if not resources.areTablesEnabled():
+        raise IOError('OMERO.tables is not enabled on this server')
+    return resources
+
+def write_table(connection, tabular, name, metadata=None, batch_rows=None):
+    """ write a PYME tabular object to a new OMERO.table
+
+    Parameters
+    ----------
+    connection : omero.gateway.BlitzGateway
+        an open connection to an OMERO server
+    tabular : PYME.IO.tabular.TabularBase
+        table to write, with numeric or boolean columns
+    name : str
+        name of the table (its OriginalFile)
+    metadata : PYME.IO.MetaDataHandler.MDHandlerBase, optional
+        metadata to store with the table
+    batch_rows : int, optional
+        rows sent per call, by default as many as fit in `BATCH_BYTES`
+
+    Returns
+    -------
+    int
+        ID of the table's OriginalFile
+    """
+    import numpy as np
+    from omero import rtypes
+
+    keys = list(tabular.keys())
+    data = [np.asarray(tabular[k]) for k in keys]
+    n_rows = len(data[0]) if data else 0
+    columns = [_column_type(d.dtype)(k, '', []) for k, d in zip(keys, data)]
+    if batch_rows is None:
+        batch_rows = _batch_rows(len(columns))
+
+    resources = _shared_resources(connection)
+    repository_id = resources.repositories().descriptions[0].getId().getValue()
+    table = resources.newTable(repository_id, name)
+    if table is None:
+        raise IOError('could not create OMERO.table %s' % name)
+    try:
+        table.initialize(columns)
+        for start in range(0, n_rows, batch_rows):
+            for column, values in zip(columns, data):
+                column.values = values[start:start + batch_rows].tolist()
+            table.addData(columns)
+        dtypes = dict((k, d.dtype.str) for k, d in zip(keys, data))
+        table_metadata = {'pyme.tablename': rtypes.rstring(name),
+                          'pyme.dtypes': rtypes.rstring(json.dumps(dtypes))}
+        if metadata is not None:
+            table_metadata['pyme.metadata'] = rtypes.rstring(
+                metadata.to_JSON())
+        table.setAllMetadata(table_metadata)
+        file_id = table.getOriginalFile().getId().getValue()
+    finally:
+        table.close()
+    logger.debug('wrote %d rows x %d columns to OMERO.table %d' % (
+        n_rows, len(keys), file_id))
+    return file_id
+
+
+class TableReader(object):
+    def __init__(self, connection, file_id, start=0, stop=None, where=None,
+                 variables=None, batch_rows=None):
+        """ reads columns of a subset of the rows of an OMERO.table
+
+        Parameters
+        ----------
+        connection : omero.gateway.BlitzGateway
+            an open connection to an OMERO server, which must stay open until
+            the reader is closed
+        file_id : int
+            ID of the table's OriginalFile
+        start, stop : int, optional
+            range of rows to read, by default all of them
+        where : str, optional
+            condition selecting rows within [start, stop), evaluated
+            server-side in PyTables condition syntax, e.g.
+            '(t >= 1000) & (t < 2000)' or 'probe == 1'
+        variables : dict, optional
+            values of any variables in `where` other than column names
+        batch_rows : int, optional
+            rows fetched per call, by default as many of the columns being
+            read as fit in `BATCH_BYTES`
+        """
+        import omero.model
+
+        resources = _shared_resources(connection)
+        self._table = resources.openTable(omero.model.OriginalFileI(file_id,
+                                                                    False))
+        if self._table is None:
+            raise IOError('could not open OMERO.table %d' % file_id)
+        try:
+            self._headers = self._table.getHeaders()
+            self._dtypes = json.loads(self.metadata().get('pyme.dtypes', 
+                                                          '{}'))
+            n_rows = self._table.getNumberOfRows()
+            self.start = max(0, start)
+            self.stop = n_rows if stop is None else min(stop, n_rows)
+            self.batch_rows = batch_rows
+            self.rows = None  # all of [start, stop)
+            if where is not None:
+                self.rows = self._table.getWhereList(where,
+                                                     _wrap(variables or {}),
+                                                     self.start, self.stop, 1)
+        except:
+            self._table.close()
+            raise
+
+    def keys(self):
+        return [h.name for h in self._headers]
+
+    @property
+    def n_rows(self):
+        if self.rows is not None:
+            return len(self.rows)
+        return max(0, self.stop - self.start)
+
+    def metadata(self):
+        """ table metadata, unwrapped """
+        from omero.rtypes import unwrap
+        return dict((k, unwrap(v)) for k, v in
+                    self._table.getAllMetadata().items())
+
+    def read(self, keys):
+        """ fetch columns, in batches of `batch_rows` rows
+
+        Parameters
+        ----------
+        keys : list
+            column names
+
+        Returns
+        -------
+        dict
+            column name -> numpy array, of the dtype it was written with
+        """
+        import numpy as np
+
+        indices = [self.keys().index(k) for k in keys]
+        batch_rows = self.batch_rows or _batch_rows(len(indices))
+        chunks = dict((k, []) for k in keys)
+        for data in self._batches(indices, batch_rows):
+            for k, column in zip(keys, data.columns):
+                chunks[k].append(np.asarray(column.values))
+        columns = {}
+        for k, c in chunks.items():
+            columns[k] = np.concatenate(c) if c else np.zeros(0)
+            if k in self._dtypes:  # tables not written by `write_table` won't
+                columns[k] = columns[k].astype(self._dtypes[k], copy=False)
+        return columns
+
+    def _batches(self, indices, batch_rows):
+        if self.rows is not None:
+            for i in range(0, len(self.rows), batch_rows):
+                yield self._table.slice(indices, self.rows[i:i + batch_rows])
+            return
+        for start in range(self.start, self.stop, batch_rows):
+            yield self._table.read(indices, start,
+                                   min(start + batch_rows, self.stop))
+
+    def close(self):
+        self._table.close()
+
+
+def _wrap(variables):
+    from omero import rtypes
+    return dict((k, rtypes.rtype(v)) for k, v in variables.items())
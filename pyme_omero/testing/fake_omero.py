@@ -0,0 +1,785 @@
+"""
+In-process stand-in for the parts of an OMERO server used by `pyme_omero.core`,
+so that login counts and call patterns can be measured without a live server.
+Model objects (`omero.model.DatasetI` etc.) are the real omero-py classes; only
+the server side is faked.
+
+Latency and bandwidth are configurable on `FakeServer`, so that transfers and
+round trips cost roughly what they would over a network, see
+`benchmarks/bench_suite.py`.
+"""
+
+import itertools
+import os
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class FakeWrapper(object):
+    """ minimal stand-in for an omero.gateway BlitzObjectWrapper """
+    def __init__(self, server, obj):
+        self._server = server
+        self._obj = obj
+
+    def getId(self):
+        return self._obj.getId().getValue()
+
+    def getName(self):
+        return self._obj.getName().getValue()
+
+    def findChildByName(self, name):
+        for child_id in self._server.children.get(self.getId(), []):
+            child = self._server.objects[child_id]
+            if child.getName().getValue() == name:
+                return FakeWrapper(self._server, child)
+        return None
+
+    def linkAnnotation(self, ann):
+        self._server.annotation_links.setdefault(self.getId(), []).append(ann)
+        return ann
+
+
+class FakeRawFileStore(object):
+    """ in-memory stand-in for omero.api.RawFileStore """
+    def __init__(self, server=None, data=None):
+        self._server = server
+        self.data = bytearray() if data is None else data
+        self.n_writes = 0
+        self.closed = False
+
+    def write(self, block, offset, length):
+        if self._server is not None:
+            self._server.transfer(length)
+        self.n_writes += 1
+        end = offset + length
+        if end > len(self.data):
+            self.data.extend(b'\0' * (end - len(self.data)))
+        self.data[offset:end] = bytes(block)
+
+    def setFileId(self, file_id, ctx=None):
+        self._file_id = file_id
+        self.data = self._server.files.setdefault(file_id, bytearray())
+
+    def read(self, offset, length):
+        if length > 1048576:
+            raise ValueError('Max read size is: 1048576')
+        if self._server is not None:
+            n_bytes = max(0, min(length, len(self.data) - offset))
+            self._server.transfer(n_bytes)
+            self._server.bytes_downloaded += n_bytes
+        return bytes(self.data[offset:offset + length])
+
+    def size(self):
+        if self._server is not None:
+            self._server.transfer(0)
+        return len(self.data)
+
+    def save(self, ctx=None):
+        from omero import rtypes
+        from hashlib import sha1
+        og_file = self._server.objects[self._file_id]
+        og_file.setSize(rtypes.rlong(len(self.data)))
+        og_file.setHash(rtypes.rstring(sha1(self.data).hexdigest()))
+        return og_file
+
+    def close(self):
+        self.closed = True
+
+
+class FakeRepositoryFileStore(FakeRawFileStore):
+    """ import uploader writing to a file in the server's stand-in
+    ManagedRepository directory, see `FakeServer` """
+    def __init__(self, server, og_file):
+        FakeRawFileStore.__init__(self, server)
+        self.og_file = og_file
+        self.path = os.path.join(server.repository_dir,
+                                 og_file.getPath().getValue(),
+                                 og_file.getName().getValue())
+
+    @property
+    def data(self):
+        if not os.path.exists(self.path):
+            return bytearray()
+        with open(self.path, 'rb') as f:
+            return bytearray(f.read())
+
+    @data.setter
+    def data(self, value):
+        pass  # always on disk
+
+    def write(self, block, offset, length):
+        if self.closed:
+            raise IOError('uploader is closed')
+        self._server.transfer(length)
+        self._server.bytes_uploaded += length
+        self.n_writes += 1
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'r+b' if os.path.exists(self.path) else 'wb') as f:
+            f.seek(offset)
+            f.write(bytes(block[:length]))
+
+    def save(self, ctx=None):
+        return self.og_file
+
+
+class FaultyRawFileStore(FakeRawFileStore):
+    """ FakeRawFileStore whose connection drops part-way through the
+    `fail_at`-th write (counting from 1), leaving a torn block behind as a real
+    failure might. Every call after that fails too. """
+    def __init__(self, server=None, data=None, fail_at=None):
+        FakeRawFileStore.__init__(self, server, data)
+        self.fail_at = fail_at
+        self.failed = False
+
+    def write(self, block, offset, length):
+        if self.failed:
+            raise IOError('connection dropped')
+        if self.fail_at is not None and self.n_writes + 1 >= self.fail_at:
+            self.failed = True
+            FakeRawFileStore.write(self, block[:length // 2], offset,
+                                   length // 2)
+            raise IOError('connection dropped')
+        FakeRawFileStore.write(self, block, offset, length)
+
+
+class FakeUpdateService(object):
+    def __init__(self, server):
+        self._server = server
+
+    def saveAndReturnObject(self, obj, ctx=None):
+        self._server.calls['saveAndReturnObject'] += 1
+        return self._server.save(obj)
+
+    def saveArray(self, objs, ctx=None):
+        self._server.calls['saveArray'] += 1
+        for obj in objs:
+            self._server.save(obj)
+
+    def saveAndReturnArray(self, objs, ctx=None):
+        self._server.calls['saveAndReturnArray'] += 1
+        return [self._server.save(obj) for obj in objs]
+
+
+class FakeContainerService(object):
+    def __init__(self, server):
+        self._server = server
+
+    def loadContainerHierarchy(self, kind, ids, options, ctx=None):
+        self._server.calls['loadContainerHierarchy'] += 1
+        return [o for o in self._server.objects.values()
+                if type(o).__name__ == kind + 'I']
+
+
+class FakeQueryService(object):
+    """ answers the name-filtered container queries in
+    `pyme_omero.containers` and the hash lookups in `pyme_omero.attachments`
+    """
+    def __init__(self, server):
+        self._server = server
+
+    def projection(self, hql, params, ctx=None):
+        from omero import rtypes
+        from pyme_omero import attachments, containers
+
+        self._server.calls['projection'] += 1
+        time.sleep(self._server.query_latency)
+        args = dict((k, v.getValue()) for k, v in params.map.items())
+        objects = self._server.objects
+        if hql.startswith(attachments.FILE_ANNOTATIONS_ON_IMAGE.split('%s')[0]):
+            return self._file_annotations_on_image(args)
+        if hql == containers.PROJECT_BY_NAME:
+            candidates = [o for o in objects.values()
+                          if type(o).__name__ == 'ProjectI']
+        elif hql == containers.DATASET_BY_NAME:
+            candidates = [o for o in objects.values()
+                          if type(o).__name__ == 'DatasetI']
+        elif hql == containers.DATASET_IN_PROJECT_BY_NAME:
+            candidates = [objects[c] for c in
+                          self._server.children.get(args['pid'], [])]
+        elif hql == attachments.FILE_ANNOTATION_BY_HASH:
+            ids = sorted(o.getId().getValue() for o in objects.values()
+                         if type(o).__name__ == 'FileAnnotationI'
+                         and self._hash_and_size(o) == (args['hash'],
+                                                        args['size'])
+                         and o.getNs().getValue() == args['ns'])
+            return [[rtypes.rlong(i)] for i in ids[:1]]
+        elif hql == attachments.IMAGE_ANNOTATION_LINK:
+            linked = self._server.linked_ids(args['iid'])
+            return [[rtypes.rlong(0)]] if args['aid'] in linked else []
+        else:
+            raise NotImplementedError(hql)
+
+        ids = sorted(o.getId().getValue() for o in candidates
+                     if o.getName().getValue() == args['name'])
+        return [[rtypes.rlong(i)] for i in ids[:1]]
+
+
+    def findByQuery(self, hql, params, ctx=None):
+        from pyme_omero import pixels
+        import omero.model
+        from omero import rtypes
+
+        self._server.calls['findByQuery'] += 1
+        time.sleep(self._server.query_latency)
+        args = dict((k, v.getValue()) for k, v in params.map.items())
+        if hql == pixels.PIXELS_TYPE_BY_VALUE:
+            pixels_type = omero.model.PixelsTypeI()
+            pixels_type.setValue(rtypes.rstring(args['value']))
+            return pixels_type
+        if hql == pixels.PIXELS_OF_IMAGE:
+            return self._server.image_pixels.get(args['iid'])
+        raise NotImplementedError(hql)
+
+    def _hash_and_size(self, ann):
+        # linked unloaded, e.g. by core._create_file_annotations
+        og_file = self._server.objects.get(ann.getFile().getId().getValue(),
+                                           ann.getFile())
+        if og_file.getHash() is None:
+            return None
+        return og_file.getHash().getValue(), og_file.getSize().getValue()
+
+    def _file_annotations_on_image(self, args):
+        from omero import rtypes
+        iid = args['iid']
+        linked = self._server.linked_ids(iid)
+        suffixes = [v.lstrip('%') for k, v in args.items()
+                    if k.startswith('ext')]
+        rows = []
+        for ann_id in linked:
+            ann = self._server.objects[ann_id]
+            if type(ann).__name__ != 'FileAnnotationI':
+                continue
+            # linked unloaded, e.g. by core._link_file_annotation
+            og_file = self._server.objects.get(ann.getFile().getId().getValue(),
+                                               ann.getFile())
+            name = og_file.getName().getValue()
+            if suffixes and not any(name.endswith(x) for x in suffixes):
+                continue
+            if 'ns' in args and ann.getNs().getValue() != args['ns']:
+                continue
+            rows.append([rtypes.rlong(ann_id), og_file.getId(),
+                         og_file.getName(), og_file.getSize(),
+                         og_file.getHash(), og_file.getMtime()])
+        return rows
+
+
+class FakeTable(object):
+    """ in-memory stand-in for omero.grid.Table, sharing its rows and metadata
+    with every other handle open on the same table """
+    def __init__(self, server, og_file):
+        self._server = server
+        self._og_file = og_file
+        self._state = server.tables[og_file.getId().getValue()]
+        self.closed = False
+
+    @staticmethod
+    def _empty(column, values=None):
+        return type(column)(column.name, column.description, values or [])
+
+    def initialize(self, columns):
+        self._state['columns'] = [self._empty(c) for c in columns]
+
+    def addData(self, columns):
+        self._server.calls['addData'] += 1
+        n_bytes = 0
+        for mine, theirs in zip(self._state['columns'], columns):
+            mine.values.extend(theirs.values)
+            n_bytes += 8 * len(theirs.values)
+        self._server.transfer(n_bytes)
+
+    def getHeaders(self):
+        return [self._empty(c) for c in self._state['columns']]
+
+    def getNumberOfRows(self):
+        columns = self._state['columns']
+        return len(columns[0].values) if columns else 0
+
+    def _data(self, col_numbers, rows):
+        import omero.grid
+        self._server.calls['readTable'] += 1
+        columns = [self._state['columns'][i] for i in col_numbers]
+        data = omero.grid.Data()
+        data.columns = [self._empty(c, [c.values[r] for r in rows])
+                        for c in columns]
+        data.rowNumbers = list(rows)
+        self._server.transfer(8 * len(rows) * len(columns))
+        return data
+
+    def read(self, colNumbers, start, stop):
+        return self._data(colNumbers, range(start, stop))
+
+    def slice(self, colNumbers, rowNumbers):
+        return self._data(colNumbers, rowNumbers)
+
+    def getWhereList(self, condition, variables, start, stop, step):
+        import numpy as np
+        from omero.rtypes import unwrap
+        self._server.calls['getWhereList'] += 1
+        namespace = dict((c.name, np.asarray(c.values))
+                         for c in self._state['columns'])
+        namespace.update(unwrap(variables))
+        mask = eval(condition, {'__builtins__': {}}, namespace)
+        rows = [i for i in np.flatnonzero(mask).tolist() if start <= i < stop]
+        return rows[::step or 1]
+
+    def setAllMetadata(self, metadata):
+        self._state['metadata'].update(metadata)
+
+    def getAllMetadata(self):
+        return dict(self._state['metadata'])
+
+    def getOriginalFile(self):
+        return self._og_file
+
+    def close(self):
+        self.closed = True
+
+
+class _Repositories(object):
+    def __init__(self, descriptions):
+        self.descriptions = descriptions
+
+
+class FakeSharedResources(object):
+    """ stand-in for omero.grid.SharedResources, with an in-memory table
+    service """
+    def __init__(self, server):
+        self._server = server
+
+    def areTablesEnabled(self):
+        return True
+
+    def repositories(self):
+        import omero.model
+        return _Repositories([omero.model.OriginalFileI(1, False)])
+
+    def newTable(self, repository_id, name):
+        import omero.model
+        from omero import rtypes
+        self._server.calls['newTable'] += 1
+        og_file = omero.model.OriginalFileI()
+        og_file.setName(rtypes.rstring(name))
+        og_file.setMimetype(rtypes.rstring('OMERO.tables'))
+        og_file = self._server.save(og_file)
+        self._server.tables[og_file.getId().getValue()] = {'columns': [],
+                                                          'metadata': {}}
+        return FakeTable(self._server, og_file)
+
+    def openTable(self, og_file):
+        self._server.calls['openTable'] += 1
+        file_id = og_file.getId().getValue()
+        if file_id not in self._server.tables:
+            return None
+        return FakeTable(self._server, self._server.objects[file_id])
+
+
+class FakePixelsService(object):
+    """ stand-in for omero.api.IPixels """
+    def __init__(self, server):
+        self._server = server
+
+    def createImage(self, sizeX, sizeY, sizeZ, sizeT, channelList, pixelsType,
+                    name, description, ctx=None):
+        import omero.model
+        from omero import rtypes
+        self._server.calls['createImage'] += 1
+        self._server.transfer(0)
+        image = omero.model.ImageI()
+        image.setName(rtypes.rstring(name))
+        image.setDescription(rtypes.rstring(description))
+        image = self._server.save(image)
+        pixels = omero.model.PixelsI()
+        pixels.setImage(image)
+        pixels.setPixelsType(pixelsType)
+        for setter, size in [(pixels.setSizeX, sizeX), (pixels.setSizeY, sizeY),
+                             (pixels.setSizeZ, sizeZ), (pixels.setSizeT, sizeT),
+                             (pixels.setSizeC, len(channelList))]:
+            setter(rtypes.rint(size))
+        pixels = self._server.save(pixels)
+        image_id = image.getId().getValue()
+        self._server.image_pixels[image_id] = pixels
+        self._server.planes[pixels.getId().getValue()] = {}
+        return rtypes.rlong(image_id)
+
+    def setChannelGlobalMinMax(self, pixelsId, channelIndex, min, max,
+                               ctx=None):
+        self._server.calls['setChannelGlobalMinMax'] += 1
+        self._server.transfer(0)
+        self._server.channel_extrema[(pixelsId, channelIndex)] = (min, max)
+
+
+class FakeRawPixelsStore(object):
+    """ stand-in for omero.api.RawPixelsStore, holding whole planes of
+    big-endian bytes """
+    def __init__(self, server):
+        self._server = server
+        self.pixels_id = None
+        self.closed = False
+
+    def setPixelsId(self, pixelsId, bypassOriginalFile, ctx=None):
+        self._server.transfer(0)
+        self.pixels_id = pixelsId
+
+    def _size_xy(self):
+        pixels = self._server.objects[self.pixels_id]
+        return pixels.getSizeX().getValue(), pixels.getSizeY().getValue()
+
+    def setPlane(self, buf, z, c, t, ctx=None):
+        self._server.calls['setPlane'] += 1
+        self._server.transfer(len(buf))
+        self._server.bytes_uploaded += len(buf)
+        self._server.planes[self.pixels_id][(z, c, t)] = bytearray(buf)
+
+    def setTile(self, buf, z, c, t, x, y, w, h, ctx=None):
+        self._server.calls['setTile'] += 1
+        self._server.transfer(len(buf))
+        self._server.bytes_uploaded += len(buf)
+        size_x, size_y = self._size_xy()
+        if x != 0 or w != size_x:
+            raise NotImplementedError('only full-width tiles are supported')
+        row_bytes = len(buf) // h
+        planes = self._server.planes[self.pixels_id]
+        plane = planes.setdefault((z, c, t), bytearray(row_bytes * size_y))
+        plane[y * row_bytes:(y + h) * row_bytes] = buf
+
+    def getPlane(self, z, c, t, ctx=None):
+        self._server.transfer(0)
+        return bytes(self._server.planes[self.pixels_id][(z, c, t)])
+
+    def save(self, ctx=None):
+        self._server.calls['savePixels'] += 1
+        self._server.transfer(0)
+        return self._server.objects[self.pixels_id]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeServiceFactory(object):
+    """ stand-in for the session's omero.api.ServiceFactory """
+    def __init__(self, server):
+        self._server = server
+
+    def createRawFileStore(self):
+        self._server.calls['createRawFileStore'] += 1
+        return FakeRawFileStore(self._server)
+
+    def createRawPixelsStore(self):
+        self._server.calls['createRawPixelsStore'] += 1
+        return FakeRawPixelsStore(self._server)
+
+    def sharedResources(self):
+        return FakeSharedResources(self._server)
+
+
+class FakeImportHandle(object):
+    def __init__(self, response):
+        self.response = response
+
+
+class FakeImportProcess(object):
+    """ stand-in for omero.grid.ImportProcess """
+    def __init__(self, server, settings, fileset=None):
+        self._server = server
+        self._settings = settings
+        self._fileset = fileset
+        self._directory = 'user_1/import_%d/' % next(server._ids)
+        self.uploaders = {}
+        self.closed = False
+
+    def _original_file(self, i):
+        import omero.model
+        from omero import rtypes
+        client_path = self._fileset.getFilesetEntry(i).getClientPath()
+        og_file = omero.model.OriginalFileI()
+        og_file.setPath(rtypes.rstring(self._directory))
+        og_file.setName(rtypes.rstring(os.path.basename(
+            client_path.getValue())))
+        return og_file
+
+    def getUploader(self, i):
+        if self._server.repository_dir is not None:
+            self.uploaders[i] = FakeRepositoryFileStore(self._server,
+                                                        self._original_file(i))
+            return self.uploaders[i]
+        # as on a real server, every uploader for an entry writes the same file
+        data = self.uploaders[i].data if i in self.uploaders else None
+        self.uploaders[i] = FakeRawFileStore(self._server, data)
+        return self.uploaders[i]
+
+    def verifyUpload(self, hashes):
+        from pyme_omero.import_policy import CHECKSUMS
+        self._server.calls['verifyUpload'] += 1
+        algorithm = self._settings.checksumAlgorithm.value.getValue()
+        for i, h in enumerate(hashes):
+            data = bytes(self.uploaders[i].data)
+            checksum = CHECKSUMS[algorithm]()
+            checksum.update(data)
+            if checksum.hexdigest() != h:
+                raise ValueError('checksum mismatch for fileset entry %d' % i)
+            if self._server.repository_dir is None:
+                self._server.bytes_uploaded += len(data)
+        name = getattr(self._settings.userSpecifiedName, 'val', 'image')
+        return FakeImportHandle(self._server.create_image(name))
+
+    def close(self):
+        self.closed = True
+
+
+class FakeManagedRepository(object):
+    def __init__(self, server):
+        self._server = server
+
+    def importFileset(self, fileset, settings):
+        self._server.calls['importFileset'] += 1
+        self._server.import_settings.append(settings)
+        return FakeImportProcess(self._server, settings, fileset)
+
+    def root(self):
+        import omero.model
+        from omero import rtypes
+        root = omero.model.OriginalFileI()
+        directory = self._server.repository_dir or '/OMERO/ManagedRepository'
+        root.setPath(rtypes.rstring(os.path.dirname(directory) + '/'))
+        root.setName(rtypes.rstring(os.path.basename(directory)))
+        return root
+
+
+class FakeClient(object):
+    """ stand-in for omero.client, as found at BlitzGateway.c """
+    def __init__(self, server):
+        self._server = server
+        self.sf = FakeServiceFactory(server)
+
+    def getManagedRepository(self):
+        return FakeManagedRepository(self._server)
+
+    def getProperty(self, key):
+        return {'omero.host': 'fake-omero', 'omero.port': '4064'}.get(key, '')
+
+
+class FakeGateway(object):
+    """ stand-in for a logged-in omero.gateway.BlitzGateway """
+    SERVICE_OPTS = None
+
+    def __init__(self, server):
+        self._server = server
+        self._connected = True
+        self.c = FakeClient(server)
+
+    def isConnected(self):
+        return self._connected
+
+    def keepAlive(self):
+        self._server.calls['keepAlive'] += 1
+        return self._connected
+
+    def close(self, hard=True):
+        self._connected = False
+
+    def getUpdateService(self):
+        return FakeUpdateService(self._server)
+
+    def getContainerService(self):
+        return FakeContainerService(self._server)
+
+    def getQueryService(self):
+        return FakeQueryService(self._server)
+
+    def getPixelsService(self):
+        return FakePixelsService(self._server)
+
+    def getUserId(self):
+        return 1
+
+    def deleteObjects(self, graph_spec, obj_ids, deleteAnns=False,
+                      deleteChildren=False, dryRun=False, wait=False):
+        self._server.calls['deleteObjects'] += 1
+        self._server.transfer(0)
+        for oid in obj_ids:
+            self._server.objects.pop(oid, None)
+            pixels = self._server.image_pixels.pop(oid, None)
+            if pixels is not None:
+                pixels_id = pixels.getId().getValue()
+                self._server.objects.pop(pixels_id, None)
+                self._server.planes.pop(pixels_id, None)
+
+    def getObject(self, kind, oid):
+        self._server.calls['getObject'] += 1
+        obj = self._server.objects.get(oid)
+        if obj is None:
+            return None
+        return FakeWrapper(self._server, obj)
+
+    def createFileAnnfromLocalFile(self, localPath, origFilePathAndName=None,
+                                   mimetype=None, ns=None, desc=None):
+        import omero.model
+        from omero import rtypes
+        from pyme_omero.attachments import file_sha1
+        self._server.calls['createFileAnnfromLocalFile'] += 1
+        size = os.path.getsize(localPath)
+        self._server.transfer(size)
+        self._server.bytes_uploaded += size
+        og_file = omero.model.OriginalFileI()
+        og_file.setName(rtypes.rstring(os.path.basename(localPath)))
+        og_file.setSize(rtypes.rlong(size))
+        og_file.setHash(rtypes.rstring(file_sha1(localPath)))
+        og_file = self._server.save(og_file)
+        with open(localPath, 'rb') as f:
+            self._server.files[og_file.getId().getValue()] = bytearray(f.read())
+        ann = omero.model.FileAnnotationI()
+        ann.setFile(og_file)
+        ann.setNs(rtypes.rstring(ns or ''))
+        ann = self._server.save(ann)
+        return FakeWrapper(self._server, ann)
+
+
+class FakeServer(object):
+    def __init__(self, login_latency=0., query_latency=0., rpc_latency=0.,
+                 bandwidth=None, import_latency=0., repository_dir=None):
+        """ shared server state for any number of `FakeGateway` sessions
+
+        Parameters
+        ----------
+        login_latency : float, optional
+            [s] time each login takes, by default 0.
+        query_latency : float, optional
+            [s] time each query service call takes, by default 0.
+        rpc_latency : float, optional
+            [s] round-trip time of each RawFileStore / RawPixelsStore and
+            pixels service call, by default 0.
+        bandwidth : float, optional
+            [bytes/s] throughput of each RawFileStore / RawPixelsStore (and of
+            file annotation uploads), by default None (unlimited). Streams do
+            not slow each other down, as is roughly the case for a few
+            parallel streams to a server on a fast network.
+        import_latency : float, optional
+            [s] time `wait_for_import` takes for the server-side import, by
+            default 0.
+        repository_dir : str, optional
+            directory standing in for the ManagedRepository, which imported
+            files are written to (or linked into, by in-place transfers), by
+            default None (imported files are held in memory)
+        """
+        self.login_latency = login_latency
+        self.query_latency = query_latency
+        self.rpc_latency = rpc_latency
+        self.bandwidth = bandwidth
+        self.import_latency = import_latency
+        self.repository_dir = repository_dir
+        self.import_settings = []
+        self.objects = {}
+        self.children = {}
+        self.annotation_links = {}
+        self.n_logins = 0
+        self.bytes_uploaded = 0
+        self.bytes_downloaded = 0
+        self.files = {}
+        self.tables = {}
+        self.image_pixels = {}
+        self.planes = {}
+        self.channel_extrema = {}
+        self.calls = _Counter()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def login(self):
+        """ open a new session, use as a `SessionPool` factory
+
+        Returns
+        -------
+        FakeGateway
+            connection to this server
+        """
+        time.sleep(self.login_latency)
+        with self._lock:
+            self.n_logins += 1
+        return FakeGateway(self)
+
+    def transfer(self, n_bytes):
+        """ wait as long as one call moving `n_bytes` would take """
+        delay = self.rpc_latency
+        if self.bandwidth:
+            delay += n_bytes / float(self.bandwidth)
+        if delay > 0:
+            time.sleep(delay)
+
+    def save(self, obj):
+        from omero import rtypes
+        with self._lock:
+            if obj.getId() is None:
+                obj.setId(rtypes.rlong(next(self._ids)))
+        if hasattr(obj, 'parent') and hasattr(obj, 'child'):
+            self.children.setdefault(obj.parent.getId().getValue(),
+                                     []).append(obj.child.getId().getValue())
+        else:
+            self.objects[obj.getId().getValue()] = obj
+        return obj
+
+    def linked_ids(self, parent_id):
+        """ IDs of everything linked to an object, in the order linked """
+        annotations = [ann.getId() for ann in
+                       self.annotation_links.get(parent_id, [])]
+        return self.children.get(parent_id, []) + [getattr(i, 'val', i)
+                                                   for i in annotations]
+
+    def add_original_file(self, data):
+        """ store file contents server-side
+
+        Returns
+        -------
+        int
+            OriginalFile ID
+        """
+        with self._lock:
+            file_id = next(self._ids)
+        self.files[file_id] = bytearray(data)
+        return file_id
+
+    def create_image(self, name):
+        """ create an Image as a server-side import would
+
+        Returns
+        -------
+        object
+            import response, with the image at `.pixels[0].image`
+        """
+        import omero.model
+        from omero import rtypes
+        image = omero.model.ImageI()
+        image.setName(rtypes.rstring(name))
+        image = self.save(image)
+        return _ImportResponse(image)
+
+    def file_import(self, client, filename, wait=-1):
+        """ stand-in for `pyme_omero.core.file_import` which creates an Image
+        rather than uploading `filename`
+        """
+        return self.create_image(filename)
+
+    def wait_for_import(self, client, handle, wait):
+        """ stand-in for `pyme_omero.import_utils.wait_for_import`, which
+        needs a live Ice communicator for its callback
+        """
+        if wait == 0:
+            return None
+        time.sleep(self.import_latency)
+        return handle.response
+
+
+class _Counter(dict):
+    def __missing__(self, key):
+        return 0
+
+
+class _ImportResponse(object):
+    def __init__(self, image):
+        self.pixels = [_Pixels(image)]
+
+
+class _Pixels(object):
+    def __init__(self, image):
+        self.image = image
@@ -0,0 +1,83 @@
+"""
+Import-cost measurement with ``python -X importtime``, used to keep PYME plugin
+discovery cheap: importing pyme-omero's plugin modules (and `pyme_omero.core`)
+should neither take long nor pull in omero, Ice or yaml.
+"""
+
+import subprocess
+import sys
+import logging
+
+logger = logging.getLogger(__name__)
+
+PLUGIN_MODULES = ['pyme_omero.recipe_modules.omero_upload',
+                  'pyme_omero.dsviewer_modules.omero_io',
+                  'pyme_omero.visgui_modules.omero_loader']
+# modules which should only be imported once OMERO is actually used
+HEAVY_PACKAGES = ('omero', 'omero_version', 'Ice', 'IcePy', 'yaml')
+
+_MARKER = '--- pyme_omero.testing.importtime ---'
+
+
+def parse_importtime(stderr):
+    """ parse ``-X importtime`` output
+
+    Returns
+    -------
+    list
+        (module name, nesting level, self [us], cumulative [us]) per import
+    """
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        entries.append((name.strip(), level, int(self_us), int(cumulative_us)))
+    return entries
+
+def import_cost(module, preload=(), python=sys.executable):
+    """ import a module in a fresh interpreter and measure what it costs
+
+    Parameters
+    ----------
+    module : str
+        module to import
+    preload : list, optional
+        modules to import first, whose cost is not counted, e.g. the parts of
+        PYME and wx a plugin module needs which the host application has
+        already loaded
+    python : str, optional
+        interpreter to use, by default this one
+
+    Returns
+    -------
+    dict
+        module, import_ms (cumulative, excluding `preload`), n_modules
+        imported, and heavy_imports, any modules from `HEAVY_PACKAGES` which
+        were imported
+
+    Raises
+    ------
+    ImportError
+        if `preload` or `module` can't be imported
+    """
+    code = ''.join('import %s\n' % m for m in preload)
+    code += 'import sys\nsys.stderr.write(%r + "\\n")\nimport %s\n' % (
+        _MARKER, module)
+    proc = subprocess.run([python, '-X', 'importtime', '-c', code],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    if proc.returncode != 0:
+        raise ImportError('importing %s failed:\n%s' % (
+            module, proc.stderr.strip().splitlines()[-1]))
+
+    entries = parse_importtime(proc.stderr.split(_MARKER, 1)[1])
+    heavy = [name for name, _, _, _ in entries
+             if name.split('.')[0] in HEAVY_PACKAGES]
+    return {
+        'module': module,
+        'import_ms': sum(c for _, level, _, c in entries if level == 0) / 1e3,
+        'n_modules': len(entries),
+        'heavy_imports': heavy,
+    }
@@ -0,0 +1,480 @@
+"""
+Chunked transfer of OriginalFiles to and from an OMERO server.
+
+The server refuses RawFileStore reads larger than 1 MB, so files are streamed
+to disk in `MAX_READ_SIZE` chunks, optionally splitting the file into byte
+ranges read in parallel over several RawFileStore handles. `RawFileStoreWriter`
+goes the other way, letting serializers write straight to the server, and
+`RawFileStoreReader` lets readers (e.g. h5py) seek around a file on the server
+without downloading it.
+"""
+
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pyme_omero import metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_READ_SIZE = 1048576  # ome.conditions.ApiUsageException: Max read size is: 1048576
+
+
+class TransferCancelled(IOError):
+    pass
+
+
+class TransferProgress(object):
+    def __init__(self, total=0, callback=None, cancel=None):
+        """ thread-safe byte count aggregated over several transfers, which
+        also lets them be cancelled part-way through
+
+        Parameters
+        ----------
+        total : int, optional
+            total number of bytes expected, can be increased with `expect`
+        callback : callable, optional
+            called as callback(bytes_done, bytes_total) after each update
+        cancel : threading.Event, optional
+            once set, the next update raises `TransferCancelled`, stopping
+            the transfer making it
+        """
+        self.total = total
+        self.done = 0
+        self._callback = callback
+        self._cancel = cancel
+        self._lock = threading.Lock()
+
+    def expect(self, n_bytes):
+        with self._lock:
+            self.total += n_bytes
+
+    def check(self):
+        """ raise `TransferCancelled` if the transfers have been cancelled """
+        if self._cancel is not None and self._cancel.is_set():
+            raise TransferCancelled('transfer cancelled')
+
+    def add(self, n_bytes):
+        self.check()
+        with self._lock:
+            self.done += n_bytes
+            done, total = self.done, self.total
+        if self._callback is not None:
+            self._callback(done, total)
+
+
+def read_range(raw_file_store, f, start, stop, chunk_size=MAX_READ_SIZE,
+               progress=None):
+    """ copy bytes [start, stop) of the RawFileStore's current file into `f` at
+    the same offsets, one chunk at a time
+
+    Parameters
+    ----------
+    raw_file_store : omero.api.RawFileStorePrx
+        store with its file ID already set
+    f : file
+        open, writable, seekable binary file
+    start : int
+        first byte to copy
+    stop : int
+        one past the last byte to copy
+    chunk_size : int, optional
+        bytes per read, capped at `MAX_READ_SIZE`
+    progress : TransferProgress, optional
+        updated after each chunk
+
+    Returns
+    -------
+    int
+        number of bytes copied
+    """
+    chunk_size = min(int(chunk_size), MAX_READ_SIZE)
+    offset = start
+    f.seek(start)
+    while offset < stop:
+        chunk = raw_file_store.read(offset, min(chunk_size, stop - offset))
+        if not chunk:
+            raise IOError('unexpected end of file at byte %d of %d' % (offset,
+                                                                      stop))
+        f.write(chunk)
+        offset += len(chunk)
+        if progress is not None:
+            progress.add(len(chunk))
+    return offset - start
+
+def create_raw_file_store(connection):
+    """ open a new stateful RawFileStore, independent of any others on the
+    same session so several can be used from different threads
+    """
+    return connection.c.sf.createRawFileStore()
+
+def _download_range(connection, file_id, path, start, stop, chunk_size,
+                    progress=None):
+    raw_file_store = create_raw_file_store(connection)
+    try:
+        raw_file_store.setFileId(file_id)
+        with open(path, 'r+b') as f:
+            return read_range(raw_file_store, f, start, stop, chunk_size,
+                              progress)
+    finally:
+        raw_file_store.close()
+
+def download_original_file(connection, file_id, size, path,
+                           chunk_size=MAX_READ_SIZE, n_streams=1,
+                           progress=None):
+    """ stream an OriginalFile to disk, holding at most one chunk per stream in
+    memory
+
+    Parameters
+    ----------
+    connection : omero.gateway.BlitzGateway
+        an open connection to an OMERO server
+    file_id : int
+        ID of the OriginalFile
+    size : int
+        size of the OriginalFile in bytes
+    path : str
+        where to write the file
+    chunk_size : int, optional
+        bytes per read, capped at `MAX_READ_SIZE`
+    n_streams : int, optional
+        number of RawFileStore handles to read byte ranges with in parallel,
+        by default 1
+    progress : TransferProgress, optional
+        updated as chunks arrive
+
+    Returns
+    -------
+    str
+        `path`
+    """
+    chunk_size = min(int(chunk_size), MAX_READ_SIZE)
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+    n_streams = max(1, min(int(n_streams), -(-size // chunk_size)))
+    with metrics.span('download', file_id=file_id, streams=n_streams) as span:
+        if n_streams == 1:
+            span.add_bytes(_download_range(connection, file_id, path, 0, size,
+                                           chunk_size, progress))
+            return path
+
+        # split into contiguous ranges, aligned to the chunk size
+        chunks = -(-size // chunk_size)
+        bounds = [min(size, (i * chunks // n_streams) * chunk_size)
+                  for i in range(n_streams + 1)]
+        bounds[-1] = size
+        with ThreadPoolExecutor(max_workers=n_streams) as pool:
+            futures = [pool.submit(_download_range, connection, file_id, path,
+                                   start, stop, chunk_size, progress)
+                       for start, stop in zip(bounds[:-1], bounds[1:])]
+            n_bytes = sum(future.result() for future in futures)
+        span.add_bytes(n_bytes)
+    logger.debug('downloaded %d bytes over %d streams' % (n_bytes, n_streams))
+    return path
+
+
+class RawFileStoreWriter(io.RawIOBase):
+    def __init__(self, raw_file_store, block_size=MAX_READ_SIZE):
+        """ writable, seekable file-like object over a RawFileStore, e.g. an
+        import uploader, so data can be serialized straight to the server
+        without a local temporary file.
+
+        Writes are buffered into `block_size` chunks. The SHA-1 of the file is
+        computed as data is sent; if the writer seeks back and overwrites data
+        which has already been sent (e.g. a TIFF writer patching offsets) the
+        digest is instead computed at the end by reading the file back.
+
+        Parameters
+        ----------
+        raw_file_store : omero.api.RawFileStorePrx
+            store with its file ID already set
+        block_size : int, optional
+            bytes per write, capped at `MAX_READ_SIZE`
+        """
+        io.RawIOBase.__init__(self)
+        self._rfs = raw_file_store
+        self._block_size = min(int(block_size), MAX_READ_SIZE)
+        self._pos = 0
+        self._size = 0
+        self._buf = bytearray()
+        self._buf_start = 0
+        self._sha1 = hashlib.sha1()
+        self._hashed = 0  # length of the contiguous prefix fed to _sha1
+        self._rehash = False
+        self.n_writes = 0
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return False
+
+    @property
+    def size(self):
+        return max(self._size, self._buf_start + len(self._buf))
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._flush_buffer()
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self._size + offset
+        else:
+            raise ValueError('invalid whence (%r)' % whence)
+        return self._pos
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError('write to closed file')
+        b = memoryview(b).cast('B')
+        if self._pos != self._buf_start + len(self._buf):
+            self._flush_buffer()
+            self._buf_start = self._pos
+        self._buf += b
+        self._pos += len(b)
+        while len(self._buf) >= self._block_size:
+            self._send(self._buf[:self._block_size], self._buf_start)
+            del self._buf[:self._block_size]
+            self._buf_start += self._block_size
+        return len(b)
+
+    def flush(self):
+        self._flush_buffer()
+
+    def _flush_buffer(self):
+        if self._buf:
+            self._send(self._buf, self._buf_start)
+        self._buf_start += len(self._buf)
+        self._buf = bytearray()
+
+    def _send(self, data, offset):
+        data = bytes(data)
+        self._rfs.write(data, offset, len(data))
+        self.n_writes += 1
+        if offset == self._hashed and not self._rehash:
+            self._sha1.update(data)
+            self._hashed += len(data)
+        else:
+            # overwrite of data already hashed, or a hole
+            self._rehash = True
+        self._size = max(self._size, offset + len(data))
+
+    def hexdigest(self):
+        """ flush, and return the SHA-1 of everything written
+
+        Returns
+        -------
+        str
+            hex SHA-1 digest
+        """
+        self._flush_buffer()
+        if self._rehash:
+            logger.debug('re-reading %d bytes to hash them' % self._size)
+            sha1 = hashlib.sha1()
+            for offset in range(0, self._size, MAX_READ_SIZE):
+                sha1.update(self._rfs.read(offset, min(MAX_READ_SIZE,
+                                                       self._size - offset)))
+            return sha1.hexdigest()
+        return self._sha1.hexdigest()
+
+    def close(self):
+        if not self.closed:
+            self._flush_buffer()
+        io.RawIOBase.close(self)
+
+
+class RawFileStoreReader(io.RawIOBase):
+    def __init__(self, raw_file_store, size=None, block_size=MAX_READ_SIZE,
+                 cache_blocks=64, read_ahead=2, close_store=False):
+        """ read-only, seekable file-like object over a RawFileStore, so that
+        e.g. h5py can open a file on the server and fetch only the byte
+        ranges it touches.
+
+        The file is read in `block_size` blocks, the most recently used
+        `cache_blocks` of which are kept in memory. Once reads are sequential
+        the next `read_ahead` blocks are fetched in the background.
+
+        Parameters
+        ----------
+        raw_file_store : omero.api.RawFileStorePrx
+            store with its file ID already set
+        size : int, optional
+            file size in bytes, by default asked of the store
+        block_size : int, optional
+            bytes per read, capped at `MAX_READ_SIZE`
+        cache_blocks : int, optional
+            number of blocks to keep in memory, by default 64
+        read_ahead : int, optional
+            number of blocks to prefetch during sequential reads, by default
+            2. 0 disables read-ahead.
+        close_store : bool, optional
+            close `raw_file_store` when this is closed, by default False
+        """
+        io.RawIOBase.__init__(self)
+        self._rfs = raw_file_store
+        self._size = raw_file_store.size() if size is None else int(size)
+        self._block_size = min(int(block_size), MAX_READ_SIZE)
+        self.cache_blocks = max(1, cache_blocks)
+        self.read_ahead = read_ahead
+        self._close_store = close_store
+        self._pos = 0
+        self._last_block = None
+
+        self._lock = threading.Lock()  # serialize calls on the stateful store
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._pending = {}
+        self._prefetcher = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='omero-read-ahead')
+        self.n_fetched = 0
+        self.bytes_fetched = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    @property
+    def size(self):
+        return self._size
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._size + offset
+        else:
+            raise ValueError('invalid whence (%r)' % whence)
+        if pos < 0:
+            raise ValueError('negative seek position %d' % pos)
+        self._pos = pos
+        return self._pos
+
+    def readinto(self, b):
+        if self.closed:
+            raise ValueError('read from closed file')
+        out = memoryview(b).cast('B')
+        n = max(0, min(len(out), self._size - self._pos))
+        done = 0
+        while done < n:
+            index, start = divmod(self._pos + done, self._block_size)
+            block = self._get_block(index)
+            count = min(n - done, len(block) - start)
+            out[done:done + count] = block[start:start + count]
+            done += count
+        self._pos += n
+        return n
+
+    def _get_block(self, index):
+        with self._cache_lock:
+            try:
+                self._cache.move_to_end(index)
+                block = self._cache[index]
+                pending = None
+            except KeyError:
+                block = None
+                pending = self._pending.get(index)
+
+        if block is None:
+            if pending is not None:  # already being read ahead
+                block = pending.result()
+            else:
+                block = self._fetch_and_cache(index)
+
+        sequential = self._last_block is not None and index in (
+            self._last_block, self._last_block + 1)
+        self._last_block = index
+        if sequential:
+            self._prefetch(index)
+        return block
+
+    def _fetch_and_cache(self, index):
+        offset = index * self._block_size
+        with self._lock:
+            block = self._rfs.read(offset, min(self._block_size,
+                                               self._size - offset))
+        self.n_fetched += 1
+        self.bytes_fetched += len(block)
+        with self._cache_lock:
+            self._cache[index] = block
+            self._cache.move_to_end(index)
+            while len(self._cache) > self.cache_blocks:
+                self._cache.popitem(last=False)
+        return block
+
+    def _prefetch(self, index):
+        n_blocks = -(-self._size // self._block_size)
+        for ahead in range(index + 1, min(index + 1 + self.read_ahead,
+                                          n_blocks)):
+            with self._cache_lock:
+                if ahead in self._cache or ahead in self._pending:
+                    continue
+                try:
+                    future = self._prefetcher.submit(self._fetch_and_cache,
+                                                     ahead)
+                except RuntimeError:  # closed
+                    return
+                self._pending[ahead] = future
+            future.add_done_callback(lambda f, ahead=ahead:
+                                     self._done_prefetch(ahead))
+
+    def _done_prefetch(self, index):
+        with self._cache_lock:
+            self._pending.pop(index, None)
+
+    def close(self):
+        if not self.closed:
+            self._prefetcher.shutdown(wait=True)
+            if self._close_store:
+                self._rfs.close()
+            with self._cache_lock:
+                self._cache.clear()
+        io.RawIOBase.close(self)
+
+
+def open_original_file(connection, file_id, size=None, **kwargs):
+    """ open an OriginalFile on the server for random-access reading, on its
+    own RawFileStore which is closed along with the returned file
+
+    Parameters
+    ----------
+    connection : omero.gateway.BlitzGateway
+        an open connection to an OMERO server, which must stay open while the
+        file is in use
+    file_id : int
+        ID of the OriginalFile
+    size : int, optional
+        size of the OriginalFile in bytes, by default asked of the server
+    **kwargs
+        passed to `RawFileStoreReader`, e.g. cache_blocks
+
+    Returns
+    -------
+    RawFileStoreReader
+        file-like object, positioned at the start of the file
+    """
+    raw_file_store = create_raw_file_store(connection)
+    try:
+        raw_file_store.setFileId(file_id)
+        return RawFileStoreReader(raw_file_store, size, close_store=True,
+                                  **kwargs)
+    except:
+        raw_file_store.close()
+        raise
@@ -0,0 +1,254 @@
+"""
+Background upload queue.
+
+Uploads are submitted as two stages: a `transfer` stage which sends bytes to
+the server and a `finish` stage which waits on the server-side import and
+links the result. Transfers run on their own worker pool, so the next file's
+bytes are sent while the server is still importing the previous one. Callers
+(recipe modules, GUI handlers) get an `UploadJob` back immediately.
+
+A job holds what its transfer returns (e.g. an OMERO connection, which the
+import handle is bound to) until its finish stage is done, so the number of
+jobs between the two is bounded. Only the most recent finished jobs are kept
+for `status`.
+"""
+
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import logging
+
+logger = logging.getLogger(__name__)
+
+QUEUED, TRANSFERRING, IMPORTING, DONE, FAILED = ('queued', 'transferring',
+                                                 'importing', 'done', 'failed')
+
+
+class UploadJob(object):
+    def __init__(self, job_id, description=''):
+        """ handle on a submitted upload
+
+        Parameters
+        ----------
+        job_id : int
+            ID, unique within the `UploadQueue`
+        description : str, optional
+            human-readable description, e.g. the file being uploaded
+        """
+        self.id = job_id
+        self.description = description
+        self.status = QUEUED
+        self.submitted = time.time()
+        self.finished = None
+        self.future = Future()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        """ block until the job is done, returning the result of its last stage
+        or raising its exception
+        """
+        return self.future.result(timeout)
+
+    def __repr__(self):
+        return '<UploadJob %d [%s] %s>' % (self.id, self.status,
+                                           self.description)
+
+
+class UploadQueue(object):
+    def __init__(self, transfer_workers=1, import_workers=2, 
+                 max_in_flight=None, max_finished=100):
+        """ worker pools running the transfer and finish stages of uploads
+
+        Parameters
+        ----------
+        transfer_workers : int, optional
+            number of uploads transferring bytes at once, by default 1
+        import_workers : int, optional
+            number of uploads waiting on server-side import at once, by
+            default 2
+        max_in_flight : int, optional
+            number of uploads between the start of their transfer and the end
+            of their finish stage at once, by default `transfer_workers` +
+            `import_workers`. Further transfers wait for one to finish.
+        max_finished : int, optional
+            number of finished (succeeded or failed) jobs to keep, most recent
+            first, by default 100. Older ones are forgotten.
+        """
+        if max_in_flight is None:
+            max_in_flight = transfer_workers + import_workers
+        self.max_in_flight = max_in_flight
+        self.max_finished = max_finished
+        self._transfer_pool = ThreadPoolExecutor(transfer_workers,
+                                                 thread_name_prefix='omero-transfer')
+        self._import_pool = ThreadPoolExecutor(import_workers,
+                                               thread_name_prefix='omero-import')
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._jobs = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, transfer, finish=None, cleanup=None, description='',
+               abort=None):
+        """ queue an upload
+
+        Parameters
+        ----------
+        transfer : callable
+            called with no arguments on a transfer worker
+        finish : callable, optional
+            called with the return value of `transfer` on an import worker
+        cleanup : callable, optional
+            called with no arguments once the job has succeeded or failed, e.g.
+            to remove temporary files
+        description : str, optional
+            human-readable description of the job
+        abort : callable, optional
+            called with the return value of `transfer` if `finish` will never
+            be, e.g. because the queue has been shut down, to release what it
+            holds (connections, open import processes)
+
+        Returns
+        -------
+        UploadJob
+            handle on the queued job
+        """
+        with self._lock:
+            job = UploadJob(next(self._ids), description)
+            self._jobs[job.id] = job
+        self._transfer_pool.submit(self._run_transfer, job, transfer, finish,
+                                   cleanup, abort)
+        return job
+
+    def get(self, job_id):
+        """ look up a pending job, or one of the most recent finished ones """
+        return self._jobs[job_id]
+
+    @property
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def status(self):
+        """
+        Returns
+        -------
+        dict
+            job ID -> (description, status) for every job pending and the
+            most recent `max_finished` jobs finished
+        """
+        return OrderedDict((job.id, (job.description, job.status))
+                           for job in self.jobs)
+
+    @property
+    def n_pending(self):
+        return len([job for job in self.jobs if not job.done()])
+
+    def wait(self, timeout=None):
+        """ block until all jobs submitted so far are done
+
+        Returns
+        -------
+        bool
+            True if all jobs finished within `timeout`
+        """
+        not_done = wait([job.future for job in self.jobs], timeout)[1]
+        return len(not_done) == 0
+
+    def clear_finished(self):
+        """ forget jobs which have succeeded or failed """
+        with self._lock:
+            for job_id in [k for k, job in self._jobs.items() if job.done()]:
+                del self._jobs[job_id]
+
+    def shutdown(self, wait=True):
+        # transfers hand off to the import pool, so shut that down second
+        self._transfer_pool.shutdown(wait)
+        self._import_pool.shutdown(wait)
+
+    def _run_transfer(self, job, transfer, finish, cleanup, abort=None):
+        # released by _complete / _fail
+        self._in_flight.acquire()
+        job.status = TRANSFERRING
+        try:
+            result = transfer()
+        except BaseException as e:
+            self._fail(job, e, cleanup)
+            return
+
+        if finish is None:
+            self._complete(job, result, cleanup)
+            return
+
+        job.status = IMPORTING
+        try:
+            self._import_pool.submit(self._run_finish, job, finish, result,
+                                     cleanup)
+        except RuntimeError as e:  # shut down
+            if abort is not None:
+                try:
+                    abort(result)
+                except Exception:
+                    logger.exception('abort of %r failed' % job)
+            self._fail(job, e, cleanup)
+
+    def _run_finish(self, job, finish, started, cleanup):
+        try:
+            result = finish(started)
+        except BaseException as e:
+            self._fail(job, e, cleanup)
+            return
+        self._complete(job, result, cleanup)
+
+    def _cleanup(self, job, cleanup):
+        if cleanup is None:
+            return
+        try:
+            cleanup()
+        except Exception:
+            logger.exception('cleanup of %r failed' % job)
+
+    def _complete(self, job, result, cleanup):
+        self._cleanup(job, cleanup)
+        self._in_flight.release()
+        job.status, job.finished = DONE, time.time()
+        logger.info('upload %d (%s) done in %.1f s' % (job.id, job.description,
+                                                       job.finished - job.submitted))
+        job.future.set_result(result)
+        self._forget_finished()
+
+    def _fail(self, job, exception, cleanup):
+        self._cleanup(job, cleanup)
+        self._in_flight.release()
+        job.status, job.finished = FAILED, time.time()
+        logger.error('upload %d (%s) failed: %s' % (job.id, job.description,
+                                                   exception))
+        job.future.set_exception(exception)
+        self._forget_finished()
+
+    def _forget_finished(self):
+        with self._lock:
+            finished = [k for k, job in self._jobs.items() if job.done()]
+            for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+                del self._jobs[job_id]
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+def get_queue():
+    """ get the process-wide upload queue, creating it on first use
+
+    Returns
+    -------
+    UploadQueue
+        shared upload queue
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = UploadQueue()
+        return _queue
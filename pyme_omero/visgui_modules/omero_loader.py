@@ -1,5 +1,6 @@
 
 import wx
+from traits.api import HasTraits, Enum, Bool
 import logging
 
 logger=logging.getLogger(__name__)
@@ -32,9 +33,151 @@ class SnapshotDialog(wx.Dialog):
 
         self.SetSizerAndFit(v_sizer)
 
-class OMEROLoader(object):
+class IncrementalLoad(object):
+    PROGRESS_RANGE = 1000
+
+    def __init__(self, loader, image_url, poll_ms=100):
+        """ open the localization files attached to an OMERO image as they
+        download, rather than freezing VisGUI until they all have. The first
+        (primary) file is opened as soon as it lands and the others are added
+        as data sources as they follow, while a progress dialog shows the
+        bytes downloaded and can cancel the rest.
+
+        Downloads run on background threads; the pipeline is only touched
+        from the GUI thread, by a timer polling the downloads.
+
+        Parameters
+        ----------
+        loader : OMEROLoader
+            loader plugin, whose pipeline and temporary directory to use
+        image_url : str
+            url from OMERO web client, see
+            `pyme_omero.core.download_localization_files`
+        poll_ms : int, optional
+            how often to check for finished downloads, by default 100 ms
+        """
+        import threading
+        self.loader = loader
+        self.image_url = image_url
+        self.poll_ms = poll_ms
+        self.futures = []
+        self._handled = set()
+        self._cancel = threading.Event()
+        self._bytes = (0, 0)
+        self._dialog = None
+        self._timer = None
+    
+    def _on_progress(self, done, total):
+        # download threads; picked up by the next poll
+        self._bytes = (done, total)
+    
+    def start(self):
+        from pyme_omero.core import download_localization_files
+
+        self.futures = download_localization_files(
+            self.image_url, self.loader._tempdir.name,
+            progress=self._on_progress, cancel=self._cancel)
+        if len(self.futures) == 0:
+            logger.error('No localization files attached to %s' % 
+                         self.image_url)
+            return
+        
+        frame = self.loader.vis_frame
+        self._dialog = wx.ProgressDialog('Open OMERO', 
+                                         'Downloading localizations...',
+                                         maximum=self.PROGRESS_RANGE, 
+                                         parent=frame,
+                                         style=wx.PD_CAN_ABORT | 
+                                         wx.PD_ELAPSED_TIME | 
+                                         wx.PD_REMAINING_TIME)
+        self._timer = wx.Timer(frame)
+        frame.Bind(wx.EVT_TIMER, self.OnPoll, self._timer)
+        self._timer.Start(self.poll_ms)
+    
+    def cancel(self):
+        """ stop the downloads still running and drop those not started.
+        Anything already opened stays open.
+        """
+        self._cancel.set()
+        for future in self.futures:
+            future.cancel()
+        self._finish()
+    
+    def _finish(self):
+        if self._timer is not None:
+            self._timer.Stop()
+            self.loader.vis_frame.Unbind(wx.EVT_TIMER, handler=self.OnPoll,
+                                         source=self._timer)
+            self._timer = None
+        if self._dialog is not None:
+            self._dialog.Destroy()
+            self._dialog = None
+    
+    def OnPoll(self, wx_event=None):
+        done, total = self._bytes
+        n_done = len([f for f in self.futures if f.done()])
+        # keep below the maximum, which would auto-hide / end the dialog
+        value = int((self.PROGRESS_RANGE - 1) * done / total) if total else 0
+        keep_going, _ = self._dialog.Update(value, 
+                                            'Downloaded %d of %d files '
+                                            '(%.1f of %.1f MB)' % (
+                                                n_done, len(self.futures),
+                                                done / 1e6, total / 1e6))
+        if not keep_going:
+            logger.info('Open OMERO cancelled')
+            self.cancel()
+            return
+        
+        self._open_ready()
+        if self._timer is not None and n_done == len(self.futures):
+            self._finish()
+    
+    def _open_ready(self):
+        import os
+        pipeline = self.loader.pipeline
+        primary = self.futures[0]
+        if primary not in self._handled:
+            if not primary.done():
+                # secondaries are added once the primary has been opened
+                return
+            self._handled.add(primary)
+            try:
+                path = primary.result()
+            except Exception as e:
+                logger.error('Failed to download %s: %s' % (self.image_url, e))
+                self.cancel()
+                wx.MessageBox('Failed to download localizations:\n%s' % e,
+                              'Open OMERO', wx.OK | wx.ICON_ERROR, 
+                              self.loader.vis_frame)
+                return
+            pipeline.OpenFile(path)
+            self.loader.vis_frame.SetFit()
+            self.loader.vis_frame.add_pointcloud_layer()
+        
+        for future in self.futures[1:]:
+            if not future.done() or future in self._handled:
+                continue
+            self._handled.add(future)
+            try:
+                path = future.result()
+            except Exception as e:
+                logger.error('Failed to download localizations from %s: %s' %
+                             (self.image_url, e))
+                continue
+            name = os.path.splitext(os.path.split(path)[-1])[0]
+            pipeline.addDataSource(name, pipeline._ds_from_file(path))
+
+
+class OMEROLoader(HasTraits):
+    # how snapshot attachments are serialized, as for the recipe modules, see
+    # pyme_omero.recipe_modules.omero_upload.ImageUpload
+    attachment_encoding = Enum(['hdf', 'hdf-blosc', 'hdf-zstd', 'parquet', 
+                                'feather'])
+    downcast_attachments = Bool(False)
+
     def __init__(self, vis_frame):
         from tempfile import TemporaryDirectory
+        HasTraits.__init__(self)
         self._tempdir = TemporaryDirectory()
         self.vis_frame = vis_frame
         self.pipeline = vis_frame.pipeline
@@ -42,14 +185,13 @@ class OMEROLoader(object):
         logging.debug('Adding menu items for OMERO loading')
         vis_frame.AddMenuItem('File', 'Open OMERO', self.OnOpenOMERO)
         vis_frame.AddMenuItem('File>Save to OMERO', 'Snapshot', self.OnSaveSnapshot)
+        vis_frame.AddMenuItem('File>Save to OMERO', 'Snapshot Options', self.OnSnapshotOptions)
         vis_frame.AddMenuItem('File>Save to OMERO', 'PNG', self.OnSavePNG)
         vis_frame.AddMenuItem('File>Save to OMERO', 'OME Tif', self.OnSaveTif)
         vis_frame.AddMenuItem('File>Save to OMERO', 'From Recipe', self.OnSaveFromRecipe)
 
     def OnOpenOMERO(self, wx_event=None):
-        from pyme_omero.core import localization_files_from_image_url
         import wx
-        import os
         dlg = wx.TextEntryDialog(self.vis_frame, 'OMERO URL', 
                                  'URL to OMERO image with attached localizations', '')
 
@@ -61,22 +203,19 @@ class OMEROLoader(object):
         
         dlg.Destroy()
 
-        paths = localization_files_from_image_url(image_url, self._tempdir.name)
-
-        data_sources = {}
-        for p_ind in range(1, len(paths)):
-            ds = self.pipeline._ds_from_file(paths[p_ind])
-            name = os.path.splitext(os.path.split(paths[p_ind])[-1])[0]
-            data_sources[name] = ds
-            self.pipeline.addDataSource(name, ds)
-        
-        self.pipeline.OpenFile(paths[0])
-        self.vis_frame.SetFit()
-        self.vis_frame.add_pointcloud_layer()
+        if getattr(self, '_load', None) is not None:
+            self._load.cancel()
+        # keep a reference so the load isn't garbage collected mid-way
+        self._load = IncrementalLoad(self, image_url)
+        self._load.start()
+    
+    def OnSnapshotOptions(self, wx_event=None):
+        self.configure_traits(kind='modal')
     
     def OnSaveSnapshot(self, wx_event=None):
-        from pyme_omero import core
+        from pyme_omero import core, serialization
         from PYME.IO import unifiedIO
+        from tempfile import TemporaryDirectory
         import os
         import PIL
         import wx
@@ -95,36 +234,54 @@ class OMEROLoader(object):
         
         img = img.transpose(PIL.Image.FLIP_TOP_BOTTOM)
         
-        snapshot = os.path.join(self._tempdir.name, file_stub + '.png')
+        # files of each snapshot get their own directory, removed once its
+        # (queued) upload is done, so later snapshots can't overwrite them
+        job_dir = TemporaryDirectory()
+        snapshot = os.path.join(job_dir.name, file_stub + '.png')
         img.save(snapshot)
 
         dlg = SnapshotDialog(self.vis_frame)
         ret = dlg.ShowModal()
         
-        if ret == wx.ID_OK:
+        if ret != wx.ID_OK:
+            job_dir.cleanup()
+            return
+        
+        try:
             project = str(dlg.project.GetValue())
             dataset = str(dlg.dataset.GetValue())
             
             # upload the currently selected datasource as an hdf file
             current_key = self.pipeline.selectedDataSourceKey
-            current = os.path.join(self._tempdir.name, current_key + '.hdf')
+            current = os.path.join(job_dir.name, current_key + 
+                                   serialization.tabular_extension(self.attachment_encoding))
             try:
                 mdh = self.pipeline.selectedDataSource.mdh
             except AttributeError:
                 mdh = self.pipeline.mdh
-            self.pipeline.selectedDataSource.to_hdf(current, 
-                                                    self.pipeline.selectedDataSourceKey, 
-                                                    metadata=mdh)
+            serialization.save_tabular(self.pipeline.selectedDataSource, 
+                                       current, current_key, mdh, 
+                                       self.attachment_encoding, 
+                                       self.downcast_attachments)
             attachments = [current]
             
             # include farthest upstream file (complete, e.g. w/ acquisition events)
-            image_id = core.upload_image_from_file(snapshot, dataset, project, attachments)
-            try:
-                with core.local_or_named_temp_filename(self.pipeline.filename) as f:
-                    core.connect_and_upload_file_annotation(image_id, f,
-                                                            namespace='pyme.localizations')
-            except (AttributeError, IOError) as e:
-                logger.error(e)
+            upstream = getattr(self.pipeline, 'filename', None)
+            def attach_upstream(image_id):
+                try:
+                    with core.local_or_named_temp_filename(upstream) as f:
+                        core.connect_and_upload_file_annotation(image_id, f,
+                                                                namespace='pyme.localizations')
+                except (AttributeError, TypeError, IOError) as e:
+                    logger.error(e)
+            
+            # upload in the background rather than blocking the GUI
+            core.submit_image_upload(snapshot, dataset, project, attachments,
+                                     callback=attach_upstream, 
+                                     cleanup=job_dir.cleanup)
+        except:
+            job_dir.cleanup()
+            raise
 
     def OnSavePNG(self, wx_event=None):
         from pyme_omero.recipe_modules import omero_upload
@@ -142,7 +299,8 @@ class OMEROLoader(object):
                                         inputLocalizations=self.pipeline.selectedDataSourceKey,
                                         outputImage='thumbnail_rendering'))
         rec.add_module(omero_upload.RGBImageUpload(rec,
-                                                    input_image='thumbnail_rendering'))
+                                                    input_image='thumbnail_rendering',
+                                                    background_upload=True))
         if rec.configure_traits(view=rec.pipeline_view, kind='modal'):
             rec.execute()
             rec.save(context)
@@ -163,7 +321,8 @@ class OMEROLoader(object):
                                         inputLocalizations=self.pipeline.selectedDataSourceKey,
                                         outputImage='thumbnail_rendering'))
         rec.add_module(omero_upload.ImageUpload(rec,
-                                                input_image='thumbnail_rendering'))
+                                                input_image='thumbnail_rendering',
+                                                background_upload=True))
         if rec.configure_traits(view=rec.pipeline_view, kind='modal'):
             rec.execute()
             rec.save(context)
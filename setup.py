@@ -33,6 +33,10 @@ setup(
     version='20.09.10',
     description='pyme-omero interoperability',
     packages=find_packages(),
+    extras_require={
+        # Murmur3 import checksums, see pyme_omero.import_policy
+        'murmur': ['mmh3'],
+    },
     cmdclass={
         'develop': DevelopModuleAndInstallPlugin,
         'install': InstallModuleAndInstallPlugin,
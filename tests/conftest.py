@@ -0,0 +1,25 @@
+import pytest
+
+
+@pytest.fixture
+def use_session_pool(monkeypatch):
+    """ install a SessionPool as `pyme_omero.core`'s pool for one test, e.g.
+    ``pool = use_session_pool(SessionPool(server.login))``, with empty
+    container and attachment caches, as `core.set_session_pool` would. The
+    pool is closed, and the previous pool and caches restored, once the test
+    is done.
+    """
+    from pyme_omero import attachments, containers, core
+
+    pools = []
+    def use(pool):
+        monkeypatch.setattr(core, '_session_pool', pool)
+        monkeypatch.setattr(core, 'container_cache', 
+                            containers.ContainerCache())
+        monkeypatch.setattr(core, 'attachment_index', 
+                            attachments.AttachmentIndex())
+        pools.append(pool)
+        return pool
+    yield use
+    for pool in pools:
+        pool.close()
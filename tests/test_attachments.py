@@ -0,0 +1,78 @@
+import os
+import pytest
+
+from pyme_omero.attachments import AttachmentIndex, file_sha1
+
+
+def test_index_rehashes_only_modified_files(tmp_path):
+    path = str(tmp_path / 'test.h5r')
+    with open(path, 'wb') as f:
+        f.write(b'abc')
+    index = AttachmentIndex()
+    assert index.sha1(path) == file_sha1(path)
+
+    with open(path, 'ab') as f:
+        f.write(b'def')
+    assert index.sha1(path) == file_sha1(path)
+
+
+def test_duplicate_attachment_is_linked_not_uploaded(tmp_path):
+    pytest.importorskip('omero')
+    from pyme_omero import attachments
+    from pyme_omero.testing.fake_omero import FakeServer
+
+    path = str(tmp_path / 'test.h5r')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(10000))
+
+    server = FakeServer()
+    conn = server.login()
+    first, second = [server.create_image(name).pixels[0].image.getId().getValue()
+                     for name in ('a.png', 'a.tif')]
+    ann = conn.createFileAnnfromLocalFile(path, ns='pyme.localizations')
+    conn.getObject('Image', first).linkAnnotation(ann)
+
+    # a fresh process, so only the server knows about the upload
+    index = AttachmentIndex()
+    digest, ann_id = attachments.attach_existing(conn, index, second, path,
+                                                 'pyme.localizations')
+    assert ann_id == ann.getId()
+    assert index.bytes_saved == 10000
+    # now cached, and linking twice is a no-op
+    calls = server.calls['projection']
+    attachments.attach_existing(conn, index, second, path, 'pyme.localizations')
+    assert server.calls['projection'] == calls + 1  # existing link check only
+    assert server.children[second] == [ann_id]
+    assert server.calls['createFileAnnfromLocalFile'] == 1
+
+    # different namespace, different annotation
+    assert attachments.attach_existing(conn, index, second, path)[1] is None
+
+
+def test_file_annotations_on_image_in_one_query(tmp_path):
+    pytest.importorskip('omero')
+    import omero.model
+    from omero import rtypes
+    from pyme_omero import attachments
+    from pyme_omero.testing.fake_omero import FakeServer
+
+    server = FakeServer()
+    conn = server.login()
+    image = conn.getObject('Image', server.create_image('a.png').pixels[0]
+                           .image.getId().getValue())
+    for i in range(50):
+        tag = omero.model.TagAnnotationI()
+        tag.setTextValue(rtypes.rstring('tag%d' % i))
+        image.linkAnnotation(server.save(tag))
+    for name in ('b.h5r', 'render.png', 'a.hdf'):
+        path = str(tmp_path / name)
+        with open(path, 'wb') as f:
+            f.write(name.encode())
+        image.linkAnnotation(conn.createFileAnnfromLocalFile(path))
+
+    files = attachments.file_annotations_on_image(conn, image.getId(),
+                                                  extensions=['.hdf', '.h5r'])
+
+    assert [f['name'] for f in files] == ['b.h5r', 'a.hdf']
+    assert [f['size'] for f in files] == [5, 5]
+    assert server.calls['projection'] == 1
@@ -0,0 +1,77 @@
+import os
+import pytest
+
+pytest.importorskip('omero')
+from pyme_omero import core, import_utils
+from pyme_omero.connection import SessionPool
+from pyme_omero.testing.fake_omero import FakeServer
+
+
+def test_images_imported_before_a_failure_are_still_linked(
+        tmp_path, monkeypatch, use_session_pool):
+    server = FakeServer()
+    use_session_pool(SessionPool(server.login))
+    n_imports = [0]
+    def wait_for_import(client, handle, wait):
+        n_imports[0] += 1
+        if n_imports[0] == 3:
+            raise RuntimeError('import failed')
+        return server.wait_for_import(client, handle, wait)
+    monkeypatch.setattr(import_utils, 'wait_for_import', wait_for_import)
+    started, start = [], core.start_file_import
+    def start_file_import(*args, **kwargs):
+        started.append(start(*args, **kwargs))
+        return started[-1]
+    monkeypatch.setattr(core, 'start_file_import', start_file_import)
+
+    files = []
+    for i in range(4):
+        files.append(str(tmp_path / ('%d.tif' % i)))
+        with open(files[-1], 'wb') as f:
+            f.write(os.urandom(1000))
+    linked = []
+    with pytest.raises(RuntimeError):
+        core.upload_images_from_files(
+            files, 'dataset', callback=lambda i, image_id: linked.append(i))
+
+    # the file in flight when import 2 failed is still imported and linked
+    assert linked == [0, 1, 3]
+    assert all(proc.closed for proc, handle in started)
+    dataset = [o for o in server.objects.values()
+               if type(o).__name__ == 'DatasetI'][0]
+    assert len(server.linked_ids(dataset.getId().getValue())) == 3
+
+
+def test_batch_attachments_are_created_in_one_call_each(tmp_path, monkeypatch,
+                                                        use_session_pool):
+    server = FakeServer()
+    use_session_pool(SessionPool(server.login))
+    monkeypatch.setattr(import_utils, 'wait_for_import',
+                        server.wait_for_import)
+    # the last attachment is large enough to go through the resumable path
+    monkeypatch.setattr(core, 'RESUMABLE_UPLOAD_SIZE', 5000)
+    monkeypatch.setattr(core, 'upload_journal_dir', 
+                        lambda: str(tmp_path / 'journal'))
+
+    def write(name, size):
+        path = str(tmp_path / name)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        return path
+    files = [write('%d.tif' % i, 1000) for i in range(3)]
+    shared = write('shared.hdf', 1000)
+    own = [write('%d.hdf' % i, 1000) for i in range(2)] + [write('2.hdf', 6000)]
+    image_ids = core.upload_images_from_files(
+        files, 'dataset', attachments=[[shared, a] for a in own])
+
+    assert server.calls['saveAndReturnArray'] == 2
+    assert server.calls['createFileAnnfromLocalFile'] == 0
+    shared_anns = set()
+    for image_id, path in zip(image_ids, own):
+        ann_ids = server.linked_ids(image_id)
+        assert len(ann_ids) == 2
+        shared_anns.add(ann_ids[0])
+        ann = server.objects[ann_ids[1]]
+        with open(path, 'rb') as f:
+            assert server.files[ann.getFile().getId().getValue()] == f.read()
+    assert len(shared_anns) == 1
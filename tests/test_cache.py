@@ -0,0 +1,82 @@
+import os
+from pyme_omero.cache import DownloadCache
+
+
+def _writer(data):
+    def fetch(path):
+        fetch.calls += 1
+        with open(path, 'wb') as f:
+            f.write(data)
+    fetch.calls = 0
+    return fetch
+
+
+def test_hit_miss_and_revalidation(tmp_path):
+    cache = DownloadCache(str(tmp_path))
+    fetch = _writer(b'abc')
+
+    path = cache.get_or_fetch('OriginalFile', 1, 'sha:3', 'locs.h5r', fetch)
+    assert os.path.basename(path) == 'locs.h5r'
+    assert cache.get_or_fetch('OriginalFile', 1, 'sha:3', 'locs.h5r', fetch) == path
+    assert fetch.calls == 1
+
+    # a new process sees the same index
+    cache = DownloadCache(str(tmp_path))
+    assert cache.get('OriginalFile', 1, 'sha:3') == path
+    # changed server-side -> refetched
+    assert cache.get('OriginalFile', 1, 'other:3') is None
+    cache.get_or_fetch('OriginalFile', 1, 'other:3', 'locs.h5r', fetch)
+    assert fetch.calls == 2
+
+
+def test_lru_eviction(tmp_path):
+    cache = DownloadCache(str(tmp_path), max_bytes=25, keep_recent=1)
+    for i in range(3):
+        cache.put('OriginalFile', i, '', 'f.hdf', _writer(b'x' * 10))
+        if i == 1:
+            cache.get('OriginalFile', 0, '')  # 0 is now more recent than 1
+
+    assert cache.get('OriginalFile', 1, '') is None
+    assert cache.get('OriginalFile', 0, '') is not None
+    assert cache.get('OriginalFile', 2, '') is not None
+    assert cache.size == 20
+
+
+def test_recently_returned_entries_are_not_evicted(tmp_path):
+    cache = DownloadCache(str(tmp_path), max_bytes=15, keep_recent=2)
+    paths = [cache.put('OriginalFile', i, '', 'f.hdf', _writer(b'x' * 10))
+             for i in range(2)]
+    # over budget, but both paths may still be open
+    assert all(os.path.exists(p) for p in paths)
+    assert cache.size == 20
+
+    cache.put('OriginalFile', 2, '', 'f.hdf', _writer(b'x' * 10))
+    assert not os.path.exists(paths[0])
+    assert os.path.exists(paths[1])
+
+
+def test_processes_sharing_a_cache_keep_each_others_entries(tmp_path):
+    # two caches on one directory, as two processes would have
+    a = DownloadCache(str(tmp_path), max_bytes=25, keep_recent=1)
+    b = DownloadCache(str(tmp_path), max_bytes=25, keep_recent=1)
+    a.put('OriginalFile', 1, '', 'f.hdf', _writer(b'x' * 10))
+    b.put('OriginalFile', 2, '', 'f.hdf', _writer(b'x' * 10))
+    assert a.get('OriginalFile', 2, '') is not None
+    assert DownloadCache(str(tmp_path)).size == 20
+
+    # b's entry counts against the budget a evicts to
+    a.put('OriginalFile', 3, '', 'f.hdf', _writer(b'x' * 10))
+    assert a.size == 20 and b.size == 20
+    assert b.get('OriginalFile', 1, '') is None
+
+
+def test_same_id_on_different_servers(tmp_path):
+    cache = DownloadCache(str(tmp_path))
+    cache.put('OriginalFile', 1, '', 'f.hdf', _writer(b'a'),
+              server='omero.example.org:4064')
+    cache.put('OriginalFile', 1, '', 'f.hdf', _writer(b'b'),
+              server='localhost:4064')
+    with open(cache.get('OriginalFile', 1, '',
+                        'omero.example.org:4064'), 'rb') as f:
+        assert f.read() == b'a'
+    assert cache.get('OriginalFile', 1, '') is None
@@ -0,0 +1,43 @@
+import io
+import os
+import pytest
+
+requests = pytest.importorskip('requests')
+from pyme_omero import cluster_io
+
+
+class FakeResponse(object):
+    """ streamed response, recording the largest chunk handed out """
+    def __init__(self, data):
+        self.data = data
+        self.max_chunk = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for offset in range(0, len(self.data), chunk_size):
+            chunk = self.data[offset:offset + chunk_size]
+            self.max_chunk = max(self.max_chunk, len(chunk))
+            yield chunk
+
+
+def test_copy_cluster_file_streams_in_bounded_chunks(monkeypatch):
+    data = os.urandom(5 * 65536 + 17)
+    response = FakeResponse(data)
+    monkeypatch.setattr(cluster_io, 'locate',
+                        lambda name, clusterfilter: 'http://node/' + name)
+    monkeypatch.setattr(requests, 'get', lambda url, **kwargs: response)
+
+    f = io.BytesIO()
+    n_bytes = cluster_io.copy_cluster_file('test.h5r', '', f, chunk_size=65536)
+
+    assert n_bytes == len(data)
+    assert f.getvalue() == data
+    assert response.max_chunk == 65536
@@ -0,0 +1,78 @@
+import threading
+from pyme_omero.connection import SessionPool
+
+
+class DummyConnection(object):
+    def __init__(self, healthy=True):
+        self.healthy = healthy
+        self.closed = False
+
+    def keepAlive(self):
+        return self.healthy
+
+    def close(self):
+        self.closed = True
+
+
+def test_connections_are_reused():
+    pool = SessionPool(DummyConnection)
+    for _ in range(5):
+        with pool.connection() as conn:
+            with pool.connection() as nested:
+                assert nested is conn
+    assert pool.n_logins == 1
+    pool.close()
+    assert conn.closed
+
+
+def test_stale_and_unhealthy_connections_are_replaced():
+    pool = SessionPool(DummyConnection, max_idle=0.)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
+    assert first.closed and second is not first
+
+    pool = SessionPool(DummyConnection, check_after=0.)
+    with pool.connection() as first:
+        first.healthy = False
+    with pool.connection() as second:
+        pass
+    assert first.closed and second is not first
+    pool.close()
+
+
+def test_checkout_is_bounded_and_thread_safe():
+    pool = SessionPool(DummyConnection, max_size=2)
+    in_use, max_in_use = set(), [0]
+    lock = threading.Lock()
+
+    def work():
+        for _ in range(20):
+            with pool.connection() as conn:
+                with lock:
+                    assert conn not in in_use
+                    in_use.add(conn)
+                    max_in_use[0] = max(max_in_use[0], len(in_use))
+                with lock:
+                    in_use.remove(conn)
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert max_in_use[0] <= 2
+    assert pool.n_logins <= 2
+    pool.close()
+
+
+def test_dedicated_connections_do_not_use_up_the_pool():
+    pool = SessionPool(DummyConnection, max_size=1)
+    held = [pool.open_dedicated() for _ in range(3)]
+    with pool.connection(timeout=0.1) as conn:
+        assert conn not in held
+    assert pool.n_open == 1 and pool.n_logins == 4
+    pool.close()
+    assert not any(conn.closed for conn in held)
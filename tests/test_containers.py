@@ -0,0 +1,41 @@
+import threading
+import time
+import pytest
+from pyme_omero.containers import ContainerCache
+
+
+def test_cache_expires_and_invalidates():
+    cache = ContainerCache(ttl=0.05)
+    cache.put(('Dataset', 'a', None), 1)
+    cache.put(('Dataset', 'b', None), 2)
+    assert cache.get(('Dataset', 'a', None)) == 1
+    cache.invalidate(('Dataset', 'a', None))
+    assert cache.get(('Dataset', 'a', None)) is None
+    time.sleep(0.1)
+    assert cache.get(('Dataset', 'b', None)) is None
+
+
+def test_concurrent_creation_is_deduplicated():
+    pytest.importorskip('omero')
+    from pyme_omero import containers
+    from pyme_omero.testing.fake_omero import FakeServer
+
+    server = FakeServer(query_latency=0.01)
+    cache = ContainerCache()
+    ids = []
+
+    def resolve():
+        conn = server.login()
+        project_id = containers.get_or_create_project_id(conn, 'p', cache)
+        ids.append(containers.get_or_create_dataset_id(conn, 'd', cache,
+                                                       project_id))
+
+    threads = [threading.Thread(target=resolve) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(set(ids)) == 1
+    assert len(server.objects) == 2  # one project, one dataset
+    assert server.calls['loadContainerHierarchy'] == 0
@@ -0,0 +1,72 @@
+import os
+import time
+import pytest
+
+pytest.importorskip('omero')
+from pyme_omero import core
+from pyme_omero.connection import SessionPool
+from pyme_omero.testing.fake_omero import FakeServer
+
+
+def test_localization_files_download_in_parallel(tmp_path, use_session_pool):
+    server = FakeServer()
+    pool = use_session_pool(SessionPool(server.login))
+    conn = server.login()
+    image_id = server.create_image('a.png').pixels[0].image.getId().getValue()
+    image = conn.getObject('Image', image_id)
+
+    contents = {}
+    for name in ('a.h5r', 'b.hdf', 'c.hdf', 'render.png'):
+        path = str(tmp_path / name)
+        contents[name] = os.urandom(300000)
+        with open(path, 'wb') as f:
+            f.write(contents[name])
+        image.linkAnnotation(conn.createFileAnnfromLocalFile(path))
+
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    progress = []
+    paths = core.localization_files_from_image_url(
+        'https://server/webclient/?show=image-%d' % image_id, str(out_dir),
+        use_cache=False, max_workers=3,
+        progress=lambda done, total: progress.append((done, total)))
+
+    assert [os.path.basename(p) for p in paths] == ['a.h5r', 'b.hdf', 'c.hdf']
+    for path in paths:
+        with open(path, 'rb') as f:
+            assert f.read() == contents[os.path.basename(path)]
+    assert server.calls['createRawFileStore'] == 3
+    assert max(progress) == (900000, 900000)
+    # connection returned once all were done (done-callbacks run just after
+    # the results are set)
+    deadline = time.time() + 1.
+    while pool.n_idle == 0 and time.time() < deadline:
+        time.sleep(0.01)
+    assert pool.n_idle == 1
+
+
+def test_cancelled_downloads_stop(tmp_path, use_session_pool):
+    import threading
+    from pyme_omero.transfer import TransferCancelled
+
+    server = FakeServer()
+    use_session_pool(SessionPool(server.login))
+    conn = server.login()
+    image_id = server.create_image('a.png').pixels[0].image.getId().getValue()
+    image = conn.getObject('Image', image_id)
+    for name in ('a.h5r', 'b.hdf'):
+        path = str(tmp_path / name)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(3000000))
+        image.linkAnnotation(conn.createFileAnnfromLocalFile(path))
+
+    cancel = threading.Event()
+    def progress(done, total):
+        cancel.set()  # after the first chunk
+
+    futures = core.download_localization_files(
+        'https://server/webclient/?show=image-%d' % image_id, str(tmp_path),
+        use_cache=False, max_workers=1, progress=progress, cancel=cancel)
+    for future in futures:
+        with pytest.raises(TransferCancelled):
+            future.result()
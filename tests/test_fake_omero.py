@@ -0,0 +1,18 @@
+import time
+
+from pyme_omero.testing.fake_omero import FakeRawFileStore, FakeServer
+
+
+def test_raw_file_store_latency_and_bandwidth():
+    server = FakeServer(rpc_latency=0.01, bandwidth=10e6)
+    rfs = FakeRawFileStore(server)
+
+    t0 = time.perf_counter()
+    for i in range(5):
+        rfs.write(b'\0' * 100000, i * 100000, 100000)
+    rfs.read(0, 500000)
+    elapsed = time.perf_counter() - t0
+
+    # 6 round trips of 10 ms, 1 MB at 10 MB/s
+    assert 0.16 <= elapsed < 1.
+    assert server.bytes_downloaded == 500000
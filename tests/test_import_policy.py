@@ -0,0 +1,146 @@
+import os
+import zlib
+import hashlib
+import pytest
+
+from pyme_omero.import_policy import ImportPolicy
+
+
+def test_checksums_streamed_and_formatted_as_server():
+    data = os.urandom(300000)
+    for algorithm, expected in [
+            ('SHA1-160', hashlib.sha1(data).hexdigest()),
+            ('CRC-32', zlib.crc32(data).to_bytes(4, 'little').hex()),
+            ('Adler-32', zlib.adler32(data).to_bytes(4, 'little').hex()),
+            ('File-Size-64', '%x' % len(data))]:
+        checksum = ImportPolicy(checksum=algorithm).hasher()
+        for i in range(0, len(data), 65536):
+            checksum.update(data[i:i + 65536])
+        assert checksum.hexdigest() == expected
+
+    with pytest.raises(ValueError):
+        ImportPolicy(checksum='SHA-256')
+    with pytest.raises(ValueError):
+        ImportPolicy(transfer='rsync')
+
+
+def test_murmur_checksum_needs_mmh3_up_front(monkeypatch):
+    import sys
+    monkeypatch.setitem(sys.modules, 'mmh3', None)
+    with pytest.raises(ImportError, match='mmh3'):
+        ImportPolicy(checksum='Murmur3-128')
+
+
+@pytest.mark.parametrize('transfer', ['upload', 'ln'])
+def test_import_against_stand_in_repository(tmp_path, monkeypatch, transfer,
+                                            use_session_pool):
+    pytest.importorskip('omero')
+    from pyme_omero import core, import_utils
+    from pyme_omero.connection import SessionPool
+    from pyme_omero.testing.fake_omero import FakeServer
+
+    repository = tmp_path / 'ManagedRepository'
+    repository.mkdir()
+    server = FakeServer(repository_dir=str(repository))
+    monkeypatch.setattr(import_utils, 'wait_for_import',
+                        server.wait_for_import)
+    use_session_pool(SessionPool(server.login))
+    path = str(tmp_path / 'image.tif')
+    data = os.urandom(2500000)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    policy = ImportPolicy(thumbnails=False, stats=False, checksum='CRC-32',
+                          transfer=transfer)
+    assert core.upload_image_from_file(path, 'dataset', policy=policy)
+
+    [settings] = server.import_settings
+    assert settings.doThumbnails.getValue() is False
+    assert settings.noStatsInfo.getValue() is True
+    assert settings.checksumAlgorithm.value.getValue() == 'CRC-32'
+    [imported] = [os.path.join(d, f) for d, _, files in os.walk(repository)
+                  for f in files]
+    with open(imported, 'rb') as f:
+        assert f.read() == data
+    if transfer == 'ln':
+        assert os.path.samefile(imported, path)
+        assert server.bytes_uploaded == 0
+    else:
+        assert server.bytes_uploaded == len(data)
+
+
+class _Value(object):
+    def __init__(self, value):
+        self._value = value
+
+    def getValue(self):
+        return self._value
+
+
+class _Uploader(object):
+    """ uploader which creates its file on disk, as the server's does """
+    def __init__(self, directory, name):
+        self.og_file = type('OriginalFile', (), {
+            'getPath': lambda s: _Value(str(directory) + '/'),
+            'getName': lambda s: _Value(name)})()
+        self.location = os.path.join(str(directory), name)
+        self.closed = False
+
+    def save(self):
+        return self.og_file
+
+    def write(self, block, offset, length):
+        assert not self.closed
+        with open(self.location, 'ab') as f:
+            f.write(block[:length])
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.mark.parametrize('transfer', ['ln', 'ln_s', 'cp'])
+def test_transfer_closes_uploader_before_placing_file(tmp_path, transfer):
+    path = str(tmp_path / 'image.tif')
+    with open(path, 'wb') as f:
+        f.write(b'pixels')
+    repository = tmp_path / 'repo'
+    repository.mkdir()
+    store = _Uploader(repository, 'image.tif')
+    policy = ImportPolicy(checksum='CRC-32', transfer=transfer)
+
+    checksum = policy.transfer_file(store, path, str(repository))
+    assert store.closed
+    assert checksum == zlib.crc32(b'pixels').to_bytes(4, 'little').hex()
+    with open(store.location, 'rb') as f:
+        assert f.read() == b'pixels'
+
+    # the server's file must be empty before it is replaced
+    store = _Uploader(repository, 'other.tif')
+    store.write = lambda block, offset, length: open(
+        store.location, 'wb').write(b'x')
+    with pytest.raises(IOError):
+        policy.transfer_file(store, path, str(repository))
+    assert store.closed
+
+
+def test_stream_import_applies_policy_but_keeps_sha1(monkeypatch,
+                                                     use_session_pool):
+    pytest.importorskip('omero')
+    from pyme_omero import core, import_utils
+    from pyme_omero.connection import SessionPool
+    from pyme_omero.testing.fake_omero import FakeServer
+
+    server = FakeServer()
+    monkeypatch.setattr(import_utils, 'wait_for_import',
+                        server.wait_for_import)
+    use_session_pool(SessionPool(server.login))
+    monkeypatch.setattr(core, '_import_policy', 
+                        ImportPolicy(thumbnails=False, stats=False, 
+                                     checksum='CRC-32'))
+    assert core.upload_image_from_stream(
+        'image.tif', lambda f: f.write(os.urandom(1000)), 'dataset')
+
+    [settings] = server.import_settings
+    assert settings.doThumbnails.getValue() is False
+    assert settings.noStatsInfo.getValue() is True
+    assert settings.checksumAlgorithm.value.getValue() == 'SHA1-160'
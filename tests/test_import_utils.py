@@ -0,0 +1,71 @@
+import hashlib
+import os
+import pytest
+
+import_utils = pytest.importorskip('pyme_omero.import_utils')
+from pyme_omero.testing.fake_omero import FakeRawFileStore
+
+
+class SingleUploader(object):
+    def __init__(self):
+        self.rfs = FakeRawFileStore()
+
+    def getUploader(self, i):
+        return self.rfs
+
+
+def test_upload_fileset_entry_hashes_in_one_pass(tmp_path):
+    data = os.urandom(2500000)
+    path = str(tmp_path / 'test.h5r')
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    proc = SingleUploader()
+    digest = import_utils.upload_fileset_entry(proc, 0, path,
+                                               block_size=10 * 1048576)
+
+    assert digest == hashlib.sha1(data).hexdigest()
+    assert bytes(proc.rfs.data) == data
+    # touch + 3 blocks, i.e. block size was capped at the server maximum
+    assert proc.rfs.n_writes == 4
+
+
+class FlakyImportProcess(object):
+    """ hands out one uploader per fileset entry, the first of which fails """
+    def __init__(self):
+        self.uploaders = {}
+        self.failed = False
+        self.reopened_while_open = False
+
+    def getUploader(self, i):
+        if i in self.uploaders and not self.uploaders[i].closed:
+            self.reopened_while_open = True
+        rfs = FakeRawFileStore()
+        if i == 0 and not self.failed:
+            self.failed = True
+            def write(block, offset, length):
+                raise IOError('connection dropped')
+            rfs.write = write
+        self.uploaders[i] = rfs
+        return rfs
+
+
+def test_upload_files_parallel_ordered_with_retry(tmp_path):
+    contents = [os.urandom(100000 * (i + 1)) for i in range(6)]
+    paths = []
+    for i, data in enumerate(contents):
+        paths.append(str(tmp_path / ('%d.tif' % i)))
+        with open(paths[-1], 'wb') as f:
+            f.write(data)
+
+    progress = {}
+    proc = FlakyImportProcess()
+    hashes = import_utils.upload_files(
+        proc, paths, max_workers=3,
+        progress=lambda path, sent, total: progress.__setitem__(path, (sent, total)))
+
+    assert hashes == [hashlib.sha1(data).hexdigest() for data in contents]
+    assert [bytes(proc.uploaders[i].data) for i in range(6)] == contents
+    # the failed uploader was closed before another was asked for
+    assert not proc.reopened_while_open
+    assert all(sent == total for sent, total in progress.values())
@@ -0,0 +1,49 @@
+import json
+import pytest
+
+from pyme_omero.metrics import Metrics, Span
+
+
+def test_spans_are_timed_nested_and_histogrammed():
+    metrics = Metrics(buckets=(0.1, 1.))
+    with metrics.span('import', file='a.tif') as outer:
+        with metrics.span('upload', 100) as inner:
+            inner.add_bytes(50)
+    with pytest.raises(IOError):
+        with metrics.span('upload'):
+            raise IOError('connection dropped')
+
+    first, second, third = metrics.spans()
+    assert (first.name, first.n_bytes, first.parent_id) == ('upload', 150,
+                                                            outer.span_id)
+    assert second is outer and outer.parent_id is None
+    assert third.error == 'OSError'
+
+    summary = metrics.summary()
+    assert summary['upload']['count'] == 2
+    assert summary['upload']['bytes'] == 150
+    assert summary['upload']['errors'] == 1
+    assert summary['import']['p50_s'] <= 0.1
+
+    exported = json.loads(metrics.to_json())
+    assert exported['spans'][1]['labels'] == {'file': 'a.tif'}
+
+
+def test_prometheus_textfile(tmp_path):
+    metrics = Metrics(buckets=(0.1, 1.))
+    for i, duration in enumerate((0.05, 0.5, 5.)):
+        span = Span('hash', i, n_bytes=10)
+        span.duration = duration
+        metrics.record(span)
+
+    path = str(tmp_path / 'pyme_omero.prom')
+    metrics.write_prometheus(path)
+    with open(path) as f:
+        lines = f.read().splitlines()
+    name = 'pyme_omero_operation_duration_seconds'
+    assert '# TYPE %s histogram' % name in lines
+    assert '%s_bucket{operation="hash",le="0.1"} 1' % name in lines
+    assert '%s_bucket{operation="hash",le="1.0"} 2' % name in lines
+    assert '%s_bucket{operation="hash",le="+Inf"} 3' % name in lines
+    assert '%s_count{operation="hash"} 3' % name in lines
+    assert 'pyme_omero_operation_bytes_total{operation="hash"} 30' in lines
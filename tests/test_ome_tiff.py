@@ -0,0 +1,55 @@
+import io
+
+import pytest
+
+np = pytest.importorskip('numpy')
+from pyme_omero import ome_tiff
+
+
+class PlaneSource(object):
+    """ 5D array which records the size of every read """
+    def __init__(self, data):
+        self._data = data
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.reads = []
+
+    def __getitem__(self, keys):
+        out = self._data[keys]
+        self.reads.append(out.size)
+        return out
+
+
+class SequentialFile(io.RawIOBase):
+    def __init__(self):
+        self.buf = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def write(self, b):
+        return self.buf.write(b)
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_planes_streamed_sequentially(compression):
+    data = np.random.randint(0, 4000, (100, 70, 3, 2, 2)).astype('u2')
+    source = PlaneSource(data)
+    f = SequentialFile()
+
+    n_bytes = ome_tiff.write_ome_tiff(source, f, name='stack', 
+                                      voxelsize=(0.1, 0.1, 0.2),
+                                      compression=compression, tile=32, 
+                                      maxworkers=3)
+    assert n_bytes == len(f.buf.getvalue())
+    assert source.reads == [100 * 70] * 12
+
+    tifffile = pytest.importorskip('tifffile')
+    with tifffile.TiffFile(io.BytesIO(f.buf.getvalue())) as tif:
+        assert tif.is_bigtiff and tif.is_ome
+        np.testing.assert_array_equal(tif.asarray(), 
+                                      data.transpose(3, 4, 2, 1, 0))
+        assert tif.pages[0].is_tiled == (compression is not None)
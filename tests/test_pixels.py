@@ -0,0 +1,59 @@
+import pytest
+
+pytest.importorskip('omero')
+np = pytest.importorskip('numpy')
+from pyme_omero import core, pixels
+from pyme_omero.connection import SessionPool
+from pyme_omero.testing.fake_omero import FakeServer
+
+
+def test_planes_written_in_parallel_and_linked(monkeypatch, use_session_pool):
+    # force some planes to be written as tiles
+    monkeypatch.setattr(pixels, 'MAX_MESSAGE_BYTES', 16 * 30)
+    server = FakeServer()
+    use_session_pool(SessionPool(server.login))
+    # (x, y, z, t, c)
+    data = np.random.randint(0, 1000, (16, 30, 3, 2, 2)).astype('u2')
+
+    image_id = core.upload_image_from_pixels('stack.tif', data, 'dataset',
+                                             attachments=[],
+                                             voxelsize=(0.1, 0.1, None),
+                                             max_workers=4)
+    assert server.calls['createRawPixelsStore'] == 4
+    assert server.calls['setTile'] > 0
+    assert server.calls['importFileset'] == 0
+
+    pixels_obj = server.image_pixels[image_id]
+    pixels_id = pixels_obj.getId().getValue()
+    assert pixels_obj.getSizeZ().getValue() == 3
+    assert pixels_obj.getPhysicalSizeX().getValue() == pytest.approx(0.1)
+    planes = server.planes[pixels_id]
+    assert len(planes) == 12
+    for (z, c, t), buf in planes.items():
+        plane = np.frombuffer(bytes(buf), '>u2').reshape(30, 16)
+        np.testing.assert_array_equal(plane, data[:, :, z, t, c].T)
+    for c in range(2):
+        assert server.channel_extrema[(pixels_id, c)] == (
+            data[..., c].min(), data[..., c].max())
+
+    dataset = [o for o in server.objects.values()
+               if type(o).__name__ == 'DatasetI'][0]
+    assert server.linked_ids(dataset.getId().getValue()) == [image_id]
+
+
+def test_failed_upload_deletes_image(monkeypatch, use_session_pool):
+    from pyme_omero.testing import fake_omero
+    server = FakeServer()
+    use_session_pool(SessionPool(server.login))
+
+    def fail(self, *args, **kwargs):
+        raise IOError('connection lost')
+    monkeypatch.setattr(fake_omero.FakeRawPixelsStore, 'setPlane', fail)
+    data = np.zeros((8, 8, 2, 1, 1), 'u2')
+
+    with pytest.raises(IOError):
+        core.upload_image_from_pixels('stack.tif', data, 'dataset')
+    assert server.calls['deleteObjects'] == 1
+    assert server.image_pixels == {}
+    assert not [o for o in server.objects.values()
+                if type(o).__name__ == 'ImageI']
@@ -0,0 +1,89 @@
+import os
+import pytest
+
+np = pytest.importorskip('numpy')
+h5py = pytest.importorskip('h5py')
+pytest.importorskip('PYME')
+from pyme_omero import transfer
+from pyme_omero.remote_tabular import RemoteHDFSource
+from pyme_omero.testing.fake_omero import FakeRawFileStore
+
+# as PYME's localization h5r files nest their FitResults
+FIT_RESULTS = np.dtype([
+    ('tIndex', '<i4'),
+    ('fitResults', [('A', '<f4'), ('x0', '<f4'), ('y0', '<f4'),
+                    ('sigma', '<f4'), ('background', '<f4')]),
+    ('fitError', [('A', '<f4'), ('x0', '<f4'), ('y0', '<f4'),
+                  ('sigma', '<f4'), ('background', '<f4')]),
+    ('resultCode', '<i4'),
+])
+
+
+def _h5r(path, n_rows=5000):
+    rows = np.zeros(n_rows, dtype=FIT_RESULTS)
+    rows['tIndex'] = np.arange(n_rows) // 10
+    rows['fitResults']['x0'] = np.random.rand(n_rows) * 1e4
+    rows['fitResults']['y0'] = np.random.rand(n_rows) * 1e4
+    rows['fitError']['x0'] = np.random.rand(n_rows) * 10
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('FitResults', data=rows, chunks=(1024,))
+    return rows
+
+
+def test_nested_fit_results_are_flattened_with_aliases(tmp_path):
+    path = str(tmp_path / 'locs.h5r')
+    rows = _h5r(path)
+    with open(path, 'rb') as f:
+        reader = transfer.RawFileStoreReader(FakeRawFileStore(
+            data=bytearray(f.read())))
+
+    source = RemoteHDFSource(reader)
+    for key in ('tIndex', 'fitResults_x0', 'fitError_sigma', 'x', 'y',
+                'error_x', 'A', 'sig'):
+        assert key in source.keys()
+    assert 'fitResults' not in source.keys() and 'z' not in source.keys()
+
+    np.testing.assert_array_equal(source['x'], rows['fitResults']['x0'])
+    np.testing.assert_array_equal(source['fitResults_y0'][100:200],
+                                  rows['fitResults']['y0'][100:200])
+    np.testing.assert_array_equal(source['error_x', 10:20],
+                                  rows['fitError']['x0'][10:20])
+    np.testing.assert_array_equal(source['tIndex'], rows['tIndex'])
+    with pytest.raises(KeyError):
+        source['fitResults']
+    source.close()
+
+
+def test_open_remote_localization_files(tmp_path, use_session_pool):
+    pytest.importorskip('omero')
+    from pyme_omero import core
+    from pyme_omero.connection import SessionPool
+    from pyme_omero.testing.fake_omero import FakeServer
+
+    server = FakeServer()
+    pool = use_session_pool(SessionPool(server.login, max_size=1))
+    conn = server.login()
+    image_id = server.create_image('a.png').pixels[0].image.getId().getValue()
+    image = conn.getObject('Image', image_id)
+    expected = {}
+    for name in ('a.h5r', 'b.hdf'):
+        path = str(tmp_path / name)
+        expected[os.path.splitext(name)[0]] = _h5r(path)
+        image.linkAnnotation(conn.createFileAnnfromLocalFile(path))
+
+    opened = []
+    open_dedicated = pool.open_dedicated
+    pool.open_dedicated = lambda: opened.append(open_dedicated()) or opened[-1]
+
+    sources = core.open_remote_localization_files(
+        'https://server/webclient/?show=image-%d' % image_id)
+    assert [name for name, _ in sources] == ['a', 'b']
+    # open sources don't hold up other users of the pool
+    with pool.connection(timeout=1):
+        pass
+    for name, source in sources:
+        np.testing.assert_array_equal(source['x'],
+                                      expected[name]['fitResults']['x0'])
+        assert opened[0].isConnected()
+        source.close()
+    assert not opened[0].isConnected()
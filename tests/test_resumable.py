@@ -0,0 +1,90 @@
+import hashlib
+import os
+
+from pyme_omero import resumable
+from pyme_omero.testing.fake_omero import FaultyRawFileStore
+
+BLOCK = 100000
+
+
+def _write(tmp_path, data):
+    path = str(tmp_path / 'large.h5r')
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def test_upload_resumes_after_dropped_connections(tmp_path):
+    data = os.urandom(25 * BLOCK + 123)
+    path = _write(tmp_path, data)
+
+    server_data = bytearray()
+    fail_at = [8, 3, 15]  # writes after which each successive store drops
+    stores, still_open = [], []
+    def open_store():
+        still_open.extend(store for store in stores if not store.closed)
+        stores.append(FaultyRawFileStore(data=server_data,
+                                         fail_at=fail_at.pop(0) if fail_at else None))
+        return stores[-1]
+
+    journal = resumable.UploadJournal(path, BLOCK, str(tmp_path / 'journal'))
+    digest = resumable.upload_file_resumable(open_store, path, journal,
+                                             backoff=0.)
+
+    assert digest == hashlib.sha1(data).hexdigest()
+    assert bytes(server_data) == data
+    assert len(stores) == 4
+    # each failed store was closed before another was opened
+    assert still_open == []
+    # each retry picked up where the last left off, nothing was re-sent
+    assert sum(store.n_writes for store in stores) == 26 + 3 + 1
+
+
+def test_resume_from_journal_rolls_back_corrupt_blocks(tmp_path):
+    data = os.urandom(10 * BLOCK)
+    path = _write(tmp_path, data)
+    journal_dir = str(tmp_path / 'journal')
+
+    # an earlier process got 6 blocks in before dying
+    server_data = bytearray(data[:6 * BLOCK])
+    journal = resumable.UploadJournal(path, BLOCK, journal_dir)
+    journal.set_target(42)
+    for i in range(6):
+        journal.record(resumable.block_digest(
+            data[i * BLOCK:(i + 1) * BLOCK]))
+    # ... but the last block it sent didn't make it intact
+    server_data[5 * BLOCK + 10] ^= 0xff
+
+    journal = resumable.UploadJournal(path, BLOCK, journal_dir)
+    assert (journal.target, journal.offset) == (42, 6 * BLOCK)
+
+    store = FaultyRawFileStore(data=server_data)
+    digest = resumable.upload_file_resumable(lambda: store, path, journal)
+
+    assert digest == hashlib.sha1(data).hexdigest()
+    assert bytes(server_data) == data
+    assert store.n_writes == 5  # blocks 5-9
+    journal.discard()
+    assert not os.listdir(journal_dir)
+
+
+def test_failed_reopen_is_retried(tmp_path):
+    data = os.urandom(3 * BLOCK)
+    path = _write(tmp_path, data)
+
+    server_data = bytearray()
+    attempts = []
+    def open_store():
+        attempts.append(None)
+        if len(attempts) in (2, 3):
+            raise IOError('server unreachable')
+        return FaultyRawFileStore(data=server_data,
+                                  fail_at=2 if len(attempts) == 1 else None)
+
+    journal = resumable.UploadJournal(path, BLOCK)
+    digest = resumable.upload_file_resumable(open_store, path, journal,
+                                             retries=3, backoff=0.)
+
+    assert digest == hashlib.sha1(data).hexdigest()
+    assert bytes(server_data) == data
+    assert len(attempts) == 4
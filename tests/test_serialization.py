@@ -0,0 +1,22 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+from pyme_omero import serialization
+
+
+def test_downcast_lossless_only_narrows_exact_columns():
+    records = np.zeros(4, dtype=[('x', 'f8'), ('sig', 'f8'), ('t', 'i8'),
+                                 ('probe', 'i8'), ('nchi2', 'f4')])
+    records['x'] = np.array([1.5, 2.25, 1e4, np.nan], dtype='f4')
+    records['sig'] = [0.1, 0.2, 0.3, 0.4]  # not exactly representable in f4
+    records['t'] = [0, 1, 20000, 65535]
+    records['probe'] = [-1, 0, 1, 2]
+    records['nchi2'] = 1
+
+    narrow = serialization.downcast_lossless(records)
+
+    assert [narrow.dtype[name] for name in narrow.dtype.names] == [
+        np.dtype('f4'), np.dtype('f8'), np.dtype('u2'), np.dtype('i1'),
+        np.dtype('f4')]
+    for name in records.dtype.names:
+        np.testing.assert_array_equal(narrow[name], records[name])
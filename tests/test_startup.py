@@ -0,0 +1,17 @@
+from pyme_omero.testing.importtime import import_cost, parse_importtime
+
+BUDGET_MS = 250.  # generous, CI machines are slow; typically well under 100
+
+
+def test_parse_importtime():
+    stderr = ('import time: self [us] | cumulative | imported package\n'
+              'import time:       120 |        120 |   json.decoder\n'
+              'import time:       300 |        420 | json\n')
+    assert parse_importtime(stderr) == [('json.decoder', 1, 120, 120),
+                                        ('json', 0, 300, 420)]
+
+
+def test_core_import_is_cheap_and_needs_no_omero_or_credentials():
+    result = import_cost('pyme_omero.core')
+    assert result['heavy_imports'] == []
+    assert result['import_ms'] < BUDGET_MS
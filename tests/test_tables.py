@@ -0,0 +1,101 @@
+import pytest
+
+pytest.importorskip('omero')
+np = pytest.importorskip('numpy')
+from pyme_omero import tables
+from pyme_omero.testing.fake_omero import FakeServer
+
+
+class Metadata(object):
+    def to_JSON(self):
+        return '{"voxelsize.x": 0.1}'
+
+
+def localizations(n_rows=2500):
+    return {
+        'x': np.random.rand(n_rows).astype('f4'),
+        't': np.arange(n_rows, dtype='i4') // 10,
+        'probe': (np.arange(n_rows) % 2).astype('u1'),
+    }
+
+
+def test_table_written_in_batches_and_read_by_column_and_row():
+    server = FakeServer()
+    conn = server.login()
+    data = localizations()
+
+    file_id = tables.write_table(conn, data, 'FitResults', Metadata(),
+                                 batch_rows=1000)
+    assert server.calls['addData'] == 3
+
+    reader = tables.TableReader(conn, file_id, start=100, stop=1100,
+                                batch_rows=400)
+    assert reader.n_rows == 1000
+    columns = reader.read(['x'])
+    assert list(columns) == ['x']
+    np.testing.assert_array_equal(columns['x'], data['x'][100:1100])
+    assert columns['x'].dtype == np.float32
+    assert server.calls['readTable'] == 3
+    assert reader.metadata()['pyme.metadata'] == Metadata().to_JSON()
+    reader.close()
+
+    # server-side selection of one time window of one probe
+    reader = tables.TableReader(conn, file_id,
+                                where='(t >= tmin) & (t < 150) & (probe == 1)',
+                                variables={'tmin': 100})
+    selected = (data['t'] >= 100) & (data['t'] < 150) & (data['probe'] == 1)
+    columns = reader.read(['t', 'probe'])
+    np.testing.assert_array_equal(columns['t'], data['t'][selected])
+    assert columns['probe'].dtype == np.uint8
+    reader.close()
+
+
+def test_tables_attached_to_image_open_as_sources(use_session_pool):
+    pytest.importorskip('PYME')
+    from pyme_omero import core
+    from pyme_omero.connection import SessionPool
+
+    server = FakeServer()
+    pool = use_session_pool(SessionPool(server.login))
+    image_id = server.create_image('a.tif').pixels[0].image.getId().getValue()
+    data = localizations()
+    with core.connection() as conn:
+        core.upload_table_annotation(conn, image_id, data, 'FitResults')
+
+    opened = []
+    open_dedicated = pool.open_dedicated
+    pool.open_dedicated = lambda: opened.append(open_dedicated()) or opened[-1]
+
+    sources = core.open_localization_tables(
+        'https://server/webclient/?show=image-%d' % image_id, columns=['x'],
+        where='t < 10')
+    [(name, source)] = sources
+    assert name == 'FitResults'
+    assert source.keys() == ['x']
+    np.testing.assert_array_equal(source['x'], data['x'][:100])
+    assert opened[0].isConnected()
+    source.close()
+    # the sources' own connection is closed with them, the pool's untouched
+    assert not opened[0].isConnected()
+    assert pool.n_idle == 1
+
+
+def test_batches_sized_by_number_of_columns(monkeypatch):
+    monkeypatch.setattr(tables, 'BATCH_BYTES', 8 * 3 * 1000)
+    server = FakeServer()
+    conn = server.login()
+    data = localizations()
+    file_id = tables.write_table(conn, data, 'FitResults')
+    assert server.calls['addData'] == 3
+
+    # fewer columns read, more rows per call
+    reader = tables.TableReader(conn, file_id)
+    columns = reader.read(['x'])
+    np.testing.assert_array_equal(columns['x'], data['x'])
+    assert server.calls['readTable'] == 1
+    reader.close()
+
+    wide = dict(('c%d' % i, np.zeros(10)) for i in range(80))
+    monkeypatch.setattr(tables, 'BATCH_BYTES', 8 * 80 * 4)
+    tables.write_table(conn, wide, 'wide')
+    assert server.calls['addData'] == 3 + 3
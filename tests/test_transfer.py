@@ -0,0 +1,86 @@
+import os
+import pytest
+from pyme_omero import transfer
+from pyme_omero.testing.fake_omero import FakeServer
+
+
+@pytest.mark.parametrize('n_streams', [1, 3])
+def test_download_is_chunked(tmp_path, n_streams):
+    server = FakeServer()
+    data = os.urandom(int(3.5 * transfer.MAX_READ_SIZE))
+    file_id = server.add_original_file(data)
+    path = str(tmp_path / 'large.h5r')
+
+    transfer.download_original_file(server.login(), file_id, len(data), path,
+                                    n_streams=n_streams)
+
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert server.bytes_downloaded == len(data)
+    assert server.calls['createRawFileStore'] == n_streams
+
+
+def test_writer_hashes_sequential_and_patched_writes():
+    import hashlib
+    from pyme_omero.testing.fake_omero import FakeRawFileStore
+
+    data = os.urandom(int(2.5 * transfer.MAX_READ_SIZE))
+    rfs = FakeRawFileStore()
+    with transfer.RawFileStoreWriter(rfs) as writer:
+        for i in range(0, len(data), 1000):
+            writer.write(data[i:i + 1000])
+        assert writer.hexdigest() == hashlib.sha1(data).hexdigest()
+        assert rfs.n_writes == 3  # buffered into server-sized blocks
+
+        # e.g. a TIFF writer going back to patch an offset
+        writer.seek(4)
+        writer.write(b'\x00' * 4)
+        writer.seek(0, os.SEEK_END)
+        writer.write(b'tail')
+        patched = data[:4] + b'\x00' * 4 + data[8:] + b'tail'
+        assert writer.hexdigest() == hashlib.sha1(patched).hexdigest()
+    assert bytes(rfs.data) == patched
+
+
+def test_reader_caches_blocks_and_reads_ahead():
+    import io
+    from pyme_omero.testing.fake_omero import FakeRawFileStore
+
+    data = os.urandom(50000)
+    rfs = FakeRawFileStore(data=bytearray(data))
+    reader = transfer.RawFileStoreReader(rfs, block_size=1000, cache_blocks=8,
+                                         read_ahead=2)
+    reader.seek(-10, io.SEEK_END)
+    assert reader.read() == data[-10:]
+    reader.seek(12345)
+    assert reader.read(3000) == data[12345:15345]
+    assert reader.read(10) == data[15345:15355]
+    fetched = reader.n_fetched
+    reader.seek(12000)
+    assert reader.read(1000) == data[12000:13000]  # cached
+    assert reader.n_fetched <= fetched + 2  # at most read-ahead since
+    reader.close()
+    # random access only fetches what it touches
+    assert reader.bytes_fetched < len(data) / 4
+
+
+def test_h5py_reads_through_reader(tmp_path):
+    h5py = pytest.importorskip('h5py')
+    import numpy as np
+    from pyme_omero.testing.fake_omero import FakeRawFileStore
+
+    path = str(tmp_path / 'test.h5r')
+    rows = np.zeros(200000, dtype=[('x', 'f4'), ('y', 'f4'), ('t', 'i4')])
+    rows['x'] = np.arange(len(rows))
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('FitResults', data=rows, chunks=(4096,))
+        f.create_dataset('Other', data=np.zeros(1000000))
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    reader = transfer.RawFileStoreReader(FakeRawFileStore(
+        data=bytearray(data)), block_size=65536)
+    with h5py.File(reader, 'r') as f:
+        x = f['FitResults'].fields('x')[1000:2000]
+    np.testing.assert_array_equal(x, rows['x'][1000:2000])
+    assert reader.bytes_fetched < len(data) / 4
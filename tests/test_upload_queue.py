@@ -0,0 +1,103 @@
+import threading
+import time
+import pytest
+from pyme_omero.upload_queue import UploadQueue, DONE, FAILED
+
+
+def test_transfer_overlaps_import_and_cleans_up():
+    queue = UploadQueue(transfer_workers=1, import_workers=2)
+    log, cleaned = [], []
+    importing = threading.Event()
+
+    def transfer(name):
+        def f():
+            log.append(('transfer', name))
+            return name
+        return f
+
+    def finish(name):
+        if name == 'a':
+            importing.set()
+            time.sleep(0.1)  # slow server-side import
+        log.append(('finish', name))
+        return name.upper()
+
+    a = queue.submit(transfer('a'), finish, cleanup=lambda: cleaned.append('a'))
+    importing.wait(1)
+    b = queue.submit(transfer('b'), finish, cleanup=lambda: cleaned.append('b'))
+
+    assert a.result(1) == 'A' and b.result(1) == 'B'
+    # b was transferred while a was still importing
+    assert log.index(('transfer', 'b')) < log.index(('finish', 'a'))
+    assert sorted(cleaned) == ['a', 'b']
+    assert [s for _, s in queue.status().values()] == [DONE, DONE]
+    queue.shutdown()
+
+
+def test_failed_jobs_report_status():
+    queue = UploadQueue()
+    cleaned = []
+
+    def transfer():
+        raise IOError('connection refused')
+
+    job = queue.submit(transfer, cleanup=lambda: cleaned.append(True))
+    with pytest.raises(IOError):
+        job.result(1)
+    assert job.status == FAILED and cleaned == [True]
+    assert queue.wait(1) and queue.n_pending == 0
+    queue.shutdown()
+
+
+def test_transfer_result_released_if_queue_shut_down():
+    queue = UploadQueue()
+    aborted, cleaned = [], []
+    transferring, shut_down = threading.Event(), threading.Event()
+
+    def transfer():
+        transferring.set()
+        shut_down.wait(1)
+        return 'connection'
+
+    job = queue.submit(transfer, finish=lambda started: None,
+                       cleanup=lambda: cleaned.append(True),
+                       abort=aborted.append)
+    transferring.wait(1)
+    queue._import_pool.shutdown()
+    shut_down.set()
+
+    with pytest.raises(RuntimeError):
+        job.result(1)
+    assert job.status == FAILED
+    assert aborted == ['connection'] and cleaned == [True]
+    queue.shutdown()
+
+
+def test_in_flight_jobs_are_bounded():
+    queue = UploadQueue(transfer_workers=2, import_workers=2, max_in_flight=2)
+    in_flight, most = [0], [0]
+    lock = threading.Lock()
+
+    def transfer():
+        with lock:
+            in_flight[0] += 1
+            most[0] = max(most[0], in_flight[0])
+
+    def finish(started):
+        time.sleep(0.02)
+        with lock:
+            in_flight[0] -= 1
+
+    jobs = [queue.submit(transfer, finish) for i in range(6)]
+    assert queue.wait(2)
+    # unbounded, transfers would run ahead of the slow finishes
+    assert most[0] <= 2 and all(job.status == DONE for job in jobs)
+    queue.shutdown()
+
+
+def test_only_recent_finished_jobs_are_kept():
+    queue = UploadQueue(max_finished=3)
+    jobs = [queue.submit(lambda: None) for i in range(5)]
+    queue.shutdown()
+    assert all(job.done() for job in jobs)
+    assert list(queue.status().keys()) == [job.id for job in jobs[-3:]]